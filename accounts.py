@@ -0,0 +1,304 @@
+"""Triage many Gmail accounts in parallel on a process pool.
+
+Each account has its own folder under the accounts directory holding its
+OAuth token and its triage state. Authorize a mailbox through the app, then
+register the resulting token and start the scheduler:
+
+    python accounts.py add alice@example.com token.json
+    python accounts.py list
+    python accounts.py run --interval 300 --workers 8
+"""
+import argparse
+import logging
+import math
+import multiprocessing
+import os
+import re
+import shutil
+import signal
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from email_processor import EmailProcessor
+from embedding_index import DEFAULT_EMBEDDING_MODEL, default_embedder
+from gmail_auth import build_gmail_resource
+from gmail_fetch import USER_QUOTA_PER_SECOND
+from rate_limiter import SharedTokenBucket, TokenBucket
+from results_store import ResultsStore
+from triage_daemon import run_once
+
+logger = logging.getLogger("accounts")
+
+_ACCOUNT_PATTERN = re.compile(r"^[\w.@+-]+$")
+
+# Worker process state, set up by _init_worker
+_llm_limiter = None
+_processors = {}
+_embedder = None  # Shared by the accounts of a worker; loading a model is slow
+
+
+class AccountStore:
+    """Per-account credentials and triage state under one directory.
+
+    Every account gets a folder named after it holding its token.json,
+    triage cache, fast-path model, sender history, email index, results
+    store and metrics. The OAuth client in ``client_secrets_file`` is shared by all
+    accounts.
+    """
+
+    def __init__(self, root="accounts", client_secrets_file="credentials.json"):
+        self.root = root
+        self.client_secrets_file = client_secrets_file
+
+    def path(self, account, filename):
+        """Return the path of ``filename`` in the account's folder."""
+        if not _ACCOUNT_PATTERN.match(account):
+            raise ValueError(f"Invalid account name: {account!r}")
+        return os.path.join(self.root, account, filename)
+
+    def accounts(self):
+        """Return the names of all accounts that have a token."""
+        if not os.path.isdir(self.root):
+            return []
+        return sorted(
+            name for name in os.listdir(self.root)
+            if _ACCOUNT_PATTERN.match(name)
+            and os.path.exists(os.path.join(self.root, name, "token.json")))
+
+    def add(self, account, token_file):
+        """Register an account by copying its authorized token file."""
+        token_path = self.path(account, "token.json")
+        os.makedirs(os.path.dirname(token_path), exist_ok=True)
+        shutil.copyfile(token_file, token_path)
+
+    def remove(self, account):
+        """Delete an account's token and all of its triage state."""
+        shutil.rmtree(os.path.dirname(self.path(account, "token.json")),
+                      ignore_errors=True)
+
+
+def _init_worker(llm_limiter, log_level):
+    global _llm_limiter
+    _llm_limiter = llm_limiter
+    # Ctrl-C reaches the whole process group; only the parent shuts down
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    logging.basicConfig(level=log_level,
+                        format="%(asctime)s %(levelname)s %(processName)s "
+                        "%(name)s: %(message)s")
+
+
+def _get_processor(store, account, settings):
+    """Return this worker's EmailProcessor for ``account``, building it once."""
+    global _embedder
+    processor = _processors.get(account)
+    if processor is None:
+        if _embedder is None:
+            _embedder = default_embedder(settings['embedding_model'])
+        _, api_resource = build_gmail_resource(
+            token_file=store.path(account, "token.json"),
+            client_secrets_file=store.client_secrets_file)
+        quota = settings['gmail_quota_per_second']
+        processor = EmailProcessor(
+            api_resource,
+            fused_triage=settings['fused_triage'],
+            max_concurrency=settings['max_concurrency'],
+            cache_path=store.path(account, "triage_cache.db"),
+            fast_path_model=store.path(account, "fast_classifier.json"),
+            metrics_path=store.path(account, "pipeline_metrics.jsonl"),
+            sender_history_path=store.path(account, "sender_history.json"),
+            index_path=store.path(account, "email_index.db"),
+            embedder=_embedder,
+            rate_limiter=_llm_limiter,
+            gmail_limiter=TokenBucket(rate=quota, capacity=quota))
+        _processors[account] = processor
+    # Other workers' fast-path training and sender history reach this one
+    # when it saves its own: FastClassifier and Prioritizer merge on save.
+    return processor
+
+
+def triage_account(store, account, settings):
+    """Run one triage pass for ``account`` in a worker process."""
+    started = time.perf_counter()
+    try:
+        processor = _get_processor(store, account, settings)
+        results = ResultsStore(store.path(account, "triage_results.db"))
+        ok = run_once(processor, results, settings['query'],
+                      settings['max_results'])
+        errors = processor.errors
+    except Exception as e:
+        ok, errors = False, [str(e)]
+    return {
+        'account': account,
+        'ok': ok,
+        'seconds': time.perf_counter() - started,
+        'errors': errors
+    }
+
+
+class AccountScheduler:
+    """Spread per-account triage runs across a process pool.
+
+    Every account is scheduled as its own task, so a slow mailbox only
+    delays its own next run and never the others. All workers draw LLM
+    requests from one shared token bucket allowing
+    ``llm_requests_per_second`` in total, while each mailbox is throttled
+    to its own Gmail quota of ``gmail_quota_per_second`` units.
+    """
+
+    def __init__(self,
+                 store,
+                 max_workers=None,
+                 llm_requests_per_second=5.0,
+                 gmail_quota_per_second=USER_QUOTA_PER_SECOND,
+                 query="is:unread newer_than:2d category:primary",
+                 max_results=50,
+                 max_concurrency=4,
+                 fused_triage=True,
+                 embedding_model=DEFAULT_EMBEDDING_MODEL,
+                 log_level="INFO"):
+        self.store = store
+        self.settings = {
+            'query': query,
+            'max_results': max_results,
+            'max_concurrency': max_concurrency,
+            'fused_triage': fused_triage,
+            'embedding_model': embedding_model,
+            'gmail_quota_per_second': gmail_quota_per_second
+        }
+        # Spawned workers don't inherit the parent's threads or HTTP clients
+        context = multiprocessing.get_context("spawn")
+        self.llm_limiter = SharedTokenBucket(rate=llm_requests_per_second,
+                                             context=context)
+        self.executor = ProcessPoolExecutor(max_workers=max_workers
+                                            or os.cpu_count(),
+                                            mp_context=context,
+                                            initializer=_init_worker,
+                                            initargs=(self.llm_limiter,
+                                                      log_level))
+
+    def run(self, interval=300.0, once=False, stop=None):
+        """Triage every account each ``interval`` seconds until ``stop`` is set.
+
+        Accounts added to the store while running are picked up on the next
+        pass. With ``once`` every account runs a single time; returns the
+        results of all completed runs.
+        """
+        stop = stop or threading.Event()
+        running = {}  # future -> account
+        next_due = {}
+        completed = []
+        while not stop.is_set():
+            now = time.monotonic()
+            busy = set(running.values())
+            for account in self.store.accounts():
+                if account in busy or next_due.get(account, 0) > now:
+                    continue
+                future = self.executor.submit(triage_account, self.store,
+                                              account, self.settings)
+                running[future] = account
+                next_due[account] = math.inf if once else now + interval
+
+            # Wake up for the next due account, but check ``stop`` regularly
+            timeout = min(next_due.values(), default=math.inf) - time.monotonic()
+            timeout = min(max(timeout, 0.0), 1.0)
+            if not running:
+                if once:
+                    break
+                stop.wait(timeout)
+                continue
+            done, _ = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                running.pop(future)
+                result = future.result()
+                completed.append(result)
+                if result['ok']:
+                    logger.info("%s: triaged in %.1f s", result['account'],
+                                result['seconds'])
+                else:
+                    logger.error("%s: triage failed: %s", result['account'],
+                                 "; ".join(result['errors']))
+        return completed
+
+    def close(self):
+        """Stop the worker processes, dropping runs that haven't started."""
+        self.executor.shutdown(cancel_futures=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--root", default="accounts",
+                        help="directory holding one folder per account")
+    parser.add_argument("--log-level", default="INFO")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    add = commands.add_parser("add", help="register an authorized account")
+    add.add_argument("account")
+    add.add_argument("token_file")
+    remove = commands.add_parser("remove", help="delete an account")
+    remove.add_argument("account")
+    commands.add_parser("list", help="list registered accounts")
+
+    run = commands.add_parser("run", help="triage all accounts on a schedule")
+    run.add_argument("--query", default="is:unread newer_than:2d category:primary")
+    run.add_argument("--max-results", type=int, default=50)
+    run.add_argument("--interval", type=float, default=300.0,
+                     help="seconds between runs of each account")
+    run.add_argument("--once", action="store_true",
+                     help="triage every account once and exit")
+    run.add_argument("--workers", type=int, default=None,
+                     help="worker processes (default: number of cores)")
+    run.add_argument("--llm-rps", type=float, default=5.0,
+                     help="LLM requests per second across all accounts")
+    run.add_argument("--gmail-quota", type=float,
+                     default=USER_QUOTA_PER_SECOND,
+                     help="Gmail quota units per second per account")
+    run.add_argument("--concurrency", type=int, default=4,
+                     help="emails triaged at once per account")
+    run.add_argument("--separate-chains", action="store_true",
+                     help="disable fused triage")
+    run.add_argument("--embedding-model", default=DEFAULT_EMBEDDING_MODEL,
+                     help="fastembed model for each account's email index")
+    run.add_argument("--keyword-index", action="store_true",
+                     help="index emails by keywords instead of an embedding model")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=args.log_level.upper(),
+                        format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    store = AccountStore(args.root)
+    if args.command == "add":
+        store.add(args.account, args.token_file)
+        return 0
+    if args.command == "remove":
+        store.remove(args.account)
+        return 0
+    if args.command == "list":
+        for account in store.accounts():
+            print(account)
+        return 0
+
+    scheduler = AccountScheduler(store,
+                                 max_workers=args.workers,
+                                 llm_requests_per_second=args.llm_rps,
+                                 gmail_quota_per_second=args.gmail_quota,
+                                 query=args.query,
+                                 max_results=args.max_results,
+                                 max_concurrency=args.concurrency,
+                                 fused_triage=not args.separate_chains,
+                                 embedding_model=None if args.keyword_index
+                                 else args.embedding_model,
+                                 log_level=args.log_level.upper())
+    stop = threading.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda *_: stop.set())
+    try:
+        results = scheduler.run(interval=args.interval,
+                                once=args.once,
+                                stop=stop)
+    finally:
+        scheduler.close()
+    return 0 if all(result['ok'] for result in results) else 1
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -1,334 +1,912 @@
-import streamlit as st
-import os
-from gmail_auth import initialize_gmail
-from email_processor import EmailProcessor
-from datetime import datetime, timedelta
-import hashlib
-import html
-
-# Page configuration
-st.set_page_config(
-    page_title="Email AI Agent",
-    page_icon="📧",
-    layout="wide"
-)
-
-# Custom CSS for styling
-st.markdown("""
-    <style>
-    .main {
-        padding: 2rem;
-        background-color: #f8f9fa;
-    }
-    .stButton > button {
-        width: 100%;
-        background-color: #0066cc;
-        color: white;
-        border-radius: 4px;
-        padding: 0.5rem 1rem;
-        border: none;
-        font-weight: 500;
-    }
-    .email-card {
-        background-color: white;
-        border-radius: 8px;
-        padding: 1.5rem;
-        margin: 1rem 0;
-        box-shadow: 0 2px 4px rgba(0,0,0,0.1);
-        display: flex;
-        justify-content: space-between;
-        align-items: center;
-    }
-    .email-content {
-        flex: 1;
-    }
-    .email-sender {
-        color: #666;
-        font-size: 0.9rem;
-        margin-bottom: 0.5rem;
-    }
-    .email-subject {
-        font-size: 1.1rem;
-        font-weight: 600;
-        margin-bottom: 0.75rem;
-    }
-    .email-summary {
-        color: #444;
-        margin-bottom: 1rem;
-    }
-    .priority-tag {
-        padding: 4px 12px;
-        border-radius: 12px;
-        font-weight: 500;
-        display: inline-block;
-    }
-    .priority-urgent {
-        background-color: #fecaca;
-        color: #dc2626;
-        background-color: #dc2626; /* Red background */
-        padding: 4px 12px;
-        border-radius: 12px;
-        font-weight: 500;
-        display: inline-block;
-    }
-    .priority-high {
-        background-color: #fee2e2;
-        color: #dc2626;
-    }
-    .priority-medium {
-        background-color: #fef9c3;
-        color: #854d0e;
-    }
-    .priority-low {
-        background-color: #dcfce7;
-        color: #16a34a;
-    }
-    .stats-container {
-        display: flex;
-        gap: 1rem;
-        margin-bottom: 2rem;
-    }
-    .stats-card {
-        flex: 1;
-        background: white;
-        padding: 1.5rem;
-        border-radius: 8px;
-        box-shadow: 0 2px 4px rgba(0,0,0,0.1);
-        text-align: center;
-    }
-    .stats-number {
-        font-size: 2rem;
-        font-weight: 600;
-        color: #0066cc;
-        margin-bottom: 0.5rem;
-    }
-    .stats-label {
-        color: #666;
-        font-size: 0.9rem;
-    }
-    .action-buttons {
-        display: flex;
-        gap: 0.5rem;
-        margin-top: 1rem;
-    }
-    .action-button {
-        padding: 4px 12px;
-        border-radius: 4px;
-        cursor: pointer;
-        font-size: 0.9rem;
-        border: 1px solid #e5e7eb;
-        background: white;
-    }
-    .action-button:hover {
-        background: #f3f4f6;
-    }
-    .generate-reply-button {
-        background-color: #4CAF50;
-        color: white;
-        border: none;
-        padding: 5px 10px;
-        border-radius: 4px;
-        cursor: pointer;
-        font-size: 0.9rem;
-    }
-    .generate-reply-button:hover {
-        background-color: #45a049;
-    }
-    </style>
-""", unsafe_allow_html=True)
-
-def safe_html(text):
-    """Safely escape text for HTML display."""
-    return html.escape(str(text)) if text else ""
-
-def format_time_ago(timestamp):
-    """Format timestamp as relative time."""
-    if not timestamp:
-        return "Never"
-    now = datetime.now()
-    diff = now - timestamp
-    if diff.seconds < 60:
-        return "Just now"
-    elif diff.seconds < 3600:
-        return f"{diff.seconds // 60} minutes ago"
-    else:
-        return f"{diff.seconds // 3600} hours ago"
-
-def generate_draft_reply(processor, email):
-    """Generate a draft reply for the selected email."""
-    with st.spinner('Generating draft reply...'):
-        success, message = processor.generate_draft_reply(email)
-        if success:
-            st.success(message)
-        else:
-            st.error(message)
-
-def main():
-    if 'processed_emails' not in st.session_state:
-        st.session_state.processed_emails = []
-    if 'last_refresh' not in st.session_state:
-        st.session_state.last_refresh = None
-    if 'selected_email' not in st.session_state:
-        st.session_state.selected_email = None  # Track the selected email for draft generation
-
-    st.title("📧 Email AI Agent")
-    st.markdown("Smart email management powered by AI")
-
-    # Initialize Gmail
-    credentials, api_resource = initialize_gmail()
-    if not credentials or not api_resource:
-        st.warning("Please complete Gmail authentication to continue.")
-        return
-
-    # Sidebar configuration
-    with st.sidebar:
-        st.header("Settings")
-        search_period = st.selectbox(
-            "Time Range",
-            ["1d", "2d", "3d", "7d"],
-            index=1,
-            format_func=lambda x: {
-                "1d": "Last 24 hours",
-                "2d": "Last 2 days",
-                "3d": "Last 3 days",
-                "7d": "Last week"
-            }[x]
-        )
-
-        max_results = st.slider(
-            "Number of Emails",
-            min_value=5,
-            max_value=50,
-            value=10,
-            step=5
-        )
-
-        query_base = st.text_input(
-            "Filter Query",
-            value="category:primary"
-        )
-
-    # Process emails button
-    col1, col2 = st.columns([3, 1])
-    with col1:
-        if st.button("🔄 Process New Emails", use_container_width=True):
-            processor = EmailProcessor(api_resource)
-            query = f"is:unread newer_than:{search_period} {query_base}"
-            with st.spinner("Processing emails..."):
-                st.session_state.processed_emails = processor.process_emails(
-                    query=query,
-                    max_results=max_results
-                )
-                st.session_state.last_refresh = datetime.now()
-
-    with col2:
-        st.caption(f"Last updated: {format_time_ago(st.session_state.last_refresh)}")
-
-    # Display results
-    if st.session_state.processed_emails:
-        emails = st.session_state.processed_emails
-
-        # Calculate statistics
-        categories = {
-            'Work': 0,
-            'Personal': 0,
-            'Promotional': 0,
-            'Spam': 0
-        }
-
-        for email in emails:
-            categories[email['category']] = categories.get(email['category'], 0) + 1
-
-        # Display statistics
-        st.markdown("### Email Overview")
-
-        # Create columns based on the number of stats_data items
-        stats_data = [("Total", len(emails))] + list(categories.items())
-        cols = st.columns(len(stats_data))
-
-        for i, (label, count) in enumerate(stats_data):
-            with cols[i]:
-                st.markdown(f"""
-                <div class="stats-card">
-                    <div class="stats-number">{count}</div>
-                    <div class="stats-label">{label} Emails</div>
-                </div>
-                """, unsafe_allow_html=True)
-
-        # Email tabs
-        tabs = st.tabs(["📥 All", "💼 Work", "👤 Personal", "🏷️ Promotional", "⚠️ Spam"])
-
-        # Function to generate a unique key for an email
-        def generate_unique_key(email):
-            # Combine email metadata to create a unique string
-            unique_string = f"{email['subject']}_{email['sender']}"
-            # Hash the string to create a unique key
-            return hashlib.md5(unique_string.encode()).hexdigest()
-
-        def display_emails(filtered_emails):
-            if not filtered_emails:
-                st.info("No emails in this category.")
-                return
-
-            for index, email in enumerate(filtered_emails):
-                urgency = email['urgency'].split(":")[0].strip().lower()  # Extracts "urgent"
-                priority_class = f"priority-{email['urgency'].lower()}"
-                # Apply urgent class if email is urgent
-                urgent_class = "urgent" if urgency == "urgent" else ""
-
-                email_html = f"""
-                <div class="email-card">
-                    <div class="email-content">
-                        <div class="email-sender">{safe_html(email['sender'])}</div>
-                        <div class="email-subject">{safe_html(email['subject'])}</div>
-                        <div class="email-summary">{safe_html(email['summary'])}</div>
-                        <div class="email-meta">
-                            <span>Category: {safe_html(email['category'])}</span>
-                            <span class="priority-tag {priority_class}">
-                                {safe_html(email['urgency'])}
-                            </span>
-                        </div>
-                    </div>
-                </div>
-                """
-                st.markdown(email_html, unsafe_allow_html=True)
-
-                
-                # Generate a unique key for the button
-                unique_key = generate_unique_key(email)
-                if st.button(f"✍️ Generate Draft Reply for: {email['subject']}", key=unique_key):
-                    st.session_state.selected_email = email  # Store the selected email in session state
-                    st.rerun()  # Rerun the app to trigger the draft generation logic
-
-        # Display emails in tabs
-        with tabs[0]:
-            display_emails(emails)
-
-        with tabs[1]:
-            display_emails([e for e in emails if e['category'] == 'Work'])
-
-        with tabs[2]:
-            display_emails([e for e in emails if e['category'] == 'Personal'])
-
-        with tabs[3]:
-            display_emails([e for e in emails if e['category'] == 'Promotional'])
-
-        with tabs[4]:
-            display_emails([e for e in emails if e['category'] == 'Spam'])
-
-        # Draft generation logic
-        if st.session_state.selected_email:
-            st.markdown("### Draft Reply")
-            selected_email = st.session_state.selected_email
-            processor = EmailProcessor(api_resource)
-            success, message = processor.generate_draft_reply(selected_email)
-            if success:
-                st.success("Draft created successfully!")
-            else:
-                st.error(f"Error: {message}")
-
-    else:
-        st.info("👋 Welcome! Click 'Process New Emails' to start analyzing your inbox.")
-
-if __name__ == "__main__":
+import streamlit as st
+import os
+from gmail_auth import initialize_gmail
+from email_processor import EmailProcessor
+from draft_jobs import DraftJobQueue, PENDING, RUNNING, DONE, FAILED
+from results_store import ResultsStore, merge_emails
+from email_store import BodyCache, Category, EmailRecord, EmailStore, Urgency
+from embedding_index import default_embedder
+from datetime import datetime, timedelta
+import html
+import math
+import time
+
+# Page configuration
+st.set_page_config(
+    page_title="Email AI Agent",
+    page_icon="📧",
+    layout="wide"
+)
+
+# Category views of the email list, in display order
+CATEGORY_VIEWS = [
+    ("All", "📥"),
+    ("Work", "💼"),
+    ("Personal", "👤"),
+    ("Promotional", "🏷️"),
+    ("Spam", "⚠️")
+]
+PAGE_SIZES = [10, 25, 50, 100]
+# Sidebar search settings; the defaults match the triage daemon's query
+PERIODS = ["1d", "2d", "3d", "7d"]
+DEFAULT_PERIOD = "2d"
+DEFAULT_QUERY_BASE = "category:primary"
+# Bulk label changes: (button text, result text, labels added, labels
+# removed). Each takes the selected emails out of the unread inbox view.
+BULK_ACTIONS = {
+    "archive": ("🗄️ Archive", "Archived", (), ("INBOX",)),
+    "mark_read": ("✔️ Mark as read", "Marked as read", (), ("UNREAD",)),
+    "spam": ("⚠️ Report spam", "Reported as spam", ("SPAM",), ("INBOX",))
+}
+
+# Custom CSS for styling
+st.markdown("""
+    <style>
+    .main {
+        padding: 2rem;
+        background-color: #f8f9fa;
+    }
+    .stButton > button {
+        width: 100%;
+        background-color: #0066cc;
+        color: white;
+        border-radius: 4px;
+        padding: 0.5rem 1rem;
+        border: none;
+        font-weight: 500;
+    }
+    .email-card {
+        background-color: white;
+        border-radius: 8px;
+        padding: 1.5rem;
+        margin: 1rem 0;
+        box-shadow: 0 2px 4px rgba(0,0,0,0.1);
+        display: flex;
+        justify-content: space-between;
+        align-items: center;
+    }
+    .email-content {
+        flex: 1;
+    }
+    .email-sender {
+        color: #666;
+        font-size: 0.9rem;
+        margin-bottom: 0.5rem;
+    }
+    .email-subject {
+        font-size: 1.1rem;
+        font-weight: 600;
+        margin-bottom: 0.75rem;
+    }
+    .email-summary {
+        color: #444;
+        margin-bottom: 1rem;
+    }
+    .priority-tag {
+        padding: 4px 12px;
+        border-radius: 12px;
+        font-weight: 500;
+        display: inline-block;
+    }
+    .priority-urgent {
+        background-color: #fecaca;
+        color: #dc2626;
+        background-color: #dc2626; /* Red background */
+        padding: 4px 12px;
+        border-radius: 12px;
+        font-weight: 500;
+        display: inline-block;
+    }
+    .priority-high {
+        background-color: #fee2e2;
+        color: #dc2626;
+    }
+    .priority-medium {
+        background-color: #fef9c3;
+        color: #854d0e;
+    }
+    .priority-low {
+        background-color: #dcfce7;
+        color: #16a34a;
+    }
+    .stats-container {
+        display: flex;
+        gap: 1rem;
+        margin-bottom: 2rem;
+    }
+    .stats-card {
+        flex: 1;
+        background: white;
+        padding: 1.5rem;
+        border-radius: 8px;
+        box-shadow: 0 2px 4px rgba(0,0,0,0.1);
+        text-align: center;
+    }
+    .stats-number {
+        font-size: 2rem;
+        font-weight: 600;
+        color: #0066cc;
+        margin-bottom: 0.5rem;
+    }
+    .stats-label {
+        color: #666;
+        font-size: 0.9rem;
+    }
+    .action-buttons {
+        display: flex;
+        gap: 0.5rem;
+        margin-top: 1rem;
+    }
+    .action-button {
+        padding: 4px 12px;
+        border-radius: 4px;
+        cursor: pointer;
+        font-size: 0.9rem;
+        border: 1px solid #e5e7eb;
+        background: white;
+    }
+    .action-button:hover {
+        background: #f3f4f6;
+    }
+    .generate-reply-button {
+        background-color: #4CAF50;
+        color: white;
+        border: none;
+        padding: 5px 10px;
+        border-radius: 4px;
+        cursor: pointer;
+        font-size: 0.9rem;
+    }
+    .generate-reply-button:hover {
+        background-color: #45a049;
+    }
+    </style>
+""", unsafe_allow_html=True)
+
+def safe_html(text):
+    """Safely escape text for HTML display."""
+    return html.escape(str(text)) if text else ""
+
+def format_time_ago(timestamp):
+    """Format timestamp as relative time."""
+    if not timestamp:
+        return "Never"
+    now = datetime.now()
+    diff = now - timestamp
+    if diff.seconds < 60:
+        return "Just now"
+    elif diff.seconds < 3600:
+        return f"{diff.seconds // 60} minutes ago"
+    else:
+        return f"{diff.seconds // 3600} hours ago"
+
+@st.cache_resource(show_spinner=False)
+def get_body_cache():
+    """Open the on-disk cache that keeps email bodies out of session state."""
+    return BodyCache()
+
+def set_processed_emails(emails):
+    """Replace the shown emails with a compact, indexed store built from them.
+
+    Bodies move to the on-disk body cache, so the session only keeps the
+    fields needed to render the list.
+    """
+    st.session_state.email_store = EmailStore(emails, get_body_cache())
+
+def render_stats(total, categories):
+    """Render the overview statistics cards from per-category counts."""
+    # Display statistics
+    st.markdown("### Email Overview")
+
+    # Create columns based on the number of stats_data items
+    stats_data = [("Total", total)] + list(categories.items())
+    cols = st.columns(len(stats_data))
+
+    for i, (label, count) in enumerate(stats_data):
+        with cols[i]:
+            st.markdown(f"""
+            <div class="stats-card">
+                <div class="stats-number">{count}</div>
+                <div class="stats-label">{label} Emails</div>
+            </div>
+            """, unsafe_allow_html=True)
+
+def render_email_card(email, similar=0):
+    """Render a single analyzed EmailRecord, noting how many similar ones it stands for."""
+    priority_class = f"priority-{email.urgency.value.lower()}"
+    similar_html = (f"<span>+{similar} similar</span>" if similar else "")
+
+    email_html = f"""
+    <div class="email-card">
+        <div class="email-content">
+            <div class="email-sender">{safe_html(email.sender)}</div>
+            <div class="email-subject">{safe_html(email.subject)}</div>
+            <div class="email-summary">{safe_html(email.summary)}</div>
+            <div class="email-meta">
+                <span>Category: {safe_html(email.category.value)}</span>
+                <span>Tokens saved: {email.tokens_saved}</span>
+                {similar_html}
+                <span class="priority-tag {priority_class}">
+                    {safe_html(email.urgency.value)}
+                </span>
+            </div>
+        </div>
+    </div>
+    """
+    st.markdown(email_html, unsafe_allow_html=True)
+
+def render_pending_emails(metadata):
+    """Show the fetched headers of emails that are still being analyzed."""
+    if not metadata:
+        return
+    st.markdown(f"#### Waiting for analysis ({len(metadata)})")
+    for email in metadata:
+        st.markdown(f"""
+        <div class="email-card">
+            <div class="email-content">
+                <div class="email-sender">{safe_html(email['sender'])}</div>
+                <div class="email-subject">{safe_html(email['subject'])}</div>
+                <div class="email-summary">{safe_html(email['snippet'])}</div>
+            </div>
+        </div>
+        """, unsafe_allow_html=True)
+
+@st.cache_resource(show_spinner=False)
+def get_results_store():
+    """Open the results store shared with the background triage daemon."""
+    return ResultsStore()
+
+def apply_run_stats(stats):
+    """Keep the stats of the latest run for the status captions and panel."""
+    st.session_state.cache_stats = stats.get('cache')
+    st.session_state.fast_path_stats = stats.get('fast_path')
+    st.session_state.performance = stats.get('performance')
+
+def build_query(search_period, query_base):
+    """Return the Gmail search query for the sidebar settings."""
+    return f"is:unread newer_than:{search_period} {query_base}"
+
+def current_query():
+    """Return the query of the sidebar settings, before they are rendered."""
+    return build_query(st.session_state.get('search_period', DEFAULT_PERIOD),
+                       st.session_state.get('query_base', DEFAULT_QUERY_BASE))
+
+def snapshot_is_newer(store, query):
+    """Return True if the store holds newer results for ``query``.
+
+    The daemon may triage another query than the sidebar's; its results
+    and historyId don't apply to this session then.
+    """
+    updated_at = store.updated_at()
+    return bool(updated_at and updated_at > st.session_state.snapshot_time
+                and store.query() == query)
+
+def load_snapshot(store, query):
+    """Load the stored results for ``query`` if they are newer than shown."""
+    if not snapshot_is_newer(store, query):
+        return
+    snapshot = store.load()
+    if snapshot['query'] != query:
+        return  # Replaced by another query's results meanwhile
+    set_processed_emails(snapshot['emails'])
+    st.session_state.history_id = snapshot['history_id']
+    st.session_state.sync_query = snapshot['query']
+    st.session_state.last_refresh = datetime.fromtimestamp(snapshot['updated_at'])
+    st.session_state.snapshot_time = snapshot['updated_at']
+    st.session_state.snapshot_source = snapshot['source']
+    apply_run_stats(snapshot['stats'])
+
+def watch_store(store):
+    """Rerun the app when the background daemon stores newer results."""
+    if snapshot_is_newer(store, current_query()):
+        st.rerun()
+
+@st.cache_resource(show_spinner="Loading the embedding model...")
+def get_embedder():
+    """Load the email index's embedding model once for all sessions."""
+    return default_embedder()
+
+def get_processor(api_resource, fused_triage, max_concurrency):
+    """Return this session's EmailProcessor, building it only when needed.
+
+    The processor (with its Groq client, chains and Gmail tools) is reused
+    across reruns for as long as the Gmail resource stays the same; the
+    resource itself is only rebuilt after a new authorization, not when
+    another process refreshes the token.
+    """
+    key = id(api_resource)
+    if st.session_state.get('processor_key') != key:
+        st.session_state.processor = EmailProcessor(api_resource,
+                                                    embedder=get_embedder())
+        st.session_state.draft_queue = DraftJobQueue(st.session_state.processor)
+        st.session_state.processor_key = key
+    processor = st.session_state.processor
+    processor.fused_triage = fused_triage
+    processor.max_concurrency = max_concurrency
+    return processor
+
+def stop_processing():
+    """Cancel the running refresh, keeping the emails analyzed so far.
+
+    Clicking the button interrupts the running script, which also stops
+    the processor's generator; this callback then shows the partial result.
+    """
+    run = st.session_state.get('partial_run')
+    if not run:
+        return
+    processor = st.session_state.processor
+    processor.cancel()
+    order = run['order']
+    set_processed_emails(sorted(run['emails'], key=lambda e: order[e['id']]))
+    # Not every email was analyzed, so the next refresh must search again
+    st.session_state.history_id = None
+    st.session_state.partial_run = None
+    processor.finish_run()
+    apply_run_stats(processor.run_stats())
+    st.session_state.last_refresh = datetime.now()
+
+def stream_processing(processor, metadata):
+    """Analyze emails, rendering each card and the stats as results arrive.
+
+    Urgent-looking emails are analyzed first. The Stop button ends the run
+    early and keeps what was analyzed so far.
+    """
+    emails = []
+    # Gmail's ordering, for the final list
+    order = {m['id']: i for i, m in enumerate(metadata)}
+    st.session_state.partial_run = {'emails': emails, 'order': order}
+
+    live = st.empty()
+    with live.container():
+        st.button("⏹ Stop", key="stop_processing", on_click=stop_processing)
+        progress = st.progress(0.0, text=f"Analyzing {len(metadata)} emails...")
+        stats = st.empty()
+        cards = st.container()
+        pending = st.empty()
+        with pending.container():
+            render_pending_emails(metadata)
+
+    categories = {category.value: 0 for category in Category}
+    for completed, total, email in processor.iter_process_emails(metadata=metadata):
+        emails.append(email)
+        record = EmailRecord.from_dict(email)
+        categories[record.category.value] += 1
+        progress.progress(completed / total,
+                          text=f"Analyzed {completed} of {total} emails")
+        with stats.container():
+            render_stats(len(emails), categories)
+        with cards:
+            render_email_card(record)
+        done = {e['id'] for e in emails}
+        with pending.container():
+            render_pending_emails([m for m in metadata if m['id'] not in done])
+    live.empty()
+    st.session_state.partial_run = None
+    return sorted(emails, key=lambda e: order[e['id']])
+
+def render_draft_jobs(draft_queue):
+    """Show the state of background draft jobs; polled while any are active."""
+    jobs = draft_queue.jobs()
+    if not jobs:
+        return
+    st.markdown("### Draft Replies")
+    icons = {PENDING: "⏳", RUNNING: "✍️", DONE: "✅", FAILED: "❌"}
+    for job in jobs.values():
+        line = f"{icons[job['status']]} **{job['subject']}** — {job['status']}"
+        if job['status'] == FAILED:
+            line += f": {job['message']}"
+        st.markdown(line)
+    if not draft_queue.active() and st.button("Clear finished drafts"):
+        draft_queue.clear_finished()
+        st.rerun()
+
+def bulk_selection(email_store):
+    """Return the records matched by the bulk action filters."""
+    view = st.session_state.get('bulk_category', "Promotional")
+    urgencies = st.session_state.get('bulk_urgencies') or None
+    return email_store.select(category_of(view), urgencies)
+
+def run_bulk_action(action):
+    """Apply a bulk action to the selected emails (button callback).
+
+    Label changes go through Gmail's batchModify, up to 1000 emails per
+    call; drafts are queued on the background draft queue, whose bodies
+    are fetched in batches. The outcome is shown on the next run.
+    """
+    email_store = st.session_state.email_store
+    records = bulk_selection(email_store)
+    if not records:
+        return
+    processor = st.session_state.processor
+    ids = [record.id for record in records]
+    try:
+        if action == "draft":
+            queued = st.session_state.draft_queue.submit_many(
+                email_store.draft_email(email_id) for email_id in ids)
+            st.session_state.bulk_result = ("success",
+                                            f"Queued {queued} draft replies.")
+            return
+        if action == "label":
+            label = st.session_state.get('bulk_label', "").strip()
+            if not label:
+                st.session_state.bulk_result = ("warning", "Enter a label name.")
+                return
+            calls = processor.modify_emails(ids, add_labels=[label])
+            text = f"Labelled {len(ids)} emails “{label}”"
+        else:
+            _, done, add_labels, remove_labels = BULK_ACTIONS[action]
+            calls = processor.modify_emails(ids, add_labels, remove_labels)
+            # They no longer match the unread inbox search
+            removed = set(ids)
+            set_processed_emails([email for email in email_store.to_dicts()
+                                  if email['id'] not in removed])
+            st.session_state.snapshot_time = get_results_store().save(
+                st.session_state.email_store.to_dicts(),
+                history_id=st.session_state.history_id,
+                query=st.session_state.sync_query,
+                stats=processor.run_stats())
+            text = f"{done}: {len(ids)} emails"
+    except Exception as e:
+        st.session_state.bulk_result = ("error", f"Bulk action failed: {str(e)}")
+        return
+    st.session_state.bulk_result = (
+        "success", f"{text} in {calls} Gmail call{'s' if calls > 1 else ''}.")
+
+def render_bulk_actions(email_store):
+    """Offer label, archive, mark-read and draft actions on a filtered selection."""
+    with st.expander("⚡ Bulk actions"):
+        col1, col2 = st.columns(2)
+        col1.selectbox("Category", [view for view, _ in CATEGORY_VIEWS],
+                       index=3, key="bulk_category")
+        col2.multiselect("Urgency (any if empty)",
+                         [urgency.value for urgency in Urgency],
+                         key="bulk_urgencies")
+        selected = len(bulk_selection(email_store))
+        st.caption(f"{selected} email{'s' if selected != 1 else ''} selected")
+
+        cols = st.columns(len(BULK_ACTIONS) + 1)
+        for col, (action, (name, *_)) in zip(cols, BULK_ACTIONS.items()):
+            col.button(name, key=f"bulk_{action}", disabled=not selected,
+                       on_click=run_bulk_action, args=(action, ),
+                       use_container_width=True)
+        cols[-1].button("✍️ Generate drafts", key="bulk_draft",
+                        disabled=not selected, on_click=run_bulk_action,
+                        args=("draft", ), use_container_width=True)
+        col1, col2 = st.columns([3, 1])
+        col1.text_input("Label", key="bulk_label",
+                        placeholder="Gmail label to add, e.g. Receipts",
+                        label_visibility="collapsed")
+        col2.button("🏷️ Add label", key="bulk_label_button",
+                    disabled=not selected, on_click=run_bulk_action,
+                    args=("label", ), use_container_width=True)
+
+        result = st.session_state.pop('bulk_result', None)
+        if result:
+            getattr(st, result[0])(result[1])
+
+def render_search_results(results):
+    """List semantic search results with their similarity."""
+    for result in results:
+        st.markdown(f"**{safe_html(result['subject'])}** — "
+                    f"{safe_html(result['sender'])} · {result['category']}, "
+                    f"{result['urgency']} · {result['score']:.0%} match  \n"
+                    f"{safe_html(result['summary'])}")
+
+def render_search(index):
+    """Search all triaged mail by meaning, or by keywords without an
+    embedding model (runs as a fragment)."""
+    if index.semantic:
+        placeholder = "e.g. invoices waiting for payment"
+    else:
+        placeholder = "Keywords, e.g. invoice payment"
+    query = st.text_input("🔎 Search triaged emails",
+                          key="semantic_query",
+                          placeholder=placeholder)
+    if not index.semantic:
+        st.caption("Keyword matching only: install fastembed to search by meaning.")
+    if not query.strip():
+        return
+    started = time.perf_counter()
+    results = index.search(query, k=10)
+    search_ms = (time.perf_counter() - started) * 1000
+    st.caption(f"{len(results)} of {len(index)} indexed emails "
+               f"in {search_ms:.1f} ms")
+    render_search_results(results)
+
+def toggle_similar(email_id):
+    shown = st.session_state.show_similar
+    shown.symmetric_difference_update({email_id})
+
+def render_performance(performance, email_store):
+    """Show per-stage timings, token usage, cost and counters of the last refresh."""
+    with st.expander(f"⏱️ Performance ({performance['duration_s']:.2f} s)"):
+        stages = sorted(performance['stages'].items(),
+                        key=lambda item: item[1]['total_ms'],
+                        reverse=True)
+        # Snapshots saved before cost tracking have no cost_usd
+        cost = performance.get('cost_usd', {})
+        st.dataframe(
+            [{'Stage': stage, **stats, 'cost_usd': cost.get(stage)}
+             for stage, stats in stages],
+            hide_index=True,
+            use_container_width=True
+        )
+
+        tokens = performance['tokens']
+        counters = performance['counters']
+        col1, col2, col3, col4, col5 = st.columns(5)
+        col1.metric("Input tokens", f"{tokens.get('input_tokens', 0):,}")
+        col2.metric("Output tokens", f"{tokens.get('output_tokens', 0):,}")
+        col3.metric("AI cost", f"${sum(cost.values()):.4f}")
+        col4.metric("Retries", counters.get('retries', 0))
+        col5.metric("Escalations", counters.get('escalations', 0))
+        if counters:
+            st.caption(" · ".join(f"{name}: {value}"
+                                  for name, value in sorted(counters.items())))
+
+        subjects = {email.id: email.subject for email in email_store}
+        per_email = [
+            {'Subject': subjects.get(email_id, email_id),
+             'Total ms': round(sum(stage_ms.values()), 1),
+             **stage_ms}
+            for email_id, stage_ms in performance['per_email'].items()
+        ]
+        if per_email:
+            st.markdown("**Per email**")
+            st.dataframe(
+                sorted(per_email, key=lambda row: row['Total ms'], reverse=True),
+                hide_index=True,
+                use_container_width=True
+            )
+
+def category_of(view):
+    """Return the category shown by a view; None for "All"."""
+    return None if view == "All" else view
+
+def change_page(view, delta):
+    """Move the given category view to the previous or next page."""
+    st.session_state[f"page_{view}"] = st.session_state.get(f"page_{view}", 1) + delta
+
+def stream_draft(processor, email, slot):
+    """Write a draft reply into ``slot`` as it is generated, then offer it for review."""
+    try:
+        with slot.container():
+            text = st.write_stream(processor.stream_draft_reply(email))
+    except Exception as e:
+        slot.error(f"Error generating draft: {str(e)}")
+        return
+    st.session_state.draft_reviews[email['id']] = text
+    render_draft_review(processor, email, text, slot)
+
+def render_draft_review(processor, email, text, slot):
+    """Let the user edit a streamed draft in ``slot`` before saving it to Gmail."""
+    with slot.container():
+        edited = st.text_area("Review the draft reply", value=text,
+                              key=f"review_{email['id']}", height=250)
+        col1, col2 = st.columns(2)
+        save = col1.button("💾 Save Draft to Gmail", key=f"save_{email['id']}")
+        discard = col2.button("Discard", key=f"discard_{email['id']}")
+    if save:
+        try:
+            processor.save_draft(email, edited)
+        except Exception as e:
+            st.error(f"Error creating draft: {str(e)}")
+            return
+        del st.session_state.draft_reviews[email['id']]
+        st.session_state.saved_drafts.add(email['id'])
+        slot.caption("Draft reply: saved to Gmail")
+    elif discard:
+        del st.session_state.draft_reviews[email['id']]
+        slot.empty()
+
+def render_email_list(email_store, draft_queue, processor, stream_drafts):
+    """Render the selected category a page at a time.
+
+    Only the visible page is rendered and other categories are not rendered
+    at all, so a rerun costs the same however many emails were fetched.
+    Runs as a fragment: switching category or page reruns only this list.
+    Each indexed email can list its most similar past emails. With
+    ``stream_drafts`` a draft reply is written onto the page as it is
+    generated and only saved to Gmail after review; otherwise drafts are
+    generated and saved in the background.
+    """
+    labels = {view: f"{icon} {view} ({email_store.count(category_of(view))})"
+              for view, icon in CATEGORY_VIEWS}
+    view = st.segmented_control(
+        "Category",
+        options=list(labels),
+        format_func=labels.get,
+        default="All",
+        key="category_view",
+        label_visibility="collapsed"
+    ) or "All"
+
+    cards = email_store.cards(category_of(view))
+    if not cards:
+        st.info("No emails in this category.")
+        return
+
+    page_size = st.session_state.get('page_size', PAGE_SIZES[0])
+    page_count = math.ceil(len(cards) / page_size)
+    page = min(max(st.session_state.get(f"page_{view}", 1), 1), page_count)
+    st.session_state[f"page_{view}"] = page
+    start = (page - 1) * page_size
+
+    for card in cards[start:start + page_size]:
+        record = card[0]
+        render_email_card(record, similar=len(card) - 1)
+        if len(card) > 1:
+            similar = len(card) - 1
+            with st.expander(f"Show {similar} similar email{'s' if similar > 1 else ''}"):
+                for other in card[1:]:
+                    st.markdown(f"**{safe_html(other.subject)}** — "
+                                f"{safe_html(other.sender)}")
+
+        index = processor.embedding_index
+        if index is not None and record.id in index:
+            st.button("🔍 Similar emails", key=f"similar_{record.id}",
+                      on_click=toggle_similar, args=(record.id, ))
+            if record.id in st.session_state.show_similar:
+                render_search_results(index.similar(record.id, k=5))
+
+        # Gmail message IDs are unique, unlike subject and sender
+        unique_key = f"draft_{record.id}"
+        draft_status = draft_queue.status(record.id)
+        review = st.session_state.draft_reviews.get(record.id)
+        slot = st.empty()  # Holds the button, then the streamed text and review
+        if record.id in st.session_state.saved_drafts:
+            slot.caption("Draft reply: saved to Gmail")
+        elif review is not None:
+            render_draft_review(processor, record.to_dict(), review, slot)
+        elif draft_status in (PENDING, RUNNING, DONE):
+            slot.caption(f"Draft reply: {draft_status}")
+        elif slot.button(f"✍️ Generate Draft Reply for: {record.subject}", key=unique_key):
+            # The body is only read back from the body cache (or Gmail) now
+            email = email_store.draft_email(record.id)
+            if stream_drafts:
+                stream_draft(processor, email, slot)
+            else:
+                draft_queue.submit(email)  # Runs in the background; duplicates are ignored
+                st.rerun()
+
+    col1, col2, col3, col4 = st.columns([1, 2, 1, 1])
+    col1.button("◀ Previous", key=f"prev_{view}", disabled=page <= 1,
+                on_click=change_page, args=(view, -1))
+    col2.caption(f"Page {page} of {page_count} · cards {start + 1}–"
+                 f"{min(start + page_size, len(cards))} of {len(cards)}")
+    col3.button("Next ▶", key=f"next_{view}", disabled=page >= page_count,
+                on_click=change_page, args=(view, 1))
+    col4.selectbox("Per page", PAGE_SIZES, key="page_size",
+                   label_visibility="collapsed")
+
+def main():
+    if 'email_store' not in st.session_state:
+        set_processed_emails([])
+    if 'last_refresh' not in st.session_state:
+        st.session_state.last_refresh = None
+    if 'history_id' not in st.session_state:
+        st.session_state.history_id = None  # Gmail historyId of the last sync
+    if 'sync_query' not in st.session_state:
+        st.session_state.sync_query = None  # query of the shown results
+    if 'cache_stats' not in st.session_state:
+        st.session_state.cache_stats = None
+    if 'fast_path_stats' not in st.session_state:
+        st.session_state.fast_path_stats = None
+    if 'performance' not in st.session_state:
+        st.session_state.performance = None
+    if 'snapshot_time' not in st.session_state:
+        st.session_state.snapshot_time = 0.0  # updated_at of the shown results
+    if 'snapshot_source' not in st.session_state:
+        st.session_state.snapshot_source = None
+    if 'draft_reviews' not in st.session_state:
+        st.session_state.draft_reviews = {}  # email id -> streamed draft text
+    if 'saved_drafts' not in st.session_state:
+        st.session_state.saved_drafts = set()
+    if 'show_similar' not in st.session_state:
+        st.session_state.show_similar = set()  # ids with similar emails shown
+
+    # Show the latest stored results straight away, before touching Gmail
+    store = get_results_store()
+    load_snapshot(store, current_query())
+
+    st.title("📧 Email AI Agent")
+    st.markdown("Smart email management powered by AI")
+
+    # Initialize Gmail
+    started = time.perf_counter()
+    credentials, api_resource = initialize_gmail()
+    auth_ms = (time.perf_counter() - started) * 1000
+    if not credentials or not api_resource:
+        st.warning("Please complete Gmail authentication to continue.")
+        return
+
+    # Sidebar configuration
+    with st.sidebar:
+        st.header("Settings")
+        search_period = st.selectbox(
+            "Time Range",
+            PERIODS,
+            index=PERIODS.index(DEFAULT_PERIOD),
+            key="search_period",
+            format_func=lambda x: {
+                "1d": "Last 24 hours",
+                "2d": "Last 2 days",
+                "3d": "Last 3 days",
+                "7d": "Last week"
+            }[x]
+        )
+
+        max_results = st.slider(
+            "Number of Emails",
+            min_value=5,
+            max_value=500,
+            value=10,
+            step=5
+        )
+
+        query_base = st.text_input(
+            "Filter Query",
+            value=DEFAULT_QUERY_BASE,
+            key="query_base"
+        )
+
+        fused_triage = st.checkbox(
+            "Fused triage (single AI call per email)",
+            value=True,
+            help="Request category, urgency and summary together. "
+                 "Falls back to separate calls if the response can't be parsed."
+        )
+
+        incremental_sync = st.checkbox(
+            "Incremental sync",
+            value=True,
+            help="Only fetch emails that arrived or changed since the last refresh."
+        )
+
+        max_concurrency = st.slider(
+            "Parallel Requests",
+            min_value=1,
+            max_value=10,
+            value=4,
+            help="Number of emails analyzed at the same time."
+        )
+
+        stream_drafts = st.checkbox(
+            "Stream drafts (review before saving)",
+            value=True,
+            help="Show draft replies as they are written and save them to "
+                 "Gmail only after review. Off: drafts are generated and saved "
+                 "in the background."
+        )
+
+        started = time.perf_counter()
+        try:
+            processor = get_processor(api_resource, fused_triage, max_concurrency)
+        except ValueError as e:
+            st.error(str(e))
+            return
+        processor_ms = (time.perf_counter() - started) * 1000
+        st.caption(f"Rerun overhead: Gmail auth {auth_ms:.1f} ms, "
+                   f"processor {processor_ms:.1f} ms")
+
+    # Process emails button
+    col1, col2 = st.columns([3, 1])
+    with col1:
+        refresh = st.button("🔄 Process New Emails", use_container_width=True)
+    with col2:
+        status = st.empty()
+
+    if refresh:
+        query = build_query(search_period, query_base)
+        # A changed query invalidates the stored history position
+        history_id = (st.session_state.history_id
+                      if incremental_sync and st.session_state.sync_query == query
+                      else None)
+        if history_id:
+            with st.spinner("Syncing new emails..."):
+                result = processor.sync_emails(
+                    history_id=history_id,
+                    query=query,
+                    max_results=max_results,
+                    known_ids=[record.id for record in st.session_state.email_store]
+                )
+            if result:
+                if result.full_resync:
+                    set_processed_emails(result.emails)
+                else:
+                    set_processed_emails(merge_emails(
+                        st.session_state.email_store.to_dicts(),
+                        result.emails,
+                        result.removed_ids,
+                        result.matching_ids
+                    ))
+                st.session_state.history_id = result.history_id
+        else:
+            processor.start_run()
+            # Read the historyId before searching so the next incremental
+            # sync doesn't miss anything that arrives meanwhile
+            new_history_id = processor.current_history_id() if incremental_sync else None
+            # Render headers first; bodies are only fetched for emails
+            # that still need to be analyzed
+            metadata = processor.fetch_email_metadata(
+                query=query,
+                max_results=max_results
+            )
+            set_processed_emails(stream_processing(processor, metadata))
+            st.session_state.history_id = new_history_id
+            st.session_state.sync_query = query
+            processor.finish_run()
+        # The same failure can hit many emails; show each message once
+        for message in dict.fromkeys(processor.errors):
+            st.error(message)
+        for policy in (processor.llm_policy, processor.gmail_policy):
+            if policy.breaker.is_open:
+                st.warning(f"{policy.name} keeps failing; calls are paused "
+                           "for a while. Emails that failed will be retried on "
+                           "the next refresh.")
+        stats = processor.run_stats()
+        apply_run_stats(stats)
+        st.session_state.snapshot_time = store.save(
+            st.session_state.email_store.to_dicts(),
+            history_id=st.session_state.history_id,
+            query=st.session_state.sync_query,
+            stats=stats
+        )
+        st.session_state.snapshot_source = "app"
+        st.session_state.last_refresh = datetime.fromtimestamp(
+            st.session_state.snapshot_time)
+
+    with status.container():
+        st.caption(f"Last updated: {format_time_ago(st.session_state.last_refresh)}")
+        if st.session_state.snapshot_source == "daemon":
+            st.caption("Results from background triage")
+        if st.session_state.cache_stats:
+            stats = st.session_state.cache_stats
+            st.caption(f"Cache: {stats['hits']} hits / {stats['misses']} misses "
+                       f"({stats['entries']} stored)")
+        if st.session_state.fast_path_stats:
+            stats = st.session_state.fast_path_stats
+            agreement = ("n/a" if stats['agreement'] is None
+                         else f"{stats['agreement']:.0%}")
+            st.caption(f"Fast path: {stats['local']} settled locally, "
+                       f"{stats['llm']} sent to AI "
+                       f"({stats['skipped_rate']:.0%} fewer calls) · "
+                       f"agreement {agreement}")
+        if st.session_state.email_store.tokens_saved:
+            st.caption("Tokens saved by preprocessing: "
+                       f"{st.session_state.email_store.tokens_saved:,}")
+
+    if st.session_state.performance:
+        render_performance(st.session_state.performance,
+                           st.session_state.email_store)
+
+    # Past results stay searchable after the session that triaged them
+    if processor.embedding_index is not None and len(processor.embedding_index):
+        st.fragment(render_search)(processor.embedding_index)
+
+    # Display results
+    email_store = st.session_state.email_store
+    if len(email_store):
+        render_stats(len(email_store),
+                     {category.value: email_store.count(category)
+                      for category in Category})
+
+        render_bulk_actions(email_store)
+
+        draft_queue = st.session_state.draft_queue
+        st.fragment(render_email_list)(email_store, draft_queue,
+                                       processor, stream_drafts)
+
+        # Draft jobs run in the background; poll their state without
+        # blocking the rest of the page
+        st.fragment(render_draft_jobs,
+                    run_every=2 if draft_queue.active() else None)(draft_queue)
+
+    else:
+        st.info("👋 Welcome! Click 'Process New Emails' to start analyzing your inbox.")
+
+    # Pick up results written by the background triage daemon
+    st.fragment(watch_store, run_every=30)(store)
+
+if __name__ == "__main__":
     main()
\ No newline at end of file
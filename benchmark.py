@@ -0,0 +1,878 @@
+"""Offline benchmark for the triage pipeline.
+
+Runs EmailProcessor against a synthetic mailbox served by a fake Gmail
+resource and a stub chat model, so throughput, latency, token usage and
+memory can be compared between changes without Gmail or Groq access:
+
+    python benchmark.py --sizes 10 100 1000 --latency 0.05 --concurrency 8
+
+``--sync`` instead checks incremental syncs against a full search after
+new mail arrives and some is read, and ``--drafts`` times draft replies to
+every triaged email, queued in the background and streamed one by one.
+"""
+import argparse
+import asyncio
+import base64
+import json
+import os
+import random
+import re
+import shutil
+import statistics
+import tempfile
+import threading
+import time
+import tracemalloc
+import zlib
+from contextlib import nullcontext
+from email.header import Header
+from email.message import EmailMessage
+from email.utils import formataddr, format_datetime
+from datetime import datetime, timedelta, timezone
+from typing import Any, List, Optional
+
+from googleapiclient.discovery import Resource
+from googleapiclient.errors import HttpError
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.outputs import (ChatGeneration, ChatGenerationChunk,
+                                    ChatResult)
+from langchain_core.utils.function_calling import convert_to_openai_tool
+from pydantic import PrivateAttr
+
+from body_prep import estimate_tokens
+from draft_jobs import DraftJobQueue
+from email_processor import EmailProcessor, VALID_CATEGORIES, VALID_URGENCIES
+from results_store import merge_emails
+
+# ---------------------------------------------------------------------------
+# Synthetic mailbox
+# ---------------------------------------------------------------------------
+
+_WORK_LINES = [
+    "Can you review the Q3 budget before Friday's meeting?",
+    "The deployment to production failed, please take a look ASAP.",
+    "Attached are the notes from today's design review.",
+    "Please confirm your availability for the client call on Tuesday.",
+]
+_PERSONAL_LINES = [
+    "Are you free for dinner this weekend?",
+    "Here are the photos from the trip, hope you like them!",
+    "Happy birthday! Let's catch up soon.",
+]
+_PROMO_LINES = [
+    "Huge savings this week only: 50% off everything in store.",
+    "Our newsletter: ten tips to boost your productivity.",
+    "Your exclusive member offer expires tonight.",
+]
+_ENCODED_SUBJECTS = [
+    "Réunion d'équipe — ordre du jour", "Überprüfung des Angebots",
+    "会議の議事録", "Cotización 📈 actualizada"
+]
+_QUOTED_HISTORY = """
+
+On Mon, Jan 6, 2025 at 9:12 AM Someone <someone@example.com> wrote:
+> Thanks for the update.
+> Let me know if anything changes.
+> """ + "\n> ".join(["Earlier message line"] * 20)
+_SIGNATURE = """
+--
+Jane Doe | Senior Manager
+CONFIDENTIAL: This email and any attachments are intended solely for the
+addressee and may contain confidential information."""
+_FOOTER = """
+You are receiving this because you subscribed to our list.
+Unsubscribe: https://example-mailer.com/unsubscribe?id=0123456789abcdef0123
+View this email in your browser"""
+
+
+def _build_message(idx, rng, start):
+    kind = rng.choices(["work", "personal", "promo"], weights=[5, 2, 3])[0]
+    message = EmailMessage()
+    if kind == "work":
+        sender = formataddr(("Alex Manager", f"alex{idx % 7}@corp.example"))
+        lines = rng.sample(_WORK_LINES, 2)
+    elif kind == "personal":
+        sender = formataddr(("Sam Friend", f"sam{idx % 5}@mail.example"))
+        lines = rng.sample(_PERSONAL_LINES, 2)
+    else:
+        sender = formataddr(("Deals", "news@substack.com"))
+        lines = rng.sample(_PROMO_LINES, 2)
+        message["List-Unsubscribe"] = "<https://example-mailer.com/u>"
+        message["Precedence"] = "bulk"
+
+    if rng.random() < 0.2:
+        subject = Header(rng.choice(_ENCODED_SUBJECTS), "utf-8").encode()
+    else:
+        subject = f"{lines[0][:40]} #{idx}"
+    message["Subject"] = subject
+    message["From"] = sender
+    message["To"] = "me@example.com"
+    message["Date"] = format_datetime(start - timedelta(minutes=idx))
+    message["Message-ID"] = f"<m{idx:06d}@mail.example>"
+
+    text = "Hi,\n\n" + "\n\n".join(lines * rng.randint(1, 6))
+    if kind == "work":
+        text += _SIGNATURE + (_QUOTED_HISTORY if rng.random() < 0.5 else "")
+    if kind == "promo":
+        text += _FOOTER
+    message.set_content(text)
+    if rng.random() < 0.5:
+        paragraphs = "".join(f"<p>{line}</p>" for line in text.split("\n\n"))
+        message.add_alternative(
+            f"<html><body><table><tr><td>{paragraphs}</td></tr></table>"
+            "<img src='https://tracker.example/pixel.gif'></body></html>",
+            subtype="html")
+    if rng.random() < 0.1:
+        message.add_attachment(b"%PDF-1.4 fake", maintype="application",
+                               subtype="pdf", filename="report.pdf")
+    labels = ["UNREAD", "INBOX"]
+    labels.append("CATEGORY_PROMOTIONS" if kind == "promo" else
+                  "CATEGORY_PERSONAL")
+    if "ASAP" in text:
+        labels.append("IMPORTANT")
+    return message, labels, lines[0][:100]
+
+
+def generate_mailbox(size, seed=0):
+    """Return ``size`` synthetic Gmail messages in ``format=raw`` shape."""
+    rng = random.Random(seed)
+    start = datetime(2025, 1, 6, 12, 0, tzinfo=timezone.utc)
+    messages = []
+    for idx in range(size):
+        message, labels, snippet = _build_message(idx, rng, start)
+        thread = idx if rng.random() < 0.7 else rng.randrange(max(1, idx + 1))
+        messages.append({
+            "id": f"m{idx:06d}",
+            "threadId": f"t{thread:06d}",
+            "labelIds": labels,
+            "snippet": snippet,
+            "raw": base64.urlsafe_b64encode(message.as_bytes()).decode(),
+            "headers": [{"name": k, "value": str(v)}
+                        for k, v in message.items()],
+        })
+    return messages
+
+
+# ---------------------------------------------------------------------------
+# Fake Gmail API resource
+# ---------------------------------------------------------------------------
+
+
+class _FakeResponse(dict):
+    """Minimal httplib2-style response for HttpError."""
+
+    def __init__(self, status):
+        super().__init__(status=str(status))
+        self.status = status
+        self.reason = "Not Found" if status == 404 else "Error"
+
+
+class FakeRequest:
+    """Stands in for googleapiclient's HttpRequest."""
+
+    def __init__(self, resource, func):
+        self._resource = resource
+        self._func = func
+
+    def execute(self, **kwargs):
+        self._resource._tick()
+        return self._func()
+
+
+class FakeBatch:
+    """Stands in for BatchHttpRequest; one round-trip for all calls."""
+
+    def __init__(self, resource, callback):
+        self._resource = resource
+        self._callback = callback
+        self._requests = []
+
+    def add(self, request, callback=None, request_id=None):
+        self._requests.append((request, callback or self._callback,
+                               request_id or str(len(self._requests))))
+
+    def execute(self, **kwargs):
+        self._resource._tick()
+        for request, callback, request_id in self._requests:
+            try:
+                response, error = request._func(), None
+            except HttpError as e:
+                response, error = None, e
+            callback(request_id, response, error)
+
+
+class _Namespace:
+
+    def __init__(self, **methods):
+        self.__dict__.update(methods)
+
+
+class FakeGmailResource(Resource):
+    """In-memory Gmail API covering the calls EmailProcessor makes.
+
+    Supports messages.list/get/batchModify (raw and metadata), batch
+    requests, getProfile, history.list, labels.list/create and
+    drafts.create. ``latency`` is added to
+    every HTTP round-trip (a batch counts as one).
+    """
+
+    def __init__(self, messages, latency=0.0):
+        # Deliberately skip Resource.__init__: no discovery document needed
+        self._messages = {m["id"]: m for m in messages}
+        self._order = [m["id"] for m in messages]
+        self._history = []
+        self._history_id = 1000
+        self._lock = threading.Lock()
+        self.latency = latency
+        self.requests = 0
+        self.drafts = []
+        self.labels = {}  # user label name -> ID
+
+    def _tick(self):
+        with self._lock:
+            self.requests += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _not_found(self, message_id):
+        return HttpError(_FakeResponse(404), f"{message_id} not found".encode())
+
+    # -- mutation helpers for incremental-sync scenarios ---------------------
+
+    def add_message(self, message):
+        """Deliver a new message and record a messageAdded history event."""
+        with self._lock:
+            self._messages[message["id"]] = message
+            self._order.insert(0, message["id"])
+            self._history_id += 1
+            self._history.append({
+                "id": str(self._history_id),
+                "messagesAdded": [{
+                    "message": {
+                        "id": message["id"],
+                        "labelIds": message["labelIds"]
+                    }
+                }]
+            })
+
+    def mark_read(self, message_id):
+        """Remove UNREAD and record a labelRemoved history event."""
+        with self._lock:
+            labels = self._messages[message_id]["labelIds"]
+            if "UNREAD" in labels:
+                labels.remove("UNREAD")
+            self._history_id += 1
+            self._history.append({
+                "id": str(self._history_id),
+                "labelsRemoved": [{
+                    "message": {"id": message_id},
+                    "labelIds": ["UNREAD"]
+                }]
+            })
+
+    # -- API surface ---------------------------------------------------------
+
+    def new_batch_http_request(self, callback=None):
+        return FakeBatch(self, callback)
+
+    def users(self):
+        return _Namespace(messages=self._messages_api,
+                          history=self._history_api,
+                          drafts=self._drafts_api,
+                          labels=self._labels_api,
+                          getProfile=self._get_profile)
+
+    def _get_profile(self, userId="me"):
+        return FakeRequest(
+            self, lambda: {
+                "emailAddress": "me@example.com",
+                "historyId": str(self._history_id)
+            })
+
+    def _messages_api(self):
+        return _Namespace(list=self._list,
+                          get=self._get,
+                          batchModify=self._batch_modify)
+
+    def _batch_modify(self, userId="me", body=None):
+
+        def run():
+            with self._lock:
+                add, remove = body["addLabelIds"], body["removeLabelIds"]
+                for message_id in body["ids"]:
+                    labels = self._messages[message_id]["labelIds"]
+                    labels[:] = [l for l in labels if l not in remove]
+                    labels.extend(l for l in add if l not in labels)
+                self._history_id += 1
+                message_refs = [{"id": i} for i in body["ids"]]
+                self._history.append({
+                    "id": str(self._history_id),
+                    "labelsAdded": [{"message": m, "labelIds": add}
+                                    for m in message_refs if add],
+                    "labelsRemoved": [{"message": m, "labelIds": remove}
+                                      for m in message_refs if remove]
+                })
+            return {}
+
+        return FakeRequest(self, run)
+
+    def _labels_api(self):
+        system = ["INBOX", "UNREAD", "SPAM", "TRASH", "STARRED", "IMPORTANT"]
+
+        def list_labels(userId="me"):
+            return FakeRequest(
+                self, lambda: {
+                    "labels": [{"id": l, "name": l} for l in system] +
+                    [{"id": i, "name": n} for n, i in self.labels.items()]
+                })
+
+        def create(userId="me", body=None):
+
+            def run():
+                with self._lock:
+                    label_id = self.labels.setdefault(
+                        body["name"], f"Label_{len(self.labels) + 1}")
+                return {"id": label_id, "name": body["name"]}
+
+            return FakeRequest(self, run)
+
+        return _Namespace(list=list_labels, create=create)
+
+    def _matches(self, message, query):
+        """Match the is:unread, category: and from: terms of a Gmail query."""
+        labels = message["labelIds"]
+        sender = next((h["value"] for h in message["headers"]
+                       if h["name"].lower() == "from"), "").lower()
+        for term in query.lower().split():
+            name, _, value = term.partition(":")
+            if term == "is:unread" and "UNREAD" not in labels:
+                return False
+            if name == "category" and value and (
+                    f"CATEGORY_{'PERSONAL' if value == 'primary' else value.upper()}"
+                    not in labels):
+                return False
+            if name == "from" and value not in sender:
+                return False
+        return True
+
+    def _list(self, userId="me", q="", maxResults=100, pageToken=None, **_):
+
+        def run():
+            ids = [
+                i for i in self._order if self._matches(self._messages[i], q)
+            ]
+            start = int(pageToken or 0)
+            page = ids[start:start + maxResults]
+            response = {"messages": [{"id": i} for i in page]}
+            if start + maxResults < len(ids):
+                response["nextPageToken"] = str(start + maxResults)
+            return response
+
+        return FakeRequest(self, run)
+
+    def _get(self, userId="me", id=None, format="full", metadataHeaders=None,
+             **_):
+
+        def run():
+            message = self._messages.get(id)
+            if message is None:
+                raise self._not_found(id)
+            response = {
+                "id": message["id"],
+                "threadId": message["threadId"],
+                "labelIds": list(message["labelIds"]),
+                "snippet": message["snippet"],
+                "historyId": str(self._history_id),
+            }
+            if format == "raw":
+                response["raw"] = message["raw"]
+            else:
+                wanted = {h.lower() for h in metadataHeaders or []}
+                response["payload"] = {
+                    "headers": [
+                        h for h in message["headers"]
+                        if not wanted or h["name"].lower() in wanted
+                    ]
+                }
+            return response
+
+        return FakeRequest(self, run)
+
+    def _history_api(self):
+
+        def list_history(userId="me", startHistoryId=None, pageToken=None,
+                         **_):
+
+            def run():
+                start = int(startHistoryId)
+                if start < 1000:
+                    raise self._not_found(startHistoryId)
+                return {
+                    "history": [
+                        h for h in self._history if int(h["id"]) > start
+                    ],
+                    "historyId": str(self._history_id)
+                }
+
+            return FakeRequest(self, run)
+
+        return _Namespace(list=list_history)
+
+    def _drafts_api(self):
+
+        def create(userId="me", body=None):
+
+            def run():
+                with self._lock:
+                    self.drafts.append(body)
+                    return {"id": f"d{len(self.drafts)}", "message": body}
+
+            return FakeRequest(self, run)
+
+        return _Namespace(create=create)
+
+
+# ---------------------------------------------------------------------------
+# Stub chat model
+# ---------------------------------------------------------------------------
+
+
+class StubLLMError(Exception):
+    """Injected failure from the stub chat model."""
+
+    def __init__(self, message, status_code):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class StubChatModel(BaseChatModel):
+    """Deterministic chat model with configurable latency and failures.
+
+    Answers the triage, categorization, urgency, summary and draft prompts
+    with plausible output, supports tool binding for structured output and
+    streaming, and counts the tokens it was sent.
+    """
+
+    model_name: str = "stub"
+    latency: float = 0.05
+    error_rate: float = 0.0
+    rate_limit_rate: float = 0.0
+    seed: int = 0
+    _rng: Any = PrivateAttr(default=None)
+    _lock: Any = PrivateAttr(default_factory=threading.Lock)
+    _usage: dict = PrivateAttr(default_factory=lambda: {
+        "calls": 0,
+        "input_tokens": 0,
+        "output_tokens": 0,
+        "errors": 0
+    })
+
+    def model_post_init(self, __context):
+        self._rng = random.Random(self.seed)
+
+    @property
+    def _llm_type(self):
+        return "stub-chat"
+
+    @property
+    def usage(self):
+        with self._lock:
+            return dict(self._usage)
+
+    def reset_usage(self):
+        with self._lock:
+            for key in self._usage:
+                self._usage[key] = 0
+
+    def bind_tools(self, tools, **kwargs):
+        return self.bind(tools=[convert_to_openai_tool(t) for t in tools],
+                         **kwargs)
+
+    def _respond(self, messages, tools):
+        system = str(messages[0].content) if messages else ""
+        content = str(messages[-1].content)
+        with self._lock:
+            roll = self._rng.random()
+        if roll < self.rate_limit_rate:
+            error = StubLLMError("429 rate limit exceeded", 429)
+        elif roll < self.rate_limit_rate + self.error_rate:
+            error = StubLLMError("500 stub failure", 500)
+        else:
+            error = None
+
+        input_tokens = sum(estimate_tokens(str(m.content)) for m in messages)
+        with self._lock:
+            self._usage["calls"] += 1
+            self._usage["input_tokens"] += input_tokens
+            if error:
+                self._usage["errors"] += 1
+        if error:
+            raise error
+
+        digest = zlib.crc32(content.encode())
+        category = VALID_CATEGORIES[digest % len(VALID_CATEGORIES)]
+        # Only "ASAP" mail is Urgent, so the benchmark can time urgent mail
+        urgency = ("Urgent" if "asap" in content.lower() else
+                   VALID_URGENCIES[1 + (digest >> 4) % 3])
+        summary = " ".join(content.split()[:12]) or "Empty email"
+        tool_calls = []
+        if tools:
+            text = ""
+            tool_calls = [{
+                "name": tools[0]["function"]["name"],
+                "args": {
+                    "category": category,
+                    "urgency": urgency,
+                    "summary": summary
+                },
+                "id": f"call_{digest}"
+            }]
+        elif "categorizes emails" in system:
+            text = category
+        elif "urgency" in system:
+            text = f"[{urgency}]"  # The format the urgency prompt asks for
+        elif "summary" in system:
+            text = summary
+        else:
+            text = ("Hi,\n\nThank you for your email. " * 20 +
+                    "\n\nBest regards,\nMe")
+
+        output_tokens = estimate_tokens(text) + (20 if tool_calls else 0)
+        with self._lock:
+            self._usage["output_tokens"] += output_tokens
+        message = AIMessage(content=text,
+                            tool_calls=tool_calls,
+                            usage_metadata={
+                                "input_tokens": input_tokens,
+                                "output_tokens": output_tokens,
+                                "total_tokens": input_tokens + output_tokens
+                            })
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _generate(self,
+                  messages: List[Any],
+                  stop: Optional[List[str]] = None,
+                  run_manager=None,
+                  **kwargs):
+        time.sleep(self.latency)
+        return self._respond(messages, kwargs.get("tools"))
+
+    async def _agenerate(self,
+                         messages: List[Any],
+                         stop: Optional[List[str]] = None,
+                         run_manager=None,
+                         **kwargs):
+        await asyncio.sleep(self.latency)
+        return self._respond(messages, kwargs.get("tools"))
+
+    def _stream(self,
+                messages: List[Any],
+                stop: Optional[List[str]] = None,
+                run_manager=None,
+                **kwargs):
+        # Spread the latency over word-sized chunks, like a real stream
+        message = self._respond(messages, kwargs.get("tools")).generations[0].message
+        words = re.findall(r"\S+\s*", message.content) or [""]
+        for idx, word in enumerate(words):
+            time.sleep(self.latency / len(words))
+            usage = message.usage_metadata if idx == len(words) - 1 else None
+            yield ChatGenerationChunk(
+                message=AIMessageChunk(content=word, usage_metadata=usage))
+
+
+# ---------------------------------------------------------------------------
+# Benchmark runner
+# ---------------------------------------------------------------------------
+
+
+class TimedEmailProcessor(EmailProcessor):
+    """EmailProcessor that records how long each email's triage took.
+
+    Also records when each Urgent email finished, relative to the start of
+    the run.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.latencies = []
+        self.urgent_done = []
+
+    def start_run(self):
+        super().start_run()
+        self.run_started = time.perf_counter()
+
+    async def _aprocess_result(self, result, semaphore):
+        # Time the work itself, not the wait for a free worker slot
+        async with semaphore:
+            started = time.perf_counter()
+            email = await super()._aprocess_result(result, nullcontext())
+            self.latencies.append(time.perf_counter() - started)
+        if email and email['urgency'] == "Urgent":
+            self.urgent_done.append(time.perf_counter() - self.run_started)
+        return email
+
+
+def _percentile(values, percent):
+    if not values:
+        return "-"  # Every email came from the cache
+    if len(values) == 1:
+        return round(values[0], 1)
+    return round(
+        statistics.quantiles(values, n=100, method="inclusive")[percent - 1],
+        1)
+
+
+def _run_once(size, args, cache_path, trace_memory):
+    resource = FakeGmailResource(generate_mailbox(size, seed=args.seed),
+                                 latency=args.gmail_latency)
+    llm = StubChatModel(latency=args.latency,
+                        error_rate=args.error_rate,
+                        rate_limit_rate=args.rate_limit_rate,
+                        seed=args.seed)
+    processor = TimedEmailProcessor(resource,
+                                    fused_triage=not args.separate_chains,
+                                    max_concurrency=args.concurrency,
+                                    requests_per_second=args.rps,
+                                    cache_path=cache_path,
+                                    fast_path_model=None,
+                                    llm=llm,
+                                    metrics_path=None,
+                                    prioritize=not args.no_priority,
+                                    sender_history_path=None,
+                                    index_path=None)
+
+    if trace_memory:
+        tracemalloc.start()
+    started = time.perf_counter()
+    emails = processor.process_emails(query="is:unread", max_results=size)
+    elapsed = time.perf_counter() - started
+    peak = None
+    if trace_memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return emails, elapsed, peak, processor, llm, resource
+
+
+def run_benchmark(size, args, cache_path=None):
+    """Triage a synthetic mailbox of ``size`` emails; returns a result dict.
+
+    tracemalloc slows Python down considerably, so peak memory is measured
+    in a second, untimed pass against an identical copy of the cache.
+    """
+    peak = None
+    with tempfile.TemporaryDirectory() as tmp:
+        memory_cache = None
+        if cache_path and os.path.exists(cache_path):
+            memory_cache = shutil.copy(cache_path, tmp)
+        elif cache_path:
+            memory_cache = os.path.join(tmp, "triage_cache.db")
+
+        emails, elapsed, _, processor, llm, resource = _run_once(
+            size, args, cache_path, trace_memory=False)
+        if not args.no_memory:
+            peak = _run_once(size, args, memory_cache, trace_memory=True)[2]
+
+    usage = llm.usage
+    latencies = [latency * 1000 for latency in processor.latencies]
+    urgent_done = [seconds * 1000 for seconds in processor.urgent_done]
+    return {
+        "size": size,
+        "processed": len(emails),
+        "seconds": round(elapsed, 3),
+        "emails_per_second": round(len(emails) / elapsed, 2) if elapsed else 0,
+        "p50_ms": _percentile(latencies, 50),
+        "p95_ms": _percentile(latencies, 95),
+        # Time until the first and the last Urgent email were triaged
+        "first_urgent_ms": round(min(urgent_done), 1) if urgent_done else "-",
+        "all_urgent_ms": round(max(urgent_done), 1) if urgent_done else "-",
+        "llm_calls": usage["calls"],
+        "llm_errors": usage["errors"],
+        "input_tokens": usage["input_tokens"],
+        "output_tokens": usage["output_tokens"],
+        "gmail_requests": resource.requests,
+        "peak_mb": round(peak / 2**20, 2) if peak is not None else "-",
+    }
+
+
+def run_sync_scenario(size, args):
+    """Sync incrementally after mail arrives and is read; returns a result dict.
+
+    A full sync of the primary unread mail is followed by new primary and
+    promotional mail and some primary mail being read. The merged result
+    of an incremental sync must equal a fresh full search.
+    """
+    query = "is:unread category:primary"
+    max_results = max(1, size // 2)
+    mailbox = generate_mailbox(size * 2, seed=args.seed)
+    resource = FakeGmailResource(mailbox[size:], latency=args.gmail_latency)
+    processor = EmailProcessor(resource,
+                               llm=StubChatModel(seed=args.seed),
+                               requests_per_second=args.rps,
+                               cache_path=None,
+                               fast_path_model=None,
+                               metrics_path=None,
+                               sender_history_path=None,
+                               index_path=None)
+    first = processor.sync_emails(query=query, max_results=max_results)
+
+    rng = random.Random(args.seed)
+    for message in reversed(mailbox[:size // 4]):
+        resource.add_message(message)
+    shown = [email['id'] for email in first.emails]
+    for message_id in rng.sample(shown, len(shown) // 4):
+        resource.mark_read(message_id)
+
+    requests = resource.requests
+    synced = processor.sync_emails(history_id=first.history_id,
+                                   query=query,
+                                   max_results=max_results,
+                                   known_ids=shown)
+    sync_requests = resource.requests - requests
+    merged = merge_emails(first.emails, synced.emails, synced.removed_ids,
+                          synced.matching_ids)
+    expected = resource.users().messages().list(
+        q=query, maxResults=max_results).execute()["messages"]
+    return {
+        "size": size,
+        "max_results": max_results,
+        "triaged": len(synced.emails),
+        "removed": len(synced.removed_ids),
+        "merged": len(merged),
+        "gmail_requests": sync_requests,
+        "matches_full_search": [email['id'] for email in merged
+                                ] == [message["id"] for message in expected],
+    }
+
+
+def run_draft_scenario(size, args, mode):
+    """Draft replies to a triaged mailbox of ``size``; returns a result dict.
+
+    ``mode`` "queued" runs every draft through DraftJobQueue, as the bulk
+    action does; "streamed" streams and saves them one at a time, as the
+    draft editor does, and also reports the time to the first token.
+    """
+    resource = FakeGmailResource(generate_mailbox(size, seed=args.seed),
+                                 latency=args.gmail_latency)
+    llm = StubChatModel(latency=args.latency,
+                        error_rate=args.error_rate,
+                        rate_limit_rate=args.rate_limit_rate,
+                        seed=args.seed)
+    processor = EmailProcessor(resource,
+                               llm=llm,
+                               max_concurrency=args.concurrency,
+                               requests_per_second=args.rps,
+                               cache_path=None,
+                               fast_path_model=None,
+                               metrics_path=None,
+                               sender_history_path=None,
+                               index_path=None)
+    emails = processor.process_emails(query="is:unread", max_results=size)
+    processor.start_run()
+    llm.reset_usage()
+    requests = resource.requests
+
+    started = time.perf_counter()
+    failed = 0
+    if mode == "queued":
+        queue = DraftJobQueue(processor, max_workers=args.concurrency)
+        queue.submit_many(emails)
+        while queue.active():
+            time.sleep(0.005)
+        failed = sum(job['status'] != "done" for job in queue.jobs().values())
+    else:
+        for email in emails:
+            try:
+                text = "".join(processor.stream_draft_reply(email))
+                processor.save_draft(email, text)
+            except Exception:
+                failed += 1
+    elapsed = time.perf_counter() - started
+
+    spans = {"llm_draft": [], "llm_draft_first_token": []}
+    for span in processor.metrics.spans:
+        if span["stage"] in spans:
+            spans[span["stage"]].append(span["seconds"] * 1000)
+    first_token = spans["llm_draft_first_token"]
+    drafted = len(resource.drafts)
+    return {
+        "mode": mode,
+        "size": size,
+        "drafts": drafted,
+        "failed": failed,
+        "seconds": round(elapsed, 3),
+        "drafts_per_second": round(drafted / elapsed, 2) if elapsed else 0,
+        "p50_ms": _percentile(spans["llm_draft"], 50),
+        "p95_ms": _percentile(spans["llm_draft"], 95),
+        # Queued drafts show nothing until they are saved
+        "ttft_p50_ms": _percentile(first_token, 50),
+        "ttft_p95_ms": _percentile(first_token, 95),
+        "input_tokens": processor.metrics.tokens["llm_draft.input_tokens"],
+        "output_tokens": processor.metrics.tokens["llm_draft.output_tokens"],
+        "gmail_requests": resource.requests - requests,
+    }
+
+
+def _print_table(rows):
+    columns = list(rows[0])
+    widths = {c: max(len(c), *(len(str(r[c])) for r in rows)) for c in columns}
+    print("  ".join(c.rjust(widths[c]) for c in columns))
+    for row in rows:
+        print("  ".join(str(row[c]).rjust(widths[c]) for c in columns))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--latency", type=float, default=0.05,
+                        help="stub LLM latency per call in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        help="fraction of LLM calls that fail with a 500")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0,
+                        help="fraction of LLM calls that fail with a 429")
+    parser.add_argument("--gmail-latency", type=float, default=0.0,
+                        help="fake Gmail latency per HTTP round-trip")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--rps", type=float, default=100.0,
+                        help="LLM requests per second allowed by the limiter")
+    parser.add_argument("--separate-chains", action="store_true",
+                        help="disable fused triage")
+    parser.add_argument("--no-priority", action="store_true",
+                        help="triage in Gmail order instead of by priority")
+    parser.add_argument("--cache", action="store_true",
+                        help="also run a second, warm-cache pass per size")
+    parser.add_argument("--no-memory", action="store_true",
+                        help="skip the tracemalloc pass for peak memory")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--sync", action="store_true",
+                        help="check incremental syncs instead of throughput")
+    parser.add_argument("--drafts", action="store_true",
+                        help="time queued and streamed draft replies instead")
+    parser.add_argument("--json", metavar="PATH",
+                        help="append results as JSON lines to PATH")
+    args = parser.parse_args(argv)
+
+    rows = []
+    for size in args.sizes:
+        if args.sync:
+            rows.append(run_sync_scenario(size, args))
+        elif args.drafts:
+            rows.append(run_draft_scenario(size, args, "queued"))
+            rows.append(run_draft_scenario(size, args, "streamed"))
+        elif args.cache:
+            with tempfile.TemporaryDirectory() as tmp:
+                cache_path = f"{tmp}/triage_cache.db"
+                rows.append({"run": "cold", **run_benchmark(size, args, cache_path)})
+                rows.append({"run": "warm", **run_benchmark(size, args, cache_path)})
+        else:
+            rows.append({"run": "nocache", **run_benchmark(size, args)})
+
+    _print_table(rows)
+    if args.json:
+        with open(args.json, "a") as f:
+            for row in rows:
+                f.write(json.dumps({**row, "config": vars(args)}) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+import math
+import re
+from typing import NamedTuple
+
+# Bump when the preprocessing rules change; part of the triage cache version.
+BODY_PREP_VERSION = "1"
+
+# Default per-chain token budgets for the email content sent to the LLM.
+DEFAULT_TOKEN_BUDGETS = {"triage": 500, "draft": 1500}
+
+# Average characters per token for English text with typical LLM tokenizers.
+CHARS_PER_TOKEN = 4
+
+# Lines that start quoted history; everything from here on is dropped.
+_REPLY_HEADER_PATTERNS = [
+    re.compile(r"^On .{0,200}wrote:\s*$", re.IGNORECASE),
+    re.compile(r"^-{2,}\s*Original Message\s*-{2,}", re.IGNORECASE),
+    re.compile(r"^_{10,}\s*$"),
+]
+# Lines that start a signature block.
+_SIGNATURE_PATTERNS = [
+    re.compile(r"^--\s*$"),
+    re.compile(r"^Sent from my \w+", re.IGNORECASE),
+    re.compile(r"^Get Outlook for ", re.IGNORECASE),
+]
+# Individual lines that are tracking or mailing-list boilerplate.
+_BOILERPLATE_PATTERN = re.compile(
+    r"unsubscribe|view (this email )?in (your )?browser|manage (your )?"
+    r"(email )?preferences|privacy policy|update your preferences|"
+    r"you are receiving this|you received this", re.IGNORECASE)
+# Paragraphs that are legal disclaimers.
+_DISCLAIMER_PATTERN = re.compile(
+    r"confidential.{0,200}(intended (solely )?(for the )?(use of the )?"
+    r"(addressee|recipient)|disclaimer)|this (e-?mail|message) and any "
+    r"attachments", re.IGNORECASE | re.DOTALL)
+_URL_PATTERN = re.compile(r"https?://([^/\s]+)\S*")
+
+
+class PreparedBody(NamedTuple):
+    """Email content ready to send to a chain, with token accounting."""
+    text: str
+    original_tokens: int
+    tokens: int
+
+    @property
+    def tokens_saved(self):
+        return self.original_tokens - self.tokens
+
+
+def estimate_tokens(text):
+    """Approximate the number of LLM tokens in ``text``."""
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+def _is_reply_header(lines, idx):
+    line = lines[idx].strip()
+    if line.lower().startswith("from:"):
+        # Only treat "From:" as quoted history when it heads a header block
+        following = " ".join(lines[idx + 1:idx + 5]).lower()
+        return "sent:" in following or "date:" in following
+    return any(pattern.match(line) for pattern in _REPLY_HEADER_PATTERNS)
+
+
+def _shorten_url(match):
+    url = match.group(0)
+    return url if len(url) <= 40 else f"[link: {match.group(1)}]"
+
+
+def strip_boilerplate(text):
+    """Remove quoted history, signatures, disclaimers and tracking lines."""
+    lines = text.splitlines()
+    kept = []
+    for idx, line in enumerate(lines):
+        stripped = line.strip()
+        if _is_reply_header(lines, idx):
+            break
+        if any(pattern.match(stripped) for pattern in _SIGNATURE_PATTERNS):
+            break
+        if stripped.startswith(">"):
+            continue
+        if _BOILERPLATE_PATTERN.search(stripped):
+            continue
+        kept.append(_URL_PATTERN.sub(_shorten_url, line.rstrip()))
+
+    paragraphs = re.split(r"\n\s*\n", "\n".join(kept))
+    paragraphs = [
+        paragraph.strip() for paragraph in paragraphs
+        if paragraph.strip() and not _DISCLAIMER_PATTERN.search(paragraph)
+    ]
+    return "\n\n".join(paragraphs)
+
+
+def fit_to_budget(text, token_budget):
+    """Trim ``text`` to ``token_budget`` tokens, preferring sentence breaks."""
+    if estimate_tokens(text) <= token_budget:
+        return text
+    limit = token_budget * CHARS_PER_TOKEN
+    cut = text[:limit]
+    boundary = max(cut.rfind("\n"), cut.rfind(". "), cut.rfind("? "),
+                   cut.rfind("! "))
+    if boundary > limit // 2:
+        cut = cut[:boundary + 1]
+    return cut.rstrip()
+
+
+def prepare_body(text, token_budget):
+    """Strip boilerplate from a cleaned email body and fit it to a budget.
+
+    Falls back to the unstripped text if stripping would leave nothing
+    (e.g. an email that is entirely a forwarded message).
+    """
+    text = text or ""
+    stripped = strip_boilerplate(text) or text.strip()
+    prepared = fit_to_budget(stripped, token_budget)
+    return PreparedBody(prepared, estimate_tokens(text),
+                        estimate_tokens(prepared))
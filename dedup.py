@@ -0,0 +1,94 @@
+import hashlib
+import re
+
+SIMHASH_BITS = 64
+# Bodies with fewer words than this are too short to fingerprint reliably.
+MIN_FINGERPRINT_WORDS = 8
+_WORD_PATTERN = re.compile(r"[a-z0-9']+")
+# Digits vary between otherwise identical notifications (build numbers,
+# dates, order IDs), so they are normalized before fingerprinting.
+_DIGITS_PATTERN = re.compile(r"\d+")
+
+
+def _hash64(value):
+    return int.from_bytes(
+        hashlib.blake2b(value.encode(), digest_size=8).digest(), "big")
+
+
+def simhash(text, shingle_size=3):
+    """Return a 64-bit SimHash of ``text`` over word shingles, or None.
+
+    Near-identical texts get fingerprints that differ in only a few bits.
+    Returns None for texts too short to fingerprint.
+    """
+    words = _WORD_PATTERN.findall(_DIGITS_PATTERN.sub("0", text.lower()))
+    if len(words) < MIN_FINGERPRINT_WORDS:
+        return None
+    weights = [0] * SIMHASH_BITS
+    for start in range(len(words) - shingle_size + 1):
+        value = _hash64(" ".join(words[start:start + shingle_size]))
+        for bit in range(SIMHASH_BITS):
+            weights[bit] += 1 if value >> bit & 1 else -1
+    return sum(1 << bit for bit, weight in enumerate(weights) if weight > 0)
+
+
+def hamming_distance(a, b):
+    return bin(a ^ b).count("1")
+
+
+def group_messages(messages, max_distance=3):
+    """Group messages that share a Gmail thread or have near-identical bodies.
+
+    ``messages`` is a list of dicts with 'threadId', 'sender' and 'text'
+    (the cleaned body). Bodies are only compared between messages from the
+    same sender, and count as near-identical when their SimHash
+    fingerprints differ in at most ``max_distance`` bits.
+
+    Returns a list of groups, each a list of positions in ``messages`` in
+    their original order; the first position is the group's representative.
+    """
+    parent = list(range(len(messages)))
+
+    def find(pos):
+        while parent[pos] != pos:
+            parent[pos] = parent[parent[pos]]
+            pos = parent[pos]
+        return pos
+
+    def union(a, b):
+        a, b = find(a), find(b)
+        if a != b:
+            # The earliest message becomes the representative
+            parent[max(a, b)] = min(a, b)
+
+    first_in_thread = {}
+    for pos, message in enumerate(messages):
+        thread_id = message.get('threadId')
+        if thread_id:
+            union(first_in_thread.setdefault(thread_id, pos), pos)
+
+    # Split fingerprints into max_distance + 1 bands: two fingerprints within
+    # max_distance bits must agree exactly on at least one band, so only
+    # messages sharing a band need to be compared.
+    bands = max_distance + 1
+    band_bits = SIMHASH_BITS // bands
+    buckets = {}
+    fingerprints = [simhash(message.get('text') or "") for message in messages]
+    for pos, fingerprint in enumerate(fingerprints):
+        if fingerprint is None:
+            continue
+        candidates = set()
+        for band in range(bands):
+            key = (messages[pos].get('sender'), band,
+                   fingerprint >> band * band_bits & (1 << band_bits) - 1)
+            candidates.update(buckets.get(key, ()))
+            buckets.setdefault(key, []).append(pos)
+        for other in candidates:
+            if hamming_distance(fingerprint,
+                                fingerprints[other]) <= max_distance:
+                union(other, pos)
+
+    groups = {}
+    for pos in range(len(messages)):
+        groups.setdefault(find(pos), []).append(pos)
+    return list(groups.values())
@@ -0,0 +1,105 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+class DraftJobQueue:
+    """Background draft generation, keyed and deduplicated by Gmail message ID.
+
+    Each message has at most one job. Requesting a draft for a message whose
+    job is pending, running or done is a no-op; only failed jobs are retried.
+    Jobs run on a small thread pool so several drafts are generated at once.
+    """
+
+    def __init__(self, processor, max_workers=4):
+        self.processor = processor
+        self._executor = ThreadPoolExecutor(max_workers=max_workers,
+                                            thread_name_prefix="draft")
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def _add(self, email):
+        """Record a pending job for ``email``; returns False for duplicates."""
+        message_id = email['id']
+        with self._lock:
+            job = self._jobs.get(message_id)
+            if job and job['status'] != FAILED:
+                return False
+            self._jobs[message_id] = {
+                'status': PENDING,
+                'subject': email['subject'],
+                'message': "",
+                'updated_at': time.time()
+            }
+        return True
+
+    def submit(self, email):
+        """Queue a draft reply for ``email``; returns False for duplicates."""
+        if not self._add(email):
+            return False
+        self._executor.submit(self._run, email['id'], dict(email))
+        return True
+
+    def submit_many(self, emails):
+        """Queue draft replies for many emails; returns how many were queued.
+
+        Bodies that aren't loaded yet are fetched first in batched Gmail
+        calls rather than one call per draft.
+        """
+        queued = [dict(email) for email in emails if self._add(email)]
+        if queued:
+            self._executor.submit(self._run_many, queued)
+        return len(queued)
+
+    def _run_many(self, emails):
+        try:
+            self.processor.load_email_bodies(emails)
+        except Exception:
+            pass  # Each job fetches its own body instead
+        for email in emails:
+            self._executor.submit(self._run, email['id'], email)
+
+    def _update(self, message_id, status, message=""):
+        with self._lock:
+            self._jobs[message_id].update(status=status,
+                                          message=message,
+                                          updated_at=time.time())
+
+    def _run(self, message_id, email):
+        self._update(message_id, RUNNING)
+        try:
+            success, message = self.processor.generate_draft_reply(email)
+        except Exception as e:
+            success, message = False, str(e)
+        self._update(message_id, DONE if success else FAILED, message)
+
+    def status(self, message_id):
+        """Return the job status for a message, or None if never requested."""
+        with self._lock:
+            job = self._jobs.get(message_id)
+            return job['status'] if job else None
+
+    def jobs(self):
+        """Return a snapshot of all jobs keyed by message ID."""
+        with self._lock:
+            return {key: dict(job) for key, job in self._jobs.items()}
+
+    def active(self):
+        """Return True while any job is pending or running."""
+        with self._lock:
+            return any(job['status'] in (PENDING, RUNNING)
+                       for job in self._jobs.values())
+
+    def clear_finished(self):
+        """Forget completed and failed jobs."""
+        with self._lock:
+            self._jobs = {
+                key: job
+                for key, job in self._jobs.items()
+                if job['status'] in (PENDING, RUNNING)
+            }
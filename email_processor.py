@@ -1,212 +1,1164 @@
-from langchain_community.agent_toolkits import GmailToolkit
-from langchain_google_community.gmail.utils import clean_email_body
-from langchain_groq import ChatGroq
-from langchain_core.prompts import ChatPromptTemplate
-from langchain_google_community.gmail.search import SearchArgsSchema, Resource
-from email.header import decode_header
-import streamlit as st
-import time
-import os
-from dotenv import load_dotenv
-
-load_dotenv()
-
-
-class EmailProcessor:
-
-    def __init__(self, api_resource):
-        """Initialize the EmailProcessor with necessary components."""
-        self.toolkit = GmailToolkit(api_resource=api_resource)
-        self.tools = self.toolkit.get_tools()
-        self.search_tool = next(
-            (tool for tool in self.tools if tool.name == "search_gmail"), None)
-        self.draft_tool = next(
-            (tool for tool in self.tools if tool.name == "create_gmail_draft"), None)
-
-        groq_api_key = os.getenv("GROQ_API_KEY")
-        if not groq_api_key:
-            raise ValueError("GROQ API key not found")
-
-        self.groq_llm = ChatGroq(
-            model="mixtral-8x7b-32768",
-            temperature=0.7,
-            max_tokens=500,  # Increased for draft generation
-            api_key=groq_api_key)
-
-        self._initialize_chains()
-
-    def _initialize_chains(self):
-        """Initialize the processing chains."""
-        self.categorization_chain = self._create_categorization_chain()
-        self.urgency_chain = self._create_urgency_chain()
-        self.summarization_chain = self._create_summarization_chain()
-        self.draft_chain = self._create_draft_chain()
-
-    def _create_categorization_chain(self):
-        prompt = ChatPromptTemplate.from_messages([(
-            "system",
-            """You are a helpful assistant that categorizes emails into one of these types: Work, Personal, Promotional, or Spam. 
-         Your response must be exactly one of these four words: Work, Personal, Promotional, or Spam. 
-         Do not include any explanations, notes, or additional text."""
-        ), ("human", "{email_content}")])
-        return prompt | self.groq_llm
-
-    def _create_urgency_chain(self):
-        prompt = ChatPromptTemplate.from_messages([
-            ("system",
-             """Rate the email's urgency using exactly one of these levels:
-                - Urgent: Immediate action required (deadlines, emergencies)
-                - High: Important but not immediate
-                - Medium: Normal priority
-                - Low: Can wait
-
-                Respond with only the urgency level.
-                Respond with only the urgency level in the format:
-                [URGENCY_LEVEL]"""),
-            ("human", "{email_content}")
-        ])
-        return prompt | self.groq_llm
-
-    def _create_summarization_chain(self):
-        prompt = ChatPromptTemplate.from_messages([
-            ("system",
-             """Create a one-line summary of the email's core message.
-                Focus on actionable content or key information.
-                Ignore technical elements, images, or formatting.
-                Be concise and direct."""), ("human", "{email_content}")
-        ])
-        return prompt | self.groq_llm
-
-    def _create_draft_chain(self):
-        prompt = ChatPromptTemplate.from_messages([
-            ("system",
-             """You are an AI assistant helping to draft email replies.
-                Create a professional and courteous response based on the original email.
-                Keep the tone appropriate for the email category (formal for work, friendly for personal).
-                Be concise but complete.
-                Include:
-                - Appropriate greeting
-                - Clear response to the main points
-                - Professional closing
-                - Your signature line
-
-                Format the response appropriately with line breaks."""),
-            ("human", """Original Email Content: {email_content}
-            Category: {category}
-            Urgency: {urgency}""")
-        ])
-        return prompt | self.groq_llm
-
-    def generate_draft_reply(self, email):
-        """Generate and save a draft reply to an email."""
-        try:
-            if not self.draft_tool:
-                raise ValueError("Draft tool not initialized")
-
-            # Generate draft content
-            draft_response = self.draft_chain.invoke({
-                "email_content":
-                email['body'],
-                "category":
-                email['category'],
-                "urgency":
-                email['urgency']
-            }).content
-
-            # Create draft in Gmail
-            draft_args = {
-                "message": {
-                    "to": email['sender'],
-                    "subject": f"Re: {email['subject']}",
-                    "body": draft_response
-                }
-            }
-
-            self.draft_tool.run(draft_args)
-            return True, "Draft created successfully"
-
-        except Exception as e:
-            return False, f"Error creating draft: {str(e)}"
-
-    def decode_email_subject(self, subject):
-        """Decode email subject."""
-        try:
-            decoded_parts = decode_header(subject)
-            decoded_subject = ""
-            for part, encoding in decoded_parts:
-                if isinstance(part, bytes):
-                    decoded_subject += part.decode(encoding or "utf-8",
-                                                   errors="replace")
-                else:
-                    decoded_subject += part
-            return decoded_subject
-        except Exception:
-            return subject
-
-    def process_emails(self,
-                       query="is:unread newer_than:2d category:primary",
-                       max_results=5):
-        """Process emails with improved error handling and consistent output."""
-        if not self.search_tool:
-            return []
-
-        try:
-            search_args = SearchArgsSchema(query=query,
-                                           resource=Resource.MESSAGES,
-                                           max_results=max_results)
-
-            with st.spinner('Processing emails...'):
-                results = self.search_tool.run(search_args.model_dump())
-                processed_emails = []
-
-                total_emails = len(results)
-                for idx, result in enumerate(results, 1):
-                    try:
-                        # Clean and prepare email content
-                        cleaned_body = clean_email_body(result['body'])
-                        decoded_subject = self.decode_email_subject(
-                            result['subject'])
-                        truncated_body = cleaned_body[:
-                                                      2000]  # Limit content length for processing
-
-                        # Process email components
-                        category = self.categorization_chain.invoke({
-                            "email_content":
-                            truncated_body
-                        }).content.strip().capitalize()
-
-                        # Validate category
-                        valid_categories = ["Work", "Personal", "Promotional", "Spam"]
-                        if category not in valid_categories:
-                            category = "Spam"  # Default to Spam if the category is invalid
-
-                        urgency = self.urgency_chain.invoke({
-                            "email_content":
-                            truncated_body
-                        }).content.strip()
-
-                        summary = self.summarization_chain.invoke({
-                            "email_content":
-                            truncated_body
-                        }).content.strip()
-
-                        processed_emails.append({
-                            'subject': decoded_subject,
-                            'sender': result['sender'],
-                            'category': category,
-                            'urgency': urgency,
-                            'summary': summary,
-                            'body': cleaned_body
-                        })
-
-                    except Exception as e:
-                        st.error(f"Error processing email: {str(e)}")
-                        continue
-
-                    time.sleep(0.2)  # Small delay to prevent rate limiting
-
-                return processed_emails
-
-        except Exception as e:
-            st.error(f"Error fetching emails: {str(e)}")
-            return []
+from langchain_google_community.gmail.utils import clean_email_body
+from langchain_core.prompts import ChatPromptTemplate
+from pydantic import BaseModel, Field, field_validator
+from email.header import decode_header
+from email.message import EmailMessage
+from rate_limiter import TokenBucket, is_rate_limited, retry_after_seconds
+from resilience import RetryPolicy
+from triage_cache import TriageCache, content_hash
+from gmail_fetch import (BatchFetcher, HistorySync, HistoryExpired,
+                         LabelModifier, QUOTA_UNITS, spend_quota)
+from body_prep import (BODY_PREP_VERSION, DEFAULT_TOKEN_BUDGETS,
+                       estimate_tokens, prepare_body)
+from dedup import group_messages
+from embedding_index import EmbeddingIndex
+from fast_classifier import FastClassifier
+from metrics import PipelineMetrics
+from model_router import ModelRouter
+from prioritizer import URGENT_LEVELS, Prioritizer
+from typing import NamedTuple
+import asyncio
+import base64
+import hashlib
+import html
+import logging
+import os
+import threading
+import time
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+VALID_CATEGORIES = ["Work", "Personal", "Promotional", "Spam"]
+VALID_URGENCIES = ["Urgent", "High", "Medium", "Low"]
+# Past replies shown to the draft chain are cut to this many characters.
+MAX_EXAMPLE_REPLY_CHARS = 1500
+
+
+def is_valid_category(label):
+    return label.strip().capitalize() in VALID_CATEGORIES
+
+
+def is_valid_urgency(label):
+    return label.strip().strip("[]").strip().capitalize() in VALID_URGENCIES
+
+
+def normalize_category(category):
+    """Map a raw model label onto a valid category, defaulting to Spam."""
+    category = category.strip().capitalize()
+    if category not in VALID_CATEGORIES:
+        category = "Spam"  # Default to Spam if the category is invalid
+    return category
+
+
+def normalize_urgency(urgency):
+    """Map a raw model label such as "[High]" onto a valid urgency, defaulting to Medium."""
+    urgency = urgency.strip().strip("[]").strip().capitalize()
+    if urgency not in VALID_URGENCIES:
+        urgency = "Medium"
+    return urgency
+
+
+class EmailTriage(BaseModel):
+    """Category, urgency and summary returned by the fused triage chain."""
+
+    category: str = Field(
+        description="Exactly one of: Work, Personal, Promotional, Spam")
+    urgency: str = Field(
+        description="Exactly one of: Urgent, High, Medium, Low")
+    summary: str = Field(
+        description="One-line summary of the email's core message")
+
+    @field_validator("category")
+    @classmethod
+    def _validate_category(cls, value):
+        return normalize_category(value)
+
+    @field_validator("urgency")
+    @classmethod
+    def _validate_urgency(cls, value):
+        # An odd urgency shouldn't cost the valid category and summary
+        return normalize_urgency(value)
+
+    @field_validator("summary")
+    @classmethod
+    def _validate_summary(cls, value):
+        summary = value.strip()
+        if not summary:
+            raise ValueError("Summary must not be empty")
+        return summary
+
+
+class SyncResult(NamedTuple):
+    """Outcome of an incremental sync."""
+    emails: list
+    removed_ids: list
+    history_id: str
+    full_resync: bool
+    # IDs matching the query after an incremental sync, in Gmail's order;
+    # merged lists keep only these
+    matching_ids: list = None
+
+
+class EmailProcessor:
+
+    def __init__(self,
+                 api_resource,
+                 fused_triage=True,
+                 max_concurrency=4,
+                 requests_per_second=5.0,
+                 max_retries=3,
+                 cache_path="triage_cache.db",
+                 token_budgets=None,
+                 fast_path_model="fast_classifier.json",
+                 llm=None,
+                 metrics_path="pipeline_metrics.jsonl",
+                 prometheus_path=None,
+                 rate_limiter=None,
+                 gmail_limiter=None,
+                 llm_timeout=60.0,
+                 deduplicate=True,
+                 routes=None,
+                 prioritize=True,
+                 sender_history_path="sender_history.json",
+                 index_path="email_index.db",
+                 embedder=None):
+        """Initialize the EmailProcessor with necessary components.
+
+        With ``fused_triage`` enabled, category, urgency and summary are
+        requested in a single structured-output call, falling back to the
+        three separate chains whenever that response cannot be parsed.
+
+        Up to ``max_concurrency`` emails are triaged at once, and every LLM
+        request goes through a token bucket allowing ``requests_per_second``
+        that backs off on 429 responses.
+
+        Triage results are cached on disk at ``cache_path`` (pass None to
+        disable) so repeat refreshes only call the LLM for new mail.
+
+        Email bodies are stripped of quoted history, signatures and
+        boilerplate, then fitted to ``token_budgets`` (tokens per chain,
+        keys "triage" and "draft") before being sent to the LLM.
+
+        Obvious promotional/spam mail is settled by a local classifier
+        persisted at ``fast_path_model`` (pass None to disable), which is
+        trained on the LLM's labels as they come in.
+
+        Each chain runs on the Groq model, temperature and max_tokens of
+        its route in ``routes`` (see model_router.DEFAULT_ROUTES): labels
+        come from a small deterministic model and drafts from a larger one.
+        Unparseable or invalid labels are asked again of the route's larger
+        escalation model. ``llm`` replaces every model, e.g. with a stub
+        for offline benchmarks.
+
+        Per-stage timings, token usage and event counters for the last run
+        are kept in ``self.metrics``, summarized in ``metrics_path`` as JSON
+        lines and, if ``prometheus_path`` is set, written there in the
+        Prometheus text format.
+
+        ``rate_limiter`` replaces the LLM token bucket, e.g. with a
+        SharedTokenBucket so several processes share one global LLM rate.
+        ``gmail_limiter`` is a token bucket of Gmail quota units for this
+        mailbox; without one Gmail calls are not throttled.
+
+        LLM calls time out after ``llm_timeout`` seconds. LLM and Gmail
+        calls that fail with 429s, 5xx or timeouts are retried up to
+        ``max_retries`` times with jittered exponential backoff, and each
+        backend has a circuit breaker that fails fast while it is down.
+
+        With ``deduplicate`` enabled, emails from the same thread or with
+        near-identical bodies from the same sender are triaged once; the
+        rest of each group copy the result and share its ``group_id``.
+
+        With ``prioritize`` enabled, emails that need the LLM are triaged
+        in order of a priority score from their labels, headers, thread and
+        sender history (persisted at ``sender_history_path``), so urgent
+        mail comes back first. cancel() stops a run partway through.
+
+        Triaged emails are added to a local embedding index at
+        ``index_path`` (pass None to disable) for semantic search, embedded
+        with ``embedder`` (default: embedding_index.default_embedder()), and
+        draft replies saved to Gmail are reused there as examples for
+        drafts to similar emails.
+        """
+        self.fused_triage = fused_triage
+        self.deduplicate = deduplicate
+        self.max_concurrency = max(1, max_concurrency)
+        self.max_retries = max_retries
+        self.token_budgets = {**DEFAULT_TOKEN_BUDGETS, **(token_budgets or {})}
+        self.metrics = PipelineMetrics()
+        self.errors = []  # Messages of the errors in the current run
+        self._cancelled = threading.Event()
+        self.metrics_path = metrics_path
+        self.prometheus_path = prometheus_path
+        self.rate_limiter = rate_limiter or TokenBucket(rate=requests_per_second)
+        self.gmail_limiter = gmail_limiter
+        self.llm_policy = RetryPolicy(
+            "Groq",
+            timeout=llm_timeout,
+            max_retries=max_retries,
+            on_retry=lambda e: self.metrics.incr("retries"))
+        self.gmail_policy = RetryPolicy(
+            "Gmail",
+            max_retries=max_retries,
+            on_retry=lambda e: self.metrics.incr("gmail_retries"))
+        self.api_resource = api_resource
+        # The Gmail client's HTTP transport is not thread-safe, so every call
+        # through api_resource is serialized with this lock.
+        self.gmail_lock = threading.Lock()
+        self.fetcher = BatchFetcher(api_resource, limiter=gmail_limiter)
+        self.history_sync = HistorySync(api_resource, limiter=gmail_limiter)
+        self.label_modifier = LabelModifier(api_resource, limiter=gmail_limiter)
+
+        groq_api_key = os.getenv("GROQ_API_KEY")
+        if llm is None and not groq_api_key:
+            raise ValueError("GROQ API key not found")
+        # Groq clients don't retry; retries are handled by self.llm_policy
+        self.router = ModelRouter(routes,
+                                  api_key=groq_api_key,
+                                  timeout=llm_timeout,
+                                  llm=llm)
+
+        self._initialize_chains()
+        self.triage_version = self._compute_triage_version()
+        self.triage_cache = TriageCache(cache_path) if cache_path else None
+        self.fast_classifier = (FastClassifier(fast_path_model)
+                                if fast_path_model else None)
+        self.prioritizer = (Prioritizer(sender_history_path)
+                            if prioritize else None)
+        self.embedding_index = (EmbeddingIndex(index_path, embedder)
+                                if index_path else None)
+
+    def _initialize_chains(self):
+        """Build each route's chain, plus its escalation chain if it has one."""
+        builders = {
+            "category": self._create_categorization_chain,
+            "urgency": self._create_urgency_chain,
+            "summary": self._create_summarization_chain,
+            "triage": self._create_triage_chain,
+            "draft": self._create_draft_chain
+        }
+        self.chains = {
+            route: build(self.router.llm(route))
+            for route, build in builders.items()
+        }
+        self.escalation_chains = {
+            route: build(self.router.llm(route, escalated=True))
+            for route, build in builders.items()
+            if self.router.can_escalate(route)
+        }
+
+    def _compute_triage_version(self):
+        """Hash the models and triage prompts so edits invalidate the cache."""
+        triage_routes = ("category", "urgency", "summary", "triage")
+        parts = [
+            self.router.fingerprint(triage_routes), BODY_PREP_VERSION,
+            str(self.token_budgets["triage"])
+        ]
+        for route in triage_routes:
+            parts.append(self.chains[route].first.pretty_repr())
+        return hashlib.sha256("\n".join(parts).encode()).hexdigest()[:16]
+
+    def _create_categorization_chain(self, llm):
+        prompt = ChatPromptTemplate.from_messages([(
+            "system",
+            """You are a helpful assistant that categorizes emails into one of these types: Work, Personal, Promotional, or Spam. 
+         Your response must be exactly one of these four words: Work, Personal, Promotional, or Spam. 
+         Do not include any explanations, notes, or additional text."""
+        ), ("human", "{email_content}")])
+        return prompt | llm
+
+    def _create_urgency_chain(self, llm):
+        prompt = ChatPromptTemplate.from_messages([
+            ("system",
+             """Rate the email's urgency using exactly one of these levels:
+                - Urgent: Immediate action required (deadlines, emergencies)
+                - High: Important but not immediate
+                - Medium: Normal priority
+                - Low: Can wait
+
+                Respond with only the urgency level.
+                Respond with only the urgency level in the format:
+                [URGENCY_LEVEL]"""),
+            ("human", "{email_content}")
+        ])
+        return prompt | llm
+
+    def _create_summarization_chain(self, llm):
+        prompt = ChatPromptTemplate.from_messages([
+            ("system",
+             """Create a one-line summary of the email's core message.
+                Focus on actionable content or key information.
+                Ignore technical elements, images, or formatting.
+                Be concise and direct."""), ("human", "{email_content}")
+        ])
+        return prompt | llm
+
+    def _create_triage_chain(self, llm):
+        prompt = ChatPromptTemplate.from_messages([
+            ("system",
+             """You are a helpful assistant that triages emails.
+                For the given email, return:
+                - category: exactly one of Work, Personal, Promotional, or Spam
+                - urgency: exactly one of these levels:
+                    - Urgent: Immediate action required (deadlines, emergencies)
+                    - High: Important but not immediate
+                    - Medium: Normal priority
+                    - Low: Can wait
+                - summary: a one-line summary of the email's core message.
+                  Focus on actionable content or key information.
+                  Ignore technical elements, images, or formatting.
+                  Be concise and direct."""), ("human", "{email_content}")
+        ])
+        return prompt | llm.with_structured_output(EmailTriage,
+                                                   include_raw=True)
+
+    def _create_draft_chain(self, llm):
+        prompt = ChatPromptTemplate.from_messages([
+            ("system",
+             """You are an AI assistant helping to draft email replies.
+                Create a professional and courteous response based on the original email.
+                Keep the tone appropriate for the email category (formal for work, friendly for personal).
+                Be concise but complete.
+                Include:
+                - Appropriate greeting
+                - Clear response to the main points
+                - Professional closing
+                - Your signature line
+
+                Format the response appropriately with line breaks."""),
+            ("human", """Original Email Content: {email_content}
+            Category: {category}
+            Urgency: {urgency}
+            {examples}""")
+        ])
+        return prompt | llm
+
+    def _draft_inputs(self, email):
+        """Load the body if needed and build the draft chain's inputs."""
+        self.load_email_body(email)
+        prepared = prepare_body(email['body'], self.token_budgets["draft"])
+        return {
+            "email_content": prepared.text,
+            "category": email['category'],
+            "urgency": email['urgency'],
+            "examples": self._reply_examples(email)
+        }
+
+    def _reply_examples(self, email):
+        """Describe past replies to similar emails, for the draft prompt."""
+        if self.embedding_index is None:
+            return ""
+        with self.metrics.span("draft_examples", email['id']):
+            examples = self.embedding_index.reply_examples(email)
+        if not examples:
+            return ""
+        parts = ["Replies you wrote to similar emails; match their tone "
+                 "and sign-off:"]
+        for info, reply in examples:
+            parts.append(f"Email: {info['subject']}\nReply: "
+                         f"{reply[:MAX_EXAMPLE_REPLY_CHARS]}")
+        return "\n\n".join(parts)
+
+    def generate_draft_reply(self, email):
+        """Generate and save a draft reply to an email."""
+        try:
+            inputs = self._draft_inputs(email)
+
+            # Generate draft content
+            self.rate_limiter.acquire_sync()
+            with self.metrics.span("llm_draft", email['id']):
+                response = self.llm_policy.call(self.chains["draft"].invoke,
+                                                inputs)
+            self.metrics.add_usage("llm_draft", response,
+                                   self.router.cost("draft", response))
+
+            self.save_draft(email, response.content)
+            return True, "Draft created successfully"
+
+        except Exception as e:
+            return False, f"Error creating draft: {str(e)}"
+
+    def stream_draft_reply(self, email):
+        """Yield a draft reply to ``email`` chunk by chunk as it is generated.
+
+        Nothing is saved; pass the reviewed text to save_draft. Failures
+        before the first chunk arrives are retried like any LLM call.
+        """
+        inputs = self._draft_inputs(email)
+        self.rate_limiter.acquire_sync()
+
+        def start_stream():
+            chunks = self.chains["draft"].stream(inputs)
+            return chunks, next(chunks, None)
+
+        started = time.perf_counter()
+        chunks, chunk = self.llm_policy.call(start_stream)
+        self.metrics.record("llm_draft_first_token",
+                            time.perf_counter() - started, email['id'])
+        message = None
+        try:
+            while chunk is not None:
+                message = chunk if message is None else message + chunk
+                yield chunk.content
+                chunk = next(chunks, None)
+        finally:
+            chunks.close()
+            self.metrics.record("llm_draft", time.perf_counter() - started,
+                                email['id'])
+            if message is not None:
+                self.metrics.add_usage("llm_draft", message,
+                                       self.router.cost("draft", message))
+
+    def _create_draft(self, body):
+        return self.api_resource.users().drafts().create(userId="me",
+                                                          body=body).execute()
+
+    def save_draft(self, email, text):
+        """Save ``text`` as a draft reply to ``email`` with one Gmail API call."""
+        subject = email['subject']
+        if not subject.lower().startswith("re:"):
+            subject = f"Re: {subject}"
+        message = EmailMessage()
+        message["To"] = email['sender']
+        message["Subject"] = subject
+        # Gmail only threads a draft that replies to the original Message-ID
+        if email.get('message_id'):
+            message["In-Reply-To"] = email['message_id']
+            message["References"] = email['message_id']
+        message.set_content(text)
+        draft = {
+            "message": {
+                "raw": base64.urlsafe_b64encode(message.as_bytes()).decode()
+            }
+        }
+        if email.get('thread_id'):
+            draft["message"]["threadId"] = email['thread_id']
+
+        spend_quota(self.gmail_limiter, QUOTA_UNITS["drafts.create"])
+        # Not idempotent: a timed-out create may still have succeeded
+        created = self._gmail("gmail_draft",
+                              self._create_draft,
+                              draft,
+                              idempotent=False)
+        if self.embedding_index is not None:
+            # The draft exists now; reporting a failure would only invite
+            # a retry that creates a duplicate
+            try:
+                self.embedding_index.add_reply(email, text)
+            except Exception as e:
+                logger.warning("Could not remember the reply: %s", e)
+        return created
+
+    def _gmail(self, stage, func, *args, idempotent=True):
+        """Call a Gmail API helper while holding the Gmail lock, timed as ``stage``.
+
+        Transient failures are retried by ``self.gmail_policy``; the lock is
+        released while backing off.
+        """
+
+        def locked_call():
+            with self.gmail_lock:
+                return func(*args)
+
+        with self.metrics.span(stage):
+            return self.gmail_policy.call(locked_call, idempotent=idempotent)
+
+    async def _agmail(self, stage, func, *args):
+        """Run a Gmail API helper in a worker thread without blocking the loop."""
+        return await asyncio.to_thread(self._gmail, stage, func, *args)
+
+    def load_email_body(self, email):
+        """Fetch and clean the body of an email that was loaded without one."""
+        if email.get('body') is None:
+            result = self._gmail("gmail_bodies", self.fetcher.fetch_full,
+                                 [email['id']]).get(email['id'])
+            if result is None:
+                raise ValueError("Email no longer exists in Gmail")
+            email['body'] = clean_email_body(result['body'])
+        return email['body']
+
+    def load_email_bodies(self, emails):
+        """Fetch the missing bodies of many emails in batched Gmail calls.
+
+        Emails that no longer exist keep a None body.
+        """
+        missing = [email for email in emails if email.get('body') is None]
+        if not missing:
+            return
+        results = self._gmail("gmail_bodies", self.fetcher.fetch_full,
+                              [email['id'] for email in missing])
+        for email in missing:
+            result = results.get(email['id'])
+            if result is not None:
+                email['body'] = clean_email_body(result['body'])
+
+    def modify_emails(self, message_ids, add_labels=(), remove_labels=()):
+        """Add and remove labels on many messages; returns the number of calls.
+
+        Labels are given by name (e.g. "INBOX", "UNREAD" or a user label,
+        which is created if it doesn't exist yet).
+        """
+        modifier = self.label_modifier
+        add_ids = [self._gmail("gmail_labels", modifier.label_id, name)
+                   for name in add_labels]
+        remove_ids = [self._gmail("gmail_labels", modifier.label_id, name)
+                      for name in remove_labels]
+        # Applying the same label change twice is harmless, so retry freely
+        calls = self._gmail("gmail_modify", modifier.batch_modify,
+                            list(message_ids), add_ids, remove_ids)
+        self.metrics.incr("emails_modified", len(message_ids))
+        return calls
+
+    def decode_email_subject(self, subject):
+        """Decode email subject."""
+        try:
+            decoded_parts = decode_header(subject)
+            decoded_subject = ""
+            for part, encoding in decoded_parts:
+                if isinstance(part, bytes):
+                    decoded_subject += part.decode(encoding or "utf-8",
+                                                   errors="replace")
+                else:
+                    decoded_subject += part
+            return decoded_subject
+        except Exception:
+            return subject
+
+    async def _ainvoke(self, route, inputs, email_id=None, escalated=False):
+        """Invoke a route's chain through the rate limiter with a timeout.
+
+        The call is timed and priced as stage ``llm_<route>``, or
+        ``llm_<route>_escalated`` on the escalation model. 429s slow down
+        the rate limiter; those, 5xx and timeouts are retried with
+        jittered backoff, up to ``max_retries`` times.
+        """
+        chain = (self.escalation_chains if escalated else self.chains)[route]
+        stage = f"llm_{route}_escalated" if escalated else f"llm_{route}"
+        attempt = 0
+        while True:
+            with self.metrics.span("rate_limit_wait", email_id):
+                await self.rate_limiter.acquire()
+            try:
+                with self.metrics.span(stage, email_id):
+                    response = await self.llm_policy.attempt(
+                        chain.ainvoke, inputs)
+            except Exception as e:
+                if not self.llm_policy.should_retry(e, attempt):
+                    raise
+                attempt += 1
+                self.metrics.incr("retries")
+                if is_rate_limited(e):
+                    self.rate_limiter.penalize(retry_after_seconds(e))
+                else:
+                    await asyncio.sleep(self.llm_policy.backoff(attempt, e))
+                continue
+            self.rate_limiter.reward()
+            # Structured output returns {"raw": AIMessage, "parsed": ...}
+            raw = response.get("raw") if isinstance(response, dict) else response
+            self.metrics.add_usage(stage, raw,
+                                   self.router.cost(route, raw, escalated))
+            return response
+
+    async def _ainvoke_label(self, route, inputs, is_valid, email_id=None):
+        """Invoke a labelling route, escalating if the label isn't valid.
+
+        If the escalation fails, the small model's answer is returned; it
+        still normalizes to a default label.
+        """
+        response = await self._ainvoke(route, inputs, email_id)
+        if is_valid(response.content) or not self.router.can_escalate(route):
+            return response
+        self.metrics.incr("escalations")
+        try:
+            return await self._ainvoke(route, inputs, email_id, escalated=True)
+        except Exception as e:
+            self.metrics.incr("escalation_failures")
+            logger.warning("Escalating %s failed, keeping the small model's "
+                           "label: %s", route, e)
+            return response
+
+    async def _atriage_separately(self, email_content, email_id=None):
+        """Run the categorization, urgency and summarization chains."""
+        inputs = {"email_content": email_content}
+        category, urgency, summary = await asyncio.gather(
+            self._ainvoke_label("category", inputs, is_valid_category,
+                                email_id),
+            self._ainvoke_label("urgency", inputs, is_valid_urgency,
+                                email_id),
+            self._ainvoke("summary", inputs, email_id))
+
+        return (normalize_category(category.content),
+                normalize_urgency(urgency.content), summary.content.strip())
+
+    async def _afused_triage(self, email_content, email_id=None,
+                             escalated=False):
+        """Return the parsed EmailTriage, or None if the response is unusable."""
+        try:
+            result = await self._ainvoke("triage",
+                                         {"email_content": email_content},
+                                         email_id, escalated)
+        except Exception as e:
+            # Groq rejects malformed tool calls with a 400; anything else
+            # (rate limits, network errors) is not a parse failure.
+            if getattr(e, "status_code", None) != 400:
+                raise
+            return None
+        return result.get("parsed")
+
+    async def atriage_email(self, email_content, email_id=None):
+        """Return (category, urgency, summary) for the given email content.
+
+        An unparseable fused response is asked again of the larger model
+        before falling back to the separate chains.
+        """
+        if self.fused_triage:
+            triage = await self._afused_triage(email_content, email_id)
+            if triage is None and self.router.can_escalate("triage"):
+                self.metrics.incr("escalations")
+                try:
+                    triage = await self._afused_triage(email_content,
+                                                       email_id,
+                                                       escalated=True)
+                except Exception as e:
+                    # The separate chains can still label the email
+                    self.metrics.incr("escalation_failures")
+                    logger.warning("Escalating triage failed: %s", e)
+            if triage is not None:
+                return triage.category, triage.urgency, triage.summary
+            self.metrics.incr("fused_fallbacks")
+
+        return await self._atriage_separately(email_content, email_id)
+
+    async def _aprocess_result(self, result, semaphore):
+        """Triage a single search result; errors only drop this email."""
+        async with semaphore:
+            try:
+                email_id = result['id']
+                # Clean and prepare email content, unless already cleaned
+                cleaned_body = result.get('cleaned_body')
+                if cleaned_body is None:
+                    with self.metrics.span("clean_body", email_id):
+                        cleaned_body = clean_email_body(result['body'])
+                with self.metrics.span("decode_subject", email_id):
+                    decoded_subject = self.decode_email_subject(
+                        result['subject'])
+                # Drop quoted history and boilerplate, then fit the budget
+                with self.metrics.span("prepare_body", email_id):
+                    prepared = prepare_body(cleaned_body,
+                                            self.token_budgets["triage"])
+
+                category, urgency, summary = await self.atriage_email(
+                    prepared.text, email_id)
+                if self.fast_classifier:
+                    self.fast_classifier.record_llm_label(result, category)
+                if self.prioritizer:
+                    self.prioritizer.record(result, urgency)
+                if self.triage_cache:
+                    with self.metrics.span("cache_store", email_id):
+                        self.triage_cache.put(email_id,
+                                              content_hash(cleaned_body),
+                                              self.triage_version, category,
+                                              urgency, summary,
+                                              result.get('group_id'))
+
+                return {
+                    'id': result['id'],
+                    'thread_id': result.get('threadId'),
+                    'message_id': result.get('messageId'),
+                    'subject': decoded_subject,
+                    'sender': result['sender'],
+                    'category': category,
+                    'urgency': urgency,
+                    'summary': summary,
+                    'body': cleaned_body,
+                    'tokens_saved': prepared.tokens_saved,
+                    'group_id': result.get('group_id')
+                }
+
+            except Exception as e:
+                self.metrics.incr("errors")
+                self._report_error(f"Error processing email: {str(e)}")
+                return None
+
+    def _cached_email(self, result):
+        """Build a processed email from the triage cache, or return None.
+
+        Metadata-only results are looked up by message ID alone, so their
+        body never has to be downloaded.
+        """
+        if not self.triage_cache:
+            return None
+        with self.metrics.span("cache_lookup", result['id']):
+            if result.get('body') is None:
+                body = None
+                cached = self.triage_cache.get_by_message(
+                    result['id'], self.triage_version)
+            else:
+                body = clean_email_body(result['body'])
+                cached = self.triage_cache.get(result['id'],
+                                               content_hash(body),
+                                               self.triage_version)
+        if not cached:
+            self.metrics.incr("cache_misses")
+            return None
+        self.metrics.incr("cache_hits")
+        return {
+            'id': result['id'],
+            'thread_id': result.get('threadId'),
+            'message_id': result.get('messageId'),
+            'subject': self.decode_email_subject(result['subject']),
+            'sender': result['sender'],
+            'category': cached['category'],
+            # Entries cached before urgencies were normalized may be "[High]"
+            'urgency': normalize_urgency(cached['urgency']),
+            'summary': cached['summary'],
+            'body': body,  # None until loaded lazily for a draft
+            'tokens_saved': 0,
+            'group_id': cached['group_id']
+        }
+
+    def _fast_path_email(self, result):
+        """Settle obvious promotional/spam mail locally, or return None."""
+        with self.metrics.span("fast_path", result['id']):
+            category = self.fast_classifier.classify(result)
+        if category is None:
+            return None
+        self.metrics.incr("fast_path")
+        body = result.get('body')
+        summary = html.unescape(result.get('snippet') or '') or result['subject']
+        return {
+            'id': result['id'],
+            'thread_id': result.get('threadId'),
+            'message_id': result.get('messageId'),
+            'subject': self.decode_email_subject(result['subject']),
+            'sender': result['sender'],
+            'category': category,
+            'urgency': "Low",
+            'summary': summary,
+            'body': clean_email_body(body) if body is not None else None,
+            'tokens_saved': 0,
+            'group_id': None
+        }
+
+    def _duplicate_email(self, representative, result):
+        """Build a processed email from its group representative's triage."""
+        cleaned_body = result['cleaned_body']
+        if self.triage_cache:
+            with self.metrics.span("cache_store", result['id']):
+                self.triage_cache.put(result['id'], content_hash(cleaned_body),
+                                      self.triage_version,
+                                      representative['category'],
+                                      representative['urgency'],
+                                      representative['summary'],
+                                      result['group_id'])
+        return {
+            'id': result['id'],
+            'thread_id': result.get('threadId'),
+            'message_id': result.get('messageId'),
+            'subject': self.decode_email_subject(result['subject']),
+            'sender': result['sender'],
+            'category': representative['category'],
+            'urgency': representative['urgency'],
+            'summary': representative['summary'],
+            'body': cleaned_body,
+            'tokens_saved': estimate_tokens(cleaned_body),  # Never sent
+            'group_id': result['group_id']
+        }
+
+    def _group_pending(self, results, pending):
+        """Clean fetched bodies and group duplicates; returns {rep: [others]}.
+
+        Updates ``results`` in place with each body's cleaned text and, for
+        emails in a group of several, the shared ``group_id``.
+        """
+        for idx in pending:
+            with self.metrics.span("clean_body", results[idx]['id']):
+                results[idx] = {
+                    **results[idx], 'cleaned_body':
+                    clean_email_body(results[idx]['body'])
+                }
+        if not self.deduplicate:
+            return {idx: [] for idx in pending}
+
+        with self.metrics.span("dedup"):
+            groups = group_messages([{
+                'threadId': results[idx].get('threadId'),
+                'sender': results[idx]['sender'],
+                'text': results[idx]['cleaned_body']
+            } for idx in pending])
+        members = {}
+        for group in groups:
+            indices = [pending[pos] for pos in group]
+            if len(indices) > 1:
+                representative = results[indices[0]]
+                group_id = representative.get('threadId') or representative['id']
+                for idx in indices:
+                    results[idx] = {**results[idx], 'group_id': group_id}
+                self.metrics.incr("deduplicated", len(indices) - 1)
+            members[indices[0]] = indices[1:]
+        return members
+
+    async def _aiter_results(self, results):
+        """Yield (index, email) pairs as soon as each email is triaged.
+
+        See _atriage_results. The emails triaged are then added to the
+        embedding index.
+        """
+        triaged = []
+        agen = self._atriage_results(results)
+        try:
+            async for idx, email in agen:
+                if email is not None:
+                    triaged.append(email)
+                yield idx, email
+        finally:
+            await agen.aclose()
+            if self.embedding_index is not None and triaged:
+                try:
+                    with self.metrics.span("embedding_index"):
+                        self.embedding_index.add_many(triaged)
+                except Exception as e:
+                    logger.warning("Could not update the email index: %s", e)
+
+    async def _atriage_results(self, results):
+        """Yield (index, email) pairs as soon as each email is triaged.
+
+        ``results`` may be metadata-only (``body`` is None). Those already in
+        the triage cache, or obvious enough for the local fast-path
+        classifier, are yielded straight away without downloading their
+        body; the rest have their full bodies fetched in batch requests and
+        are yielded in completion order, each group of duplicates right
+        after its representative. Emails that fail are yielded as
+        (index, None) so callers can still count them.
+
+        The emails that need the LLM are started in priority order. After
+        cancel() no further emails are yielded and outstanding work stops.
+        """
+        if self.triage_cache:
+            self.triage_cache.reset_stats()
+        if self.fast_classifier:
+            self.fast_classifier.reset_stats()
+
+        started = time.perf_counter()
+        results = list(results)
+        pending = []
+        for idx, result in enumerate(results):
+            email = self._cached_email(result)
+            if email is None and self.fast_classifier:
+                email = self._fast_path_email(result)
+            if email is None:
+                pending.append(idx)
+            else:
+                yield idx, email
+        if self.prioritizer:
+            with self.metrics.span("prioritize"):
+                pending = self.prioritizer.rank(results, pending)
+
+        missing_bodies = [
+            results[idx]['id'] for idx in pending
+            if results[idx].get('body') is None
+        ]
+        if missing_bodies:
+            try:
+                full = await self._agmail("gmail_bodies",
+                                          self.fetcher.fetch_full,
+                                          missing_bodies)
+            except Exception as e:
+                self._report_error(f"Error fetching email bodies: {str(e)}")
+                full = {}
+            # Keep the metadata fields; take only the body from the full fetch
+            for idx in pending:
+                result = results[idx]
+                if result.get('body') is None and result['id'] in full:
+                    results[idx] = {**result, 'body': full[result['id']]['body']}
+
+        for idx in pending:
+            if results[idx].get('body') is None:
+                yield idx, None  # Its body could not be fetched
+        members = self._group_pending(
+            results,
+            [idx for idx in pending if results[idx].get('body') is not None])
+
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        async def triage(idx):
+            return idx, await self._aprocess_result(results[idx], semaphore)
+
+        # Only one email per group goes to the LLM; the others copy its result
+        # Tasks queue on the semaphore in creation order, i.e. by priority
+        tasks = [asyncio.ensure_future(triage(idx)) for idx in members]
+        first_urgent = None
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                if self._cancelled.is_set():
+                    next_done.close()  # Not awaited; the tasks are cancelled below
+                    self.metrics.incr("cancelled",
+                                      sum(not task.done() for task in tasks))
+                    break
+                idx, email = await next_done
+                if (first_urgent is None and email
+                        and email['urgency'] in URGENT_LEVELS):
+                    first_urgent = time.perf_counter() - started
+                    self.metrics.record("first_urgent_email", first_urgent)
+                yield idx, email
+                for other in members[idx]:
+                    yield other, (self._duplicate_email(email, results[other])
+                                  if email else None)
+        finally:
+            # Stop outstanding work if the consumer stopped early
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            if self.triage_cache:
+                self.triage_cache.evict()
+            if self.fast_classifier:
+                self.fast_classifier.save()
+            if self.prioritizer:
+                self.prioritizer.save()
+
+    async def aprocess_results(self, results):
+        """Triage fetched messages concurrently, keeping their original order."""
+        processed = [None] * len(results)
+        async for idx, email in self._aiter_results(results):
+            processed[idx] = email
+        return [email for email in processed if email is not None]
+
+    async def afetch_email_metadata(self,
+                                    query="is:unread newer_than:2d category:primary",
+                                    max_results=5):
+        """List matching messages and fetch their headers in batch requests."""
+        message_ids = await self._agmail("gmail_list", self.fetcher.list_ids,
+                                         query, max_results)
+        return await self._agmail("gmail_metadata",
+                                  self.fetcher.fetch_metadata, message_ids)
+
+    async def aprocess_emails(self,
+                              query="is:unread newer_than:2d category:primary",
+                              max_results=5,
+                              metadata=None):
+        """Fetch matching emails and triage them concurrently.
+
+        Pass ``metadata`` from fetch_email_metadata to skip listing again.
+        """
+        if metadata is None:
+            try:
+                metadata = await self.afetch_email_metadata(
+                    query=query, max_results=max_results)
+            except Exception as e:
+                self._report_error(f"Error fetching emails: {str(e)}")
+                return []
+
+        return await self.aprocess_results(metadata)
+
+    async def aiter_emails(self,
+                           query="is:unread newer_than:2d category:primary",
+                           max_results=5,
+                           metadata=None):
+        """Yield (completed, total, email) as each email finishes triage.
+
+        ``completed`` counts failed emails too, so ``completed / total``
+        can drive a progress bar; failed emails themselves are not yielded.
+        """
+        if metadata is None:
+            try:
+                metadata = await self.afetch_email_metadata(
+                    query=query, max_results=max_results)
+            except Exception as e:
+                self._report_error(f"Error fetching emails: {str(e)}")
+                return
+
+        total_emails = len(metadata)
+        completed = 0
+        async for _, email in self._aiter_results(metadata):
+            completed += 1
+            if email is not None:
+                yield completed, total_emails, email
+
+    async def async_emails(self,
+                           history_id=None,
+                           query="is:unread newer_than:2d category:primary",
+                           max_results=5,
+                           known_ids=None):
+        """Triage only the unread mail that changed since ``history_id``.
+
+        History reports every unread message, so the changes are narrowed
+        to the first ``max_results`` messages still matching ``query``,
+        read with one IDs-only search. Matching messages that aren't in
+        ``known_ids`` (the emails already shown, if given) are triaged too,
+        e.g. older mail moving up when newer mail drops out.
+
+        Without a usable ``history_id`` (first run, or Gmail expired the
+        history) this falls back to a full search with ``query``. The
+        returned SyncResult carries the historyId to pass on the next call.
+        """
+        try:
+            if history_id:
+                try:
+                    changes = await self._agmail(
+                        "gmail_history", self.history_sync.changes_since,
+                        history_id)
+                except HistoryExpired:
+                    pass
+                else:
+                    matching_ids = await self._agmail(
+                        "gmail_list", self.fetcher.list_ids, query,
+                        max_results)
+                    matching = set(matching_ids)
+                    changed_ids = [
+                        message_id for message_id in changes.changed_ids
+                        if message_id in matching
+                    ]
+                    if known_ids is not None:
+                        known = set(known_ids) | set(changed_ids)
+                        changed_ids += [
+                            message_id for message_id in matching_ids
+                            if message_id not in known
+                        ]
+                    results = await self._agmail("gmail_metadata",
+                                                 self.fetcher.fetch_metadata,
+                                                 changed_ids)
+                    emails = await self.aprocess_results(results)
+                    # After a cancel, sync the same changes again next time
+                    return SyncResult(
+                        emails, changes.removed_ids,
+                        history_id if self.cancelled else changes.history_id,
+                        False, matching_ids)
+
+            # Read the historyId before searching so nothing that arrives
+            # during the search is missed by the next incremental sync.
+            history_id = await self._agmail(
+                "gmail_history", self.history_sync.current_history_id)
+        except Exception as e:
+            self._report_error(f"Error syncing emails: {str(e)}")
+            return None
+
+        emails = await self.aprocess_emails(query=query,
+                                            max_results=max_results)
+        # A cancelled full sync is incomplete; the next one starts over
+        return SyncResult(emails, [], None if self.cancelled else history_id,
+                          True)
+
+    def _report_error(self, message):
+        """Log an error and keep it for the caller to display."""
+        logger.error(message)
+        self.errors.append(message)
+
+    def start_run(self):
+        """Reset the pipeline metrics and errors at the start of a refresh."""
+        self.metrics.reset()
+        self.errors = []
+        self._cancelled.clear()
+
+    def cancel(self):
+        """Stop the current run; emails triaged so far are still returned.
+
+        Safe to call from another thread or a signal handler. In-flight LLM
+        calls are abandoned once the next one completes.
+        """
+        self._cancelled.set()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def finish_run(self):
+        """Write the metrics of the finished refresh to the configured sinks."""
+        try:
+            if self.metrics_path:
+                self.metrics.write_jsonl(self.metrics_path)
+            if self.prometheus_path:
+                self.metrics.write_prometheus(self.prometheus_path)
+        except OSError as e:
+            logger.warning("Could not write pipeline metrics: %s", e)
+        return self.metrics.summary()
+
+    def run_stats(self):
+        """Return the cache, fast-path and performance stats of the last run."""
+        return {
+            'cache': self.triage_cache.stats() if self.triage_cache else None,
+            'fast_path': (self.fast_classifier.stats()
+                          if self.fast_classifier else None),
+            'performance': {
+                **self.metrics.summary(), 'per_email': self.metrics.per_email()
+            }
+        }
+
+    def _iterate(self, agen):
+        """Drive an async generator from synchronous code, one item at a time."""
+        loop = asyncio.new_event_loop()
+        try:
+            while True:
+                try:
+                    yield loop.run_until_complete(agen.__anext__())
+                except StopAsyncIteration:
+                    break
+        finally:
+            loop.run_until_complete(agen.aclose())
+            loop.run_until_complete(loop.shutdown_default_executor())
+            loop.close()
+
+    def iter_process_emails(self,
+                            query="is:unread newer_than:2d category:primary",
+                            max_results=5,
+                            metadata=None):
+        """Generator version of process_emails yielding (completed, total, email).
+
+        Each email is yielded as soon as it is triaged, so callers can render
+        results progressively. Closing the generator cancels pending work.
+        """
+        return self._iterate(
+            self.aiter_emails(query=query,
+                              max_results=max_results,
+                              metadata=metadata))
+
+    def current_history_id(self):
+        """Return the mailbox historyId to start incremental syncs from."""
+        try:
+            return self._gmail("gmail_history",
+                               self.history_sync.current_history_id)
+        except Exception as e:
+            self._report_error(f"Error reading mailbox history: {str(e)}")
+            return None
+
+    def fetch_email_metadata(self,
+                             query="is:unread newer_than:2d category:primary",
+                             max_results=5):
+        """Return header-only search results so the list can render early."""
+        try:
+            return asyncio.run(
+                self.afetch_email_metadata(query=query,
+                                           max_results=max_results))
+        except Exception as e:
+            self._report_error(f"Error fetching emails: {str(e)}")
+            return []
+
+    def process_emails(self,
+                       query="is:unread newer_than:2d category:primary",
+                       max_results=5,
+                       metadata=None):
+        """Process emails with improved error handling and consistent output."""
+        self.start_run()
+        emails = asyncio.run(
+            self.aprocess_emails(query=query,
+                                 max_results=max_results,
+                                 metadata=metadata))
+        self.finish_run()
+        return emails
+
+    def sync_emails(self,
+                    history_id=None,
+                    query="is:unread newer_than:2d category:primary",
+                    max_results=5,
+                    known_ids=None):
+        """Incrementally sync and triage emails; returns a SyncResult or None."""
+        self.start_run()
+        result = asyncio.run(
+            self.async_emails(history_id=history_id,
+                              query=query,
+                              max_results=max_results,
+                              known_ids=known_ids))
+        self.finish_run()
+        return result
@@ -0,0 +1,232 @@
+import enum
+import sqlite3
+import sys
+import threading
+import time
+import zlib
+from dataclasses import dataclass
+from typing import Optional
+
+
+class Category(str, enum.Enum):
+    """Email category; members compare equal to their label."""
+    WORK = "Work"
+    PERSONAL = "Personal"
+    PROMOTIONAL = "Promotional"
+    SPAM = "Spam"
+
+    @classmethod
+    def parse(cls, label):
+        """Map a label onto a category, defaulting to Spam like the triage chains."""
+        if isinstance(label, cls):
+            return label
+        try:
+            return cls(str(label).strip().capitalize())
+        except ValueError:
+            return cls.SPAM
+
+
+class Urgency(str, enum.Enum):
+    """Email urgency level; members compare equal to their label."""
+    URGENT = "Urgent"
+    HIGH = "High"
+    MEDIUM = "Medium"
+    LOW = "Low"
+
+    @classmethod
+    def parse(cls, label):
+        """Map a label such as "[High]" onto a level, defaulting to Medium."""
+        if isinstance(label, cls):
+            return label
+        try:
+            return cls(str(label).strip().strip("[]").strip().capitalize())
+        except ValueError:
+            return cls.MEDIUM
+
+
+@dataclass(slots=True)
+class EmailRecord:
+    """One triaged email, without its body."""
+    id: str
+    subject: str
+    sender: str
+    category: Category
+    urgency: Urgency
+    summary: str
+    thread_id: Optional[str] = None
+    group_id: Optional[str] = None
+    tokens_saved: int = 0
+    message_id: Optional[str] = None  # RFC 822 Message-ID, to thread replies
+
+    @classmethod
+    def from_dict(cls, email):
+        """Build a record from a processed email dict, dropping the body."""
+        return cls(id=email['id'],
+                   subject=email['subject'],
+                   sender=sys.intern(email['sender']),
+                   category=Category.parse(email['category']),
+                   urgency=Urgency.parse(email['urgency']),
+                   summary=email['summary'],
+                   thread_id=email.get('thread_id'),
+                   group_id=email.get('group_id'),
+                   tokens_saved=email.get('tokens_saved', 0),
+                   message_id=email.get('message_id'))
+
+    def to_dict(self, body=None):
+        """Return the processed email dict the rest of the app works with."""
+        return {
+            'id': self.id,
+            'thread_id': self.thread_id,
+            'message_id': self.message_id,
+            'subject': self.subject,
+            'sender': self.sender,
+            'category': self.category.value,
+            'urgency': self.urgency.value,
+            'summary': self.summary,
+            'body': body,
+            'tokens_saved': self.tokens_saved,
+            'group_id': self.group_id
+        }
+
+    @property
+    def card_key(self):
+        """Emails that were deduplicated together, or share a thread, form one card."""
+        return self.group_id or self.thread_id or self.id
+
+
+class BodyCache:
+    """Compressed email bodies on disk, keyed by Gmail message ID.
+
+    Keeps bodies out of the app's memory until a draft needs one. The least
+    recently stored entries are dropped once it holds more than
+    ``max_entries``.
+    """
+
+    def __init__(self, path="email_bodies.db", max_entries=5000):
+        self.path = path
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS bodies (
+                message_id TEXT PRIMARY KEY,
+                body BLOB NOT NULL,
+                stored_at REAL NOT NULL
+            )""")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_bodies_stored "
+                           "ON bodies (stored_at)")
+        self._conn.commit()
+
+    def get(self, message_id):
+        """Return the stored body, or None if it isn't cached."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT body FROM bodies WHERE message_id = ?",
+                (message_id, )).fetchone()
+        return zlib.decompress(row[0]).decode() if row else None
+
+    def put_many(self, bodies):
+        """Store {message_id: body} and trim the cache to ``max_entries``."""
+        if not bodies:
+            return
+        now = time.time()
+        rows = [(message_id, zlib.compress(body.encode()), now)
+                for message_id, body in bodies.items()]
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO bodies VALUES (?, ?, ?)", rows)
+            self._conn.execute(
+                "DELETE FROM bodies WHERE rowid IN (SELECT rowid FROM bodies "
+                "ORDER BY stored_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries, ))
+            self._conn.commit()
+
+
+class EmailStore:
+    """Triaged emails as compact records, indexed by category and urgency.
+
+    Built once per refresh from the processed email dicts. Bodies go to
+    ``body_cache`` (if given) instead of memory and are loaded again by
+    draft_email. Counts and category views are dictionary lookups, so
+    reruns don't scan the list.
+    """
+
+    def __init__(self, emails=(), body_cache=None):
+        self.body_cache = body_cache
+        self._records = [EmailRecord.from_dict(email) for email in emails]
+        self._by_id = {record.id: record for record in self._records}
+        self.tokens_saved = sum(record.tokens_saved for record in self._records)
+        self._category_counts = dict.fromkeys(Category, 0)
+        self._urgency_counts = dict.fromkeys(Urgency, 0)
+        for record in self._records:
+            self._category_counts[record.category] += 1
+            self._urgency_counts[record.urgency] += 1
+
+        # Each card is a list of records whose first entry is shown; a card
+        # is filed under the category of that first record
+        cards = {}
+        for record in self._records:
+            cards.setdefault(record.card_key, []).append(record)
+        self._all_cards = list(cards.values())
+        self._category_cards = {category: [] for category in Category}
+        for card in self._all_cards:
+            self._category_cards[card[0].category].append(card)
+
+        if body_cache is not None:
+            body_cache.put_many({
+                email['id']: email['body']
+                for email in emails if email.get('body') is not None
+            })
+
+    def __len__(self):
+        return len(self._records)
+
+    def __iter__(self):
+        return iter(self._records)
+
+    def get(self, email_id):
+        return self._by_id.get(email_id)
+
+    def count(self, category=None):
+        """Return the number of emails in ``category``, or in total."""
+        if category is None:
+            return len(self._records)
+        return self._category_counts[Category.parse(category)]
+
+    def urgency_count(self, urgency):
+        return self._urgency_counts[Urgency.parse(urgency)]
+
+    def cards(self, category=None):
+        """Return the cards filed under ``category``, or all cards."""
+        if category is None:
+            return self._all_cards
+        return self._category_cards[Category.parse(category)]
+
+    def select(self, category=None, urgencies=None):
+        """Return the records in ``category`` whose urgency is in ``urgencies``.
+
+        None selects every category or urgency.
+        """
+        if category is not None:
+            category = Category.parse(category)
+        if urgencies is not None:
+            urgencies = {Urgency.parse(urgency) for urgency in urgencies}
+        return [
+            record for record in self._records
+            if (category is None or record.category == category) and (
+                urgencies is None or record.urgency in urgencies)
+        ]
+
+    def to_dicts(self):
+        """Return the emails as dicts without bodies, e.g. to merge or save."""
+        return [record.to_dict() for record in self._records]
+
+    def draft_email(self, email_id):
+        """Return an email dict with its body from the body cache, if cached.
+
+        A None body is fetched from Gmail by the processor when the draft
+        is generated.
+        """
+        record = self._by_id[email_id]
+        body = self.body_cache.get(email_id) if self.body_cache else None
+        return record.to_dict(body)
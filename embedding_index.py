@@ -0,0 +1,363 @@
+import json
+import logging
+import re
+import sqlite3
+import threading
+import time
+import zlib
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Small English sentence-embedding model that runs on the CPU via fastembed
+DEFAULT_EMBEDDING_MODEL = "BAAI/bge-small-en-v1.5"
+EMBEDDING_DIM = 384
+# Only the start of a long body is embedded; it carries the topic.
+MAX_EMBED_CHARS = 4000
+_TOKEN_PATTERN = re.compile(r"\w{2,}")
+
+
+class FastEmbedEmbedder:
+    """Sentence embeddings from a small ONNX model run on the CPU by fastembed.
+
+    Texts with the same meaning get close vectors even without shared
+    words. The model is downloaded on first use (about 70 MB for the
+    default one).
+    """
+    semantic = True
+    # Cosine similarity above which two emails are about the same thing
+    related_score = 0.75
+
+    def __init__(self, model_name=DEFAULT_EMBEDDING_MODEL):
+        from fastembed import TextEmbedding
+        self.model = TextEmbedding(model_name=model_name)
+        self.name = f"fastembed-{model_name}"
+
+    def embed_documents(self, texts):
+        return list(self.model.embed(list(texts)))
+
+    def embed_query(self, text):
+        return next(iter(self.model.query_embed(text)))
+
+
+class HashingEmbedder:
+    """Keyword vectors by feature hashing, with no model to download.
+
+    Words and word pairs are hashed into ``dim`` signed buckets, weighted by
+    log term frequency and normalized, so the cosine similarity of two
+    texts reflects their shared vocabulary, not their meaning. Used when
+    fastembed isn't installed.
+    """
+    semantic = False
+    related_score = 0.3
+
+    def __init__(self, dim=EMBEDDING_DIM):
+        self.dim = dim
+        self.name = f"hashing-v2-{dim}"
+
+    def _embed(self, text):
+        words = _TOKEN_PATTERN.findall(text.lower())
+        counts = {}
+        for feature in words + [f"{a} {b}" for a, b in zip(words, words[1:])]:
+            counts[feature] = counts.get(feature, 0) + 1
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for feature, count in counts.items():
+            value = zlib.crc32(feature.encode())
+            sign = 1.0 if value & 1 else -1.0
+            vector[(value >> 1) % self.dim] += sign * (1.0 + np.log(count))
+        return vector
+
+    def embed_documents(self, texts):
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text):
+        return self._embed(text)
+
+
+def default_embedder(model_name=DEFAULT_EMBEDDING_MODEL):
+    """Return the FastEmbedEmbedder for ``model_name``.
+
+    Falls back to keyword matching with HashingEmbedder when ``model_name``
+    is None, fastembed isn't installed or the model can't be loaded, e.g.
+    because it can't be downloaded.
+    """
+    if model_name is None:
+        return HashingEmbedder()
+    try:
+        return FastEmbedEmbedder(model_name)
+    except ImportError:
+        logger.warning("fastembed is not installed; the email index will "
+                       "match keywords only (pip install fastembed)")
+    except Exception as e:
+        logger.warning("Could not load the embedding model %s (%s); the "
+                       "email index will match keywords only", model_name, e)
+    return HashingEmbedder()
+
+
+_EMAILS_TABLE = """
+    CREATE TABLE IF NOT EXISTS emails (
+        message_id TEXT PRIMARY KEY,
+        info TEXT NOT NULL,
+        text TEXT,
+        indexed_at REAL NOT NULL
+    )"""
+_SCHEMA = _EMAILS_TABLE + """;
+    CREATE TABLE IF NOT EXISTS vectors (
+        embedder TEXT NOT NULL,
+        message_id TEXT NOT NULL,
+        vector BLOB NOT NULL,
+        PRIMARY KEY (embedder, message_id)
+    );
+    CREATE TABLE IF NOT EXISTS replies (
+        message_id TEXT PRIMARY KEY,
+        reply TEXT NOT NULL,
+        saved_at REAL NOT NULL
+    );"""
+
+
+def _normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def email_text(email):
+    """Return the text of a processed email that is embedded."""
+    return "\n".join(
+        part for part in (email.get('subject'), email.get('summary'),
+                          (email.get('body') or "")[:MAX_EMBED_CHARS]) if part)
+
+
+class EmbeddingIndex:
+    """Persistent vector index over triaged emails, for semantic search.
+
+    Each email is embedded once, from its subject, summary and cleaned body,
+    and stored in SQLite at ``path`` together with the fields needed to show
+    it and the embedded text. All vectors are kept in one NumPy matrix, so a search is a single
+    matrix-vector product: a few milliseconds for tens of thousands of
+    emails, which is as large as a triaged mailbox gets. Draft replies saved
+    with add_reply are returned by reply_examples for similar emails.
+
+    ``embedder`` is anything with the embed_documents and embed_query
+    methods of LangChain embeddings; it defaults to default_embedder().
+    Vectors are stored per embedder, so processes with different embedders
+    (say the app and a daemon without fastembed) can share ``path``: emails
+    without a vector from this embedder are embedded when it is opened.
+    """
+
+    def __init__(self, path="email_index.db", embedder=None):
+        self.path = path
+        self.embedder = embedder or default_embedder()
+        self.embedder_name = getattr(
+            self.embedder, "name", None) or "{}-{}".format(
+                type(self.embedder).__name__,
+                getattr(self.embedder, "model_name", None)
+                or getattr(self.embedder, "model", ""))
+        # LangChain embedding models are assumed to capture meaning
+        self.semantic = getattr(self.embedder, "semantic", True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path,
+                                     timeout=30,
+                                     check_same_thread=False)
+        self._conn.executescript(_SCHEMA)
+        self._migrate()
+
+        self._ids = []
+        self._info = {}  # message_id -> fields shown in results
+        self._rows = {}  # message_id -> row of self._matrix
+        self._matrix = None
+        entries = []
+        missing = []
+        for message_id, info, text, vector in self._conn.execute(
+                "SELECT e.message_id, e.info, e.text, v.vector FROM emails e "
+                "LEFT JOIN vectors v ON v.embedder = ? AND "
+                "v.message_id = e.message_id ORDER BY e.indexed_at",
+            (self.embedder_name, )).fetchall():
+            if vector is None:
+                missing.append((message_id, json.loads(info), text))
+            else:
+                entries.append((message_id, json.loads(info),
+                                np.frombuffer(vector, dtype=np.float32)))
+        if missing:
+            entries += self._embed_stored(missing)
+        if entries:
+            self._append(entries)
+        self._replies = dict(
+            self._conn.execute("SELECT message_id, reply FROM replies"))
+
+    def _migrate(self):
+        """Convert an index from before vectors were stored per embedder.
+
+        Its vectors are kept for the embedder recorded with them; replies
+        are kept as they are.
+        """
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            columns = [
+                row[1]
+                for row in self._conn.execute("PRAGMA table_info(emails)")
+            ]
+            if "vector" in columns:
+                self._conn.execute("ALTER TABLE emails RENAME TO emails_old")
+                self._conn.execute(_EMAILS_TABLE)
+                self._conn.execute(
+                    "INSERT INTO emails SELECT message_id, info, NULL, "
+                    "indexed_at FROM emails_old")
+                self._conn.execute(
+                    "INSERT OR IGNORE INTO vectors SELECT meta.value, "
+                    "emails_old.message_id, emails_old.vector FROM emails_old "
+                    "JOIN meta ON meta.key = 'embedder'")
+                self._conn.execute("DROP TABLE emails_old")
+                self._conn.execute("DROP TABLE meta")
+            self._conn.commit()
+        except BaseException:
+            self._conn.rollback()
+            raise
+
+    def _embed_stored(self, stored):
+        """Embed stored (message_id, info, text) emails with this embedder.
+
+        Returns their (message_id, info, vector) entries.
+        """
+        # Emails indexed before their text was stored only have the subject
+        # and summary left to embed
+        vectors = _normalize(
+            self.embedder.embed_documents(
+                [text or email_text(info) for _, info, text in stored]))
+        self._conn.executemany(
+            "INSERT OR REPLACE INTO vectors VALUES (?, ?, ?)",
+            [(self.embedder_name, message_id, vector.tobytes())
+             for (message_id, _, _), vector in zip(stored, vectors)])
+        self._conn.commit()
+        return [(message_id, info, vector)
+                for (message_id, info, _), vector in zip(stored, vectors)]
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __contains__(self, message_id):
+        return message_id in self._rows
+
+    def _append(self, entries):
+        """Add (message_id, info, vector) entries to the in-memory matrix."""
+        vectors = np.stack([vector for _, _, vector in entries])
+        if self._matrix is None:
+            self._matrix = vectors
+        else:
+            self._matrix = np.concatenate([self._matrix, vectors])
+        for message_id, info, _ in entries:
+            self._rows[message_id] = len(self._ids)
+            self._ids.append(message_id)
+            self._info[message_id] = info
+
+    def add_many(self, emails):
+        """Embed and store processed emails that aren't indexed yet.
+
+        Gmail messages never change, so indexed emails are skipped; returns
+        the number added.
+        """
+        with self._lock:
+            new = {}
+            for email in emails:
+                if email['id'] not in self._rows:
+                    new[email['id']] = email
+        if not new:
+            return 0
+        emails = list(new.values())
+        texts = {email['id']: email_text(email) for email in emails}
+        vectors = _normalize(self.embedder.embed_documents(list(texts.values())))
+        now = time.time()
+        entries = []
+        for email, vector in zip(emails, vectors):
+            info = {
+                key: email.get(key)
+                for key in ('subject', 'sender', 'summary', 'category',
+                            'urgency', 'thread_id')
+            }
+            entries.append((email['id'], info, vector))
+        with self._lock:
+            entries = [entry for entry in entries if entry[0] not in self._rows]
+            if not entries:
+                return 0
+            # Another process may have stored the email already
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO emails VALUES (?, ?, ?, ?)",
+                [(message_id, json.dumps(info), texts[message_id], now)
+                 for message_id, info, _ in entries])
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO vectors VALUES (?, ?, ?)",
+                [(self.embedder_name, message_id, vector.tobytes())
+                 for message_id, _, vector in entries])
+            self._conn.commit()
+            self._append(entries)
+        return len(entries)
+
+    def _top(self, query_vector, rows, k, exclude=()):
+        """Return [(score, message_id)] of the ``k`` best ``rows`` (None: all)."""
+        if self._matrix is None:
+            return []
+        matrix = self._matrix if rows is None else self._matrix[rows]
+        ids = self._ids if rows is None else [self._ids[row] for row in rows]
+        if not ids:
+            return []
+        scores = matrix @ query_vector
+        count = min(len(ids), k + len(exclude))
+        best = np.argpartition(-scores, count - 1)[:count]
+        best = best[np.argsort(-scores[best])]
+        return [(float(scores[i]), ids[i]) for i in best
+                if ids[i] not in exclude][:k]
+
+    def _results(self, matches):
+        return [{
+            'id': message_id,
+            'score': score,
+            **self._info[message_id]
+        } for score, message_id in matches]
+
+    def search(self, query, k=10):
+        """Return the ``k`` emails closest in meaning to ``query``, best first.
+
+        Each result is a dict with the email's id, subject, sender, summary,
+        category, urgency, thread_id and a cosine similarity ``score``.
+        """
+        vector = _normalize(self.embedder.embed_query(query))
+        with self._lock:
+            return self._results(self._top(vector, None, k))
+
+    def similar(self, message_id, k=5):
+        """Return the ``k`` emails most similar to an indexed email."""
+        with self._lock:
+            row = self._rows.get(message_id)
+            if row is None:
+                return []
+            return self._results(
+                self._top(self._matrix[row], None, k, exclude={message_id}))
+
+    def add_reply(self, email, reply):
+        """Remember ``reply`` as the reply sent to ``email``."""
+        self.add_many([email])
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO replies VALUES (?, ?, ?)",
+                               (email['id'], reply, time.time()))
+            self._conn.commit()
+            self._replies[email['id']] = reply
+
+    def reply_examples(self, email, k=2, min_score=None):
+        """Return up to ``k`` (email info, reply) pairs from similar emails.
+
+        Only replies to emails at least ``min_score`` similar are returned,
+        by default the embedder's ``related_score``.
+        """
+        if min_score is None:
+            min_score = getattr(self.embedder, "related_score", 0.75)
+        with self._lock:
+            rows = [self._rows[message_id] for message_id in self._replies
+                    if message_id != email['id'] and message_id in self._rows]
+        if not rows:
+            return []
+        vector = _normalize(self.embedder.embed_query(email_text(email)))
+        with self._lock:
+            matches = self._top(vector, rows, k)
+            return [(self._info[message_id], self._replies[message_id])
+                    for score, message_id in matches if score >= min_score]
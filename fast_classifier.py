@@ -0,0 +1,290 @@
+import json
+import logging
+import math
+import os
+import random
+import re
+import threading
+import zlib
+from email.utils import parseaddr
+
+from file_utils import write_atomic
+
+logger = logging.getLogger(__name__)
+
+# The local fast path only ever settles these categories; anything that
+# might need a reply still goes to the LLM.
+FAST_PATH_CATEGORIES = ("Promotional", "Spam")
+
+# Sender domains that only ever send newsletters or marketing mail.
+NEWSLETTER_DOMAINS = {
+    "substack.com", "mailchimp.com", "mcsv.net", "mcdlv.net", "list-manage.com",
+    "sendgrid.net", "sendinblue.com", "klaviyomail.com", "hubspotemail.net",
+    "constantcontact.com", "e.linkedin.com", "em.linkedin.com", "beehiiv.com",
+    "convertkit-mail.com", "campaign-archive.com"
+}
+_BULK_PRECEDENCE = {"bulk", "list", "junk"}
+_TOKEN_PATTERN = re.compile(r"[a-z0-9']{2,}")
+
+
+def _sender_domain(sender):
+    address = parseaddr(sender or "")[1].lower()
+    return address.rpartition("@")[2]
+
+
+def header_rules(result):
+    """Decide obvious cases from labels and headers alone.
+
+    Returns (category, confidence) or None when the headers are not decisive.
+    """
+    labels = set(result.get("labelIds") or [])
+    headers = result.get("headers") or {}
+    domain = _sender_domain(result.get("sender"))
+
+    if "SPAM" in labels:
+        return "Spam", 0.99
+    if "CATEGORY_PROMOTIONS" in labels:
+        return "Promotional", 0.97
+    if any(domain == d or domain.endswith("." + d) for d in NEWSLETTER_DOMAINS):
+        return "Promotional", 0.96
+    if ("list-unsubscribe" in headers and headers.get(
+            "precedence", "").strip().lower() in _BULK_PRECEDENCE):
+        return "Promotional", 0.9
+    return None
+
+
+def extract_features(result):
+    """Turn a message's metadata into string features for the local model."""
+    headers = result.get("headers") or {}
+    domain = _sender_domain(result.get("sender"))
+    features = [f"domain={domain}", f"tld={domain.rpartition('.')[2]}"]
+    features += [f"label={label}" for label in result.get("labelIds") or []]
+    for name in ("list-unsubscribe", "list-id", "precedence", "auto-submitted",
+                 "in-reply-to"):
+        if name in headers:
+            features.append(f"has={name}")
+    local_part = parseaddr(result.get("sender") or "")[1].partition("@")[0]
+    if re.search(r"no-?reply|newsletter|marketing|news|info|deals", local_part,
+                 re.IGNORECASE):
+        features.append("sender=bulk-like")
+    text = f"{result.get('subject') or ''} {result.get('snippet') or ''}"
+    features += [f"w={token}" for token in _TOKEN_PATTERN.findall(text.lower())]
+    return features
+
+
+class HashedNaiveBayes:
+    """Multinomial naive Bayes over hashed features, trained incrementally."""
+
+    def __init__(self, n_features=2**18, alpha=1.0):
+        self.n_features = n_features
+        self.alpha = alpha
+        self.class_counts = {}
+        self.feature_counts = {}
+        self.feature_totals = {}
+
+    def _buckets(self, features):
+        return [zlib.crc32(f.encode()) % self.n_features for f in features]
+
+    def partial_fit(self, features, label):
+        """Update the model with one labelled example."""
+        self.class_counts[label] = self.class_counts.get(label, 0) + 1
+        counts = self.feature_counts.setdefault(label, {})
+        for bucket in self._buckets(features):
+            counts[bucket] = counts.get(bucket, 0) + 1
+        self.feature_totals[label] = (self.feature_totals.get(label, 0) +
+                                      len(features))
+
+    def merge(self, other):
+        """Add the training counts of ``other`` to this model."""
+        for label, count in other.class_counts.items():
+            self.class_counts[label] = self.class_counts.get(label, 0) + count
+            counts = self.feature_counts.setdefault(label, {})
+            for bucket, value in other.feature_counts[label].items():
+                counts[bucket] = counts.get(bucket, 0) + value
+            self.feature_totals[label] = (self.feature_totals.get(label, 0) +
+                                          other.feature_totals[label])
+
+    def predict_proba(self, features):
+        """Return {label: probability}; empty until the model has been trained."""
+        total = sum(self.class_counts.values())
+        if not total:
+            return {}
+        buckets = self._buckets(features)
+        scores = {}
+        for label, class_count in self.class_counts.items():
+            counts = self.feature_counts[label]
+            denominator = (self.feature_totals[label] +
+                           self.alpha * self.n_features)
+            score = math.log(class_count / total)
+            for bucket in buckets:
+                score += math.log(
+                    (counts.get(bucket, 0) + self.alpha) / denominator)
+            scores[label] = score
+        best = max(scores.values())
+        exp = {label: math.exp(score - best) for label, score in scores.items()}
+        norm = sum(exp.values())
+        return {label: value / norm for label, value in exp.items()}
+
+    def to_dict(self):
+        return {
+            "n_features": self.n_features,
+            "alpha": self.alpha,
+            "class_counts": self.class_counts,
+            "feature_counts": {
+                label: {str(k): v for k, v in counts.items()}
+                for label, counts in self.feature_counts.items()
+            },
+            "feature_totals": self.feature_totals,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        model = cls(data["n_features"], data["alpha"])
+        model.class_counts = data["class_counts"]
+        model.feature_counts = {
+            label: {int(k): v for k, v in counts.items()}
+            for label, counts in data["feature_counts"].items()
+        }
+        model.feature_totals = data["feature_totals"]
+        return model
+
+
+class FastClassifier:
+    """Local pre-classifier that settles obvious promotional/spam mail.
+
+    Header rules decide the clear-cut cases; a naive Bayes model trained on
+    past LLM labels decides the rest once it has seen ``min_samples``
+    examples. Only predictions of Promotional or Spam with confidence of at
+    least ``threshold`` skip the LLM. A random ``audit_rate`` fraction of
+    those is still sent to the LLM so the agreement rate stays measurable.
+
+    Several processes (app sessions, the daemon) may train on the same
+    ``path``: save() adds what this instance learnt since its last save to
+    the stored model, and picks up the others' training in the process.
+    """
+
+    def __init__(self,
+                 path="fast_classifier.json",
+                 threshold=0.95,
+                 min_samples=50,
+                 audit_rate=0.05):
+        self.path = path
+        self.threshold = threshold
+        self.min_samples = min_samples
+        self.audit_rate = audit_rate
+        self.model = HashedNaiveBayes()
+        self.agreed = 0
+        self.compared = 0
+        self._lock = threading.Lock()
+        self._load()
+        self._reset_unsaved()
+        self.reset_stats()
+
+    def _read(self):
+        """Return the stored (model, agreed, compared), or None."""
+        if not self.path or not os.path.exists(self.path):
+            return None
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+            return (HashedNaiveBayes.from_dict(data["model"]),
+                    data.get("agreed", 0), data.get("compared", 0))
+        except (OSError, ValueError, KeyError):
+            return None  # Start from scratch if the saved model is unreadable
+
+    def _load(self):
+        stored = self._read()
+        if stored:
+            self.model, self.agreed, self.compared = stored
+
+    def _reset_unsaved(self):
+        self._unsaved = HashedNaiveBayes(self.model.n_features,
+                                         self.model.alpha)
+        self._unsaved_agreed = 0
+        self._unsaved_compared = 0
+
+    def save(self):
+        """Add this instance's new training to the stored model.
+
+        Errors are logged rather than raised; the training is kept and
+        saved next time.
+        """
+        if not self.path:
+            return
+        with self._lock:
+            if not self._unsaved.class_counts and not self._unsaved_compared:
+                return
+            model, agreed, compared = self._read() or (HashedNaiveBayes(
+                self.model.n_features, self.model.alpha), 0, 0)
+            model.merge(self._unsaved)
+            agreed += self._unsaved_agreed
+            compared += self._unsaved_compared
+            try:
+                write_atomic(
+                    self.path,
+                    json.dumps({
+                        "model": model.to_dict(),
+                        "agreed": agreed,
+                        "compared": compared
+                    }))
+            except OSError as e:
+                logger.warning("Could not save the fast-path model: %s", e)
+                return
+            self.model, self.agreed, self.compared = model, agreed, compared
+            self._reset_unsaved()
+
+    def reset_stats(self):
+        """Reset the per-refresh counters."""
+        self.local_decisions = 0
+        self.llm_decisions = 0
+
+    def predict(self, result):
+        """Return (category, confidence) from header rules or the model."""
+        decision = header_rules(result)
+        if decision:
+            return decision
+        with self._lock:
+            if sum(self.model.class_counts.values()) < self.min_samples:
+                return None
+            probabilities = self.model.predict_proba(extract_features(result))
+        if not probabilities:
+            return None
+        category = max(probabilities, key=probabilities.get)
+        return category, probabilities[category]
+
+    def classify(self, result):
+        """Return a category if the LLM can be skipped for this email, else None."""
+        decision = self.predict(result)
+        if (decision is None or decision[0] not in FAST_PATH_CATEGORIES
+                or decision[1] < self.threshold):
+            return None
+        if random.random() < self.audit_rate:
+            return None  # Audit sample: let the LLM decide and compare
+        self.local_decisions += 1
+        return decision[0]
+
+    def record_llm_label(self, result, category):
+        """Learn from an LLM label and track agreement with the local guess."""
+        decision = self.predict(result)
+        with self._lock:
+            if decision is not None:
+                agreed = int(decision[0] == category)
+                self.compared += 1
+                self.agreed += agreed
+                self._unsaved_compared += 1
+                self._unsaved_agreed += agreed
+            features = extract_features(result)
+            self.model.partial_fit(features, category)
+            self._unsaved.partial_fit(features, category)
+        self.llm_decisions += 1
+
+    def stats(self):
+        """Return LLM call reduction for the last refresh and overall agreement."""
+        total = self.local_decisions + self.llm_decisions
+        return {
+            "local": self.local_decisions,
+            "llm": self.llm_decisions,
+            "skipped_rate": self.local_decisions / total if total else 0.0,
+            "agreement": self.agreed / self.compared if self.compared else None,
+            "compared": self.compared
+        }
@@ -0,0 +1,20 @@
+import os
+import tempfile
+
+
+def write_atomic(path, text):
+    """Replace the file at ``path`` with ``text`` in one step.
+
+    The text is written to a uniquely named temporary file in the same
+    directory and renamed over ``path``, so readers never see a partial
+    file and concurrent writers don't share a temporary file.
+    """
+    directory, name = os.path.split(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=f".{name}.")
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
@@ -1,73 +1,271 @@
-from langchain_community.tools.gmail.utils import (
-    build_resource_service,
-    get_gmail_credentials,
-)
-import streamlit as st
-import os
-import webbrowser
-from google_auth_oauthlib.flow import Flow
-
-def initialize_gmail():
-    """Initialize Gmail credentials and API resource."""
-    try:
-        if not os.path.exists("credentials.json"):
-            st.error("credentials.json file not found. Please upload your Google API credentials.")
-            uploaded_file = st.file_uploader("Upload credentials.json", type="json")
-            if uploaded_file:
-                with open("credentials.json", "wb") as f:
-                    f.write(uploaded_file.getbuffer())
-                st.success("Credentials uploaded successfully!")
-                st.rerun()
-            return None, None
-
-        if not os.path.exists("token.json"):
-            st.warning("Gmail authentication required.")
-            # Create the flow using the client secrets file
-            flow = Flow.from_client_secrets_file(
-                'credentials.json',
-                scopes=['https://mail.google.com/'],
-                redirect_uri='urn:ietf:wg:oauth:2.0:oob'
-            )
-
-            auth_url, _ = flow.authorization_url(prompt='consent')
-
-            st.markdown(f"""
-            ### Gmail Authentication Required
-            1. Click the link below to authorize the application:
-            2. [Click here to authenticate with Gmail]({auth_url})
-            3. Copy the authorization code and paste it below:
-            """)
-
-            auth_code = st.text_input("Enter the authorization code:")
-            if auth_code:
-                flow.fetch_token(code=auth_code)
-                with open("token.json", "w") as token_file:
-                    credentials = flow.credentials
-                    import json
-                    token_file.write(json.dumps({
-                        'token': credentials.token,
-                        'refresh_token': credentials.refresh_token,
-                        'token_uri': credentials.token_uri,
-                        'client_id': credentials.client_id,
-                        'client_secret': credentials.client_secret,
-                        'scopes': credentials.scopes
-                    }))
-                st.success("Authentication successful!")
-                st.rerun()
-            return None, None
-
-        credentials = get_gmail_credentials(
-            token_file="token.json",
-            scopes=["https://mail.google.com/"],
-            client_secrets_file="credentials.json",
-        )
-        api_resource = build_resource_service(credentials=credentials)
-        return credentials, api_resource
-    except Exception as e:
-        st.error(f"Error initializing Gmail: {str(e)}")
-        if "token.json" in str(e):
-            if os.path.exists("token.json"):
-                os.remove("token.json")
-            st.warning("Authentication token expired. Please authenticate again.")
-            st.rerun()
-        return None, None
\ No newline at end of file
+import streamlit as st
+import functools
+import json
+import logging
+import os
+import tempfile
+import threading
+import webbrowser
+from datetime import datetime, timezone
+import google_auth_httplib2
+import httplib2
+from google.auth.exceptions import RefreshError
+from google.oauth2.credentials import Credentials
+from google_auth_oauthlib.flow import Flow
+from googleapiclient import discovery_cache
+from googleapiclient.discovery import build_from_document
+
+logger = logging.getLogger(__name__)
+
+GMAIL_SCOPES = ["https://mail.google.com/"]
+# Socket timeout for every Gmail API request, so a hung call can't block a run.
+GMAIL_TIMEOUT_SECONDS = 30
+# Refresh the access token this many seconds before it expires.
+REFRESH_MARGIN_SECONDS = 300
+# Wait before retrying a refresh that failed for a transient reason.
+REFRESH_RETRY_SECONDS = 30
+
+@functools.lru_cache(maxsize=None)
+def _discovery_document():
+    """Return the Gmail discovery document bundled with google-api-python-client."""
+    return discovery_cache.get_static_doc("gmail", "v1")
+
+def save_token(token_file, credentials):
+    """Write ``credentials`` to ``token_file`` atomically, readable by the owner only.
+
+    The token is written to a uniquely named temporary file next to it and
+    then renamed, so a crash, a concurrent reader or another writer (e.g.
+    the app and the daemon) never sees a half-written token.
+    """
+    directory, name = os.path.split(os.path.abspath(token_file))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=f".{name}.")
+    try:
+        with os.fdopen(fd, "w") as f:  # mkstemp creates it with mode 0o600
+            f.write(credentials.to_json())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, token_file)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+class CredentialManager:
+    """Gmail OAuth credentials and API resource for one token file.
+
+    The token is read and the Gmail resource built once, from the bundled
+    discovery document, so no discovery request is ever made. The access
+    token is refreshed ``refresh_margin`` seconds before it expires, by a
+    background thread once start() is called, and saved with save_token.
+    The resource keeps working across refreshes because its authorized HTTP
+    client shares the refreshed credentials object; an access token saved
+    by another process is copied into it too. A non-retryable refresh
+    failure (e.g. revoked access) is kept in ``refresh_error``.
+    """
+
+    def __init__(self,
+                 token_file="token.json",
+                 client_secrets_file="credentials.json",
+                 refresh_margin=REFRESH_MARGIN_SECONDS):
+        self.token_file = token_file
+        self.client_secrets_file = client_secrets_file
+        self.refresh_margin = refresh_margin
+        self.refresh_error = None
+        self._lock = threading.RLock()
+        self._refresh_lock = threading.Lock()  # One refresh at a time
+        self._stop = threading.Event()
+        self._thread = None
+        self._load()
+
+    def _read_credentials(self):
+        """Return the credentials in the token file and the file's mtime."""
+        mtime = os.path.getmtime(self.token_file)
+        with open(self.token_file) as f:
+            info = json.load(f)
+        if not info.get("client_id") and os.path.exists(self.client_secrets_file):
+            # Tokens from some flows leave the OAuth client out
+            with open(self.client_secrets_file) as f:
+                secrets = json.load(f)
+            client = secrets.get("installed") or secrets.get("web") or {}
+            info.setdefault("client_id", client.get("client_id"))
+            info.setdefault("client_secret", client.get("client_secret"))
+        return Credentials.from_authorized_user_info(info, GMAIL_SCOPES), mtime
+
+    def _load(self):
+        """Read the token file and build a Gmail resource around it."""
+        credentials, mtime = self._read_credentials()
+        with self._lock:
+            self.credentials = credentials
+            http = google_auth_httplib2.AuthorizedHttp(
+                self.credentials,
+                http=httplib2.Http(timeout=GMAIL_TIMEOUT_SECONDS))
+            self.api_resource = build_from_document(_discovery_document(),
+                                                    http=http)
+            self.refresh_error = None
+            self._loaded_mtime = mtime
+
+    def reload_if_changed(self):
+        """Pick up a token file written by another process or a new authorization.
+
+        A refreshed access token (e.g. saved by the daemon) is copied into
+        the current credentials, so the Gmail resource and everything built
+        on it stay valid. Only a new refresh token or OAuth client, i.e. a
+        new authorization, rebuilds them; returns True in that case.
+        """
+        with self._lock:
+            if os.path.getmtime(self.token_file) == self._loaded_mtime:
+                return False
+            credentials, mtime = self._read_credentials()
+            current = self.credentials
+            if (credentials.refresh_token, credentials.client_id,
+                    credentials.client_secret) != (current.refresh_token,
+                                                   current.client_id,
+                                                   current.client_secret):
+                self._load()
+                return True
+            if credentials.expiry and (current.expiry is None
+                                       or credentials.expiry > current.expiry):
+                current.token = credentials.token
+                current.expiry = credentials.expiry
+            self._loaded_mtime = mtime
+            return False
+
+    def seconds_until_refresh(self):
+        """Return how long the current access token can be used before refreshing."""
+        with self._lock:
+            expiry = self.credentials.expiry
+            if not self.credentials.token or expiry is None:
+                return 0.0  # Unknown expiry: refresh to learn it
+        # google-auth keeps expiry as a naive UTC datetime
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+        return (expiry - now).total_seconds() - self.refresh_margin
+
+    def ensure_fresh(self):
+        """Refresh the access token now if it is close to expiring.
+
+        The network request is made without holding the state lock, so
+        reload_if_changed() never waits on it.
+        """
+        with self._refresh_lock:
+            if self.seconds_until_refresh() > 0:
+                return
+            with self._lock:
+                credentials = self.credentials
+            credentials.refresh(google_auth_httplib2.Request(
+                httplib2.Http(timeout=GMAIL_TIMEOUT_SECONDS)))
+            with self._lock:
+                if credentials is not self.credentials:
+                    return  # Replaced by a new authorization meanwhile
+                save_token(self.token_file, credentials)
+                self._loaded_mtime = os.path.getmtime(self.token_file)
+        logger.info("Refreshed the Gmail access token")
+
+    def _refresh_loop(self):
+        while not self._stop.wait(max(self.seconds_until_refresh(), 0.0)):
+            try:
+                self.ensure_fresh()
+            except RefreshError as e:
+                if not getattr(e, "retryable", False):
+                    logger.error("Gmail token refresh failed: %s", e)
+                    self.refresh_error = e
+                    return
+                logger.warning("Gmail token refresh failed, retrying: %s", e)
+                self._stop.wait(REFRESH_RETRY_SECONDS)
+            except Exception as e:
+                logger.warning("Gmail token refresh failed, retrying: %s", e)
+                self._stop.wait(REFRESH_RETRY_SECONDS)
+
+    def start(self):
+        """Keep the token fresh from a background thread until stop()."""
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._refresh_loop,
+                                        name="gmail-token-refresh",
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+def build_gmail_resource(token_file="token.json",
+                         client_secrets_file="credentials.json"):
+    """Build credentials and the Gmail API resource without any UI.
+
+    Expects an authorized ``token_file``, which is refreshed first if the
+    access token is about to expire; used by the headless triage daemon and
+    the account workers. The resource's HTTP client refreshes expired
+    tokens on its own afterwards.
+    """
+    manager = CredentialManager(token_file, client_secrets_file)
+    manager.ensure_fresh()
+    return manager.credentials, manager.api_resource
+
+@st.cache_resource(show_spinner=False)
+def get_credential_manager(token_file="token.json",
+                           client_secrets_file="credentials.json"):
+    """Return the app's credential manager, created once per process.
+
+    Reruns reuse its resource and pooled HTTP connection; the token is
+    kept fresh in the background instead of being checked on every rerun.
+    """
+    manager = CredentialManager(token_file, client_secrets_file)
+    manager.start()
+    return manager
+
+def initialize_gmail():
+    """Initialize Gmail credentials and API resource."""
+    try:
+        if not os.path.exists("credentials.json"):
+            st.error("credentials.json file not found. Please upload your Google API credentials.")
+            uploaded_file = st.file_uploader("Upload credentials.json", type="json")
+            if uploaded_file:
+                with open("credentials.json", "wb") as f:
+                    f.write(uploaded_file.getbuffer())
+                st.success("Credentials uploaded successfully!")
+                st.rerun()
+            return None, None
+
+        if not os.path.exists("token.json"):
+            st.warning("Gmail authentication required.")
+            # Create the flow using the client secrets file
+            flow = Flow.from_client_secrets_file(
+                'credentials.json',
+                scopes=['https://mail.google.com/'],
+                redirect_uri='urn:ietf:wg:oauth:2.0:oob'
+            )
+
+            auth_url, _ = flow.authorization_url(prompt='consent')
+
+            st.markdown(f"""
+            ### Gmail Authentication Required
+            1. Click the link below to authorize the application:
+            2. [Click here to authenticate with Gmail]({auth_url})
+            3. Copy the authorization code and paste it below:
+            """)
+
+            auth_code = st.text_input("Enter the authorization code:")
+            if auth_code:
+                flow.fetch_token(code=auth_code)
+                save_token("token.json", flow.credentials)
+                st.success("Authentication successful!")
+                st.rerun()
+            return None, None
+
+        manager = get_credential_manager()
+        # Picks up a token saved by the daemon or a new authorization; a
+        # stat() call unless the file changed
+        manager.reload_if_changed()
+        manager.start()  # Restarts refreshing after a reload
+        if manager.refresh_error:
+            raise manager.refresh_error
+        return manager.credentials, manager.api_resource
+    except RefreshError as e:
+        # Access was revoked or the refresh token expired: authorize again
+        st.error(f"Error initializing Gmail: {str(e)}")
+        if os.path.exists("token.json"):
+            os.remove("token.json")
+        st.warning("Authentication token expired. Please authenticate again.")
+        st.rerun()
+    except Exception as e:
+        st.error(f"Error initializing Gmail: {str(e)}")
+    return None, None
\ No newline at end of file
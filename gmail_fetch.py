@@ -0,0 +1,327 @@
+import base64
+import email
+from typing import NamedTuple
+
+from googleapiclient.errors import HttpError
+
+# History events that can change the set of unread messages we display.
+HISTORY_TYPES = ["messageAdded", "messageDeleted", "labelAdded", "labelRemoved"]
+# Labels whose addition means a message should drop out of the unread view.
+REMOVAL_LABELS = {"TRASH", "SPAM"}
+# Headers requested with format=metadata; enough to render and pre-sort mail.
+METADATA_HEADERS = [
+    "Subject", "From", "To", "Cc", "Date", "List-Unsubscribe", "List-Id",
+    "Precedence", "Auto-Submitted", "Importance", "X-Priority",
+    "In-Reply-To", "References", "Message-ID"
+]
+# Gmail allows at most 100 calls in one batch request.
+MAX_BATCH_SIZE = 100
+# messages.batchModify accepts at most 1000 message IDs per call.
+MAX_MODIFY_IDS = 1000
+# Gmail API quota units per call; each user may spend 250 units per second.
+QUOTA_UNITS = {
+    "messages.list": 5,
+    "messages.get": 5,
+    "history.list": 2,
+    "getProfile": 1,
+    "drafts.create": 10,
+    "messages.batchModify": 50,
+    "labels.list": 1,
+    "labels.create": 5
+}
+USER_QUOTA_PER_SECOND = 250
+
+
+def spend_quota(limiter, units):
+    """Wait on the per-account Gmail quota limiter, if there is one."""
+    if limiter is not None:
+        limiter.acquire_sync(units)
+
+
+class HistoryExpired(Exception):
+    """Raised when Gmail no longer has history for the stored historyId."""
+
+
+class SyncChanges(NamedTuple):
+    """Message IDs touched since a given historyId."""
+    changed_ids: list
+    removed_ids: list
+    history_id: str
+
+
+def _decode_part(part):
+    payload = part.get_payload(decode=True) or b""
+    return payload.decode(part.get_content_charset() or "utf-8",
+                          errors="replace")
+
+
+def parse_raw_message(message_data):
+    """Convert a ``format=raw`` messages.get response into a search result.
+
+    The returned dict has the same keys the Gmail search tool produces
+    (``id``, ``threadId``, ``subject``, ``sender``, ``body`` ...), with the
+    body left uncleaned so callers can run ``clean_email_body`` themselves.
+    """
+    raw = base64.urlsafe_b64decode(message_data["raw"].encode("ASCII"))
+    email_msg = email.message_from_bytes(raw)
+
+    body = ""
+    html_body = ""
+    for part in email_msg.walk():
+        if part.is_multipart():
+            continue
+        if "attachment" in str(part.get("Content-Disposition")):
+            continue
+        content_type = part.get_content_type()
+        if content_type == "text/plain" and not body:
+            body = _decode_part(part)
+        elif content_type == "text/html" and not html_body:
+            html_body = _decode_part(part)
+
+    return {
+        "id": message_data["id"],
+        "threadId": message_data.get("threadId"),
+        "labelIds": message_data.get("labelIds", []),
+        "snippet": message_data.get("snippet", ""),
+        "body": body or html_body,
+        "subject": email_msg["Subject"] or "",
+        "sender": email_msg["From"] or "",
+        "date": email_msg["Date"],
+        "messageId": email_msg["Message-ID"],
+    }
+
+
+def parse_metadata_message(message_data):
+    """Convert a ``format=metadata`` messages.get response into a search result.
+
+    The body is not part of a metadata response, so ``body`` is None until
+    the full message is fetched.
+    """
+    headers = {
+        header["name"].lower(): header["value"]
+        for header in message_data.get("payload", {}).get("headers", [])
+    }
+    return {
+        "id": message_data["id"],
+        "threadId": message_data.get("threadId"),
+        "labelIds": message_data.get("labelIds", []),
+        "snippet": message_data.get("snippet", ""),
+        "body": None,
+        "subject": headers.get("subject", ""),
+        "sender": headers.get("from", ""),
+        "date": headers.get("date"),
+        "messageId": headers.get("message-id"),
+        "headers": headers,
+    }
+
+
+class BatchFetcher:
+    """Fetch Gmail messages with one list call plus batched messages.get calls."""
+
+    def __init__(self,
+                 api_resource,
+                 user_id="me",
+                 batch_size=MAX_BATCH_SIZE,
+                 limiter=None):
+        self.api_resource = api_resource
+        self.user_id = user_id
+        self.batch_size = max(1, min(batch_size, MAX_BATCH_SIZE))
+        self.limiter = limiter  # TokenBucket counting Gmail quota units
+
+    def list_ids(self, query, max_results):
+        """Return up to ``max_results`` message IDs matching ``query``."""
+        message_ids = []
+        page_token = None
+        while len(message_ids) < max_results:
+            spend_quota(self.limiter, QUOTA_UNITS["messages.list"])
+            response = self.api_resource.users().messages().list(
+                userId=self.user_id,
+                q=query,
+                maxResults=min(500, max_results - len(message_ids)),
+                pageToken=page_token).execute()
+            message_ids.extend(
+                message["id"] for message in response.get("messages", []))
+            page_token = response.get("nextPageToken")
+            if not page_token:
+                break
+        return message_ids[:max_results]
+
+    def _batch_get(self, message_ids, **params):
+        """Run messages.get for every ID in batches; returns {id: response}.
+
+        Messages that no longer exist are skipped; any other per-message
+        failure is retried once individually before being raised.
+        """
+        responses, failed = {}, []
+
+        def callback(request_id, response, exception):
+            if exception is None:
+                responses[request_id] = response
+            elif getattr(getattr(exception, "resp", None), "status",
+                         None) != 404:
+                failed.append(request_id)
+
+        messages = self.api_resource.users().messages()
+        for start in range(0, len(message_ids), self.batch_size):
+            chunk = message_ids[start:start + self.batch_size]
+            batch = self.api_resource.new_batch_http_request(callback=callback)
+            for message_id in chunk:
+                batch.add(messages.get(userId=self.user_id,
+                                       id=message_id,
+                                       **params),
+                          request_id=message_id)
+            # Batched calls still count individually against the quota
+            spend_quota(self.limiter, QUOTA_UNITS["messages.get"] * len(chunk))
+            batch.execute()
+
+        for message_id in failed:
+            spend_quota(self.limiter, QUOTA_UNITS["messages.get"])
+            try:
+                responses[message_id] = messages.get(userId=self.user_id,
+                                                     id=message_id,
+                                                     **params).execute()
+            except HttpError as e:
+                if e.resp.status != 404:
+                    raise
+        return responses
+
+    def fetch_metadata(self, message_ids):
+        """Fetch headers and snippets only, preserving the order of IDs."""
+        responses = self._batch_get(message_ids,
+                                    format="metadata",
+                                    metadataHeaders=METADATA_HEADERS)
+        return [
+            parse_metadata_message(responses[message_id])
+            for message_id in message_ids if message_id in responses
+        ]
+
+    def fetch_full(self, message_ids):
+        """Fetch and parse full message bodies; returns {id: search result}."""
+        responses = self._batch_get(message_ids, format="raw")
+        return {
+            message_id: parse_raw_message(response)
+            for message_id, response in responses.items()
+        }
+
+
+class HistorySync:
+    """Incremental mailbox sync based on Gmail's ``users.history.list``."""
+
+    def __init__(self, api_resource, user_id="me", limiter=None):
+        self.api_resource = api_resource
+        self.user_id = user_id
+        self.limiter = limiter  # TokenBucket counting Gmail quota units
+
+    def current_history_id(self):
+        """Return the mailbox's latest historyId."""
+        spend_quota(self.limiter, QUOTA_UNITS["getProfile"])
+        profile = self.api_resource.users().getProfile(
+            userId=self.user_id).execute()
+        return profile["historyId"]
+
+    def changes_since(self, start_history_id):
+        """Collect unread messages added or changed since ``start_history_id``.
+
+        Messages that were deleted, trashed or marked as read are reported in
+        ``removed_ids``. Raises HistoryExpired if Gmail has discarded the
+        history for that ID and a full resync is required.
+        """
+        changed, removed = {}, {}
+        history_id = start_history_id
+        page_token = None
+        while True:
+            spend_quota(self.limiter, QUOTA_UNITS["history.list"])
+            try:
+                response = self.api_resource.users().history().list(
+                    userId=self.user_id,
+                    startHistoryId=start_history_id,
+                    historyTypes=HISTORY_TYPES,
+                    pageToken=page_token).execute()
+            except HttpError as e:
+                if e.resp.status == 404:
+                    raise HistoryExpired(start_history_id) from e
+                raise
+
+            for record in response.get("history", []):
+                for item in record.get("messagesAdded", []):
+                    message = item["message"]
+                    if "UNREAD" in message.get("labelIds", []):
+                        changed[message["id"]] = True
+                        removed.pop(message["id"], None)
+                for item in record.get("labelsAdded", []):
+                    message_id = item["message"]["id"]
+                    if REMOVAL_LABELS & set(item.get("labelIds", [])):
+                        removed[message_id] = True
+                        changed.pop(message_id, None)
+                    elif "UNREAD" in item.get("labelIds", []):
+                        changed[message_id] = True
+                        removed.pop(message_id, None)
+                for item in record.get("labelsRemoved", []):
+                    if "UNREAD" in item.get("labelIds", []):
+                        message_id = item["message"]["id"]
+                        removed[message_id] = True
+                        changed.pop(message_id, None)
+                for item in record.get("messagesDeleted", []):
+                    message_id = item["message"]["id"]
+                    removed[message_id] = True
+                    changed.pop(message_id, None)
+
+            history_id = response.get("historyId", history_id)
+            page_token = response.get("nextPageToken")
+            if not page_token:
+                break
+
+        return SyncChanges(list(changed), list(removed), history_id)
+
+
+class LabelModifier:
+    """Change the labels of many messages with ``users.messages.batchModify``.
+
+    Archiving, marking as read and labelling are all label changes, so one
+    call handles up to MAX_MODIFY_IDS messages.
+    """
+
+    def __init__(self, api_resource, user_id="me", limiter=None):
+        self.api_resource = api_resource
+        self.user_id = user_id
+        self.limiter = limiter  # TokenBucket counting Gmail quota units
+        self._label_ids = None  # label name -> ID
+
+    def label_id(self, name):
+        """Return the ID of the label called ``name``, creating it if needed.
+
+        System labels such as INBOX or UNREAD are their own ID.
+        """
+        labels = self.api_resource.users().labels()
+        if self._label_ids is None:
+            spend_quota(self.limiter, QUOTA_UNITS["labels.list"])
+            response = labels.list(userId=self.user_id).execute()
+            self._label_ids = {
+                label["name"]: label["id"]
+                for label in response.get("labels", [])
+            }
+        if name not in self._label_ids:
+            spend_quota(self.limiter, QUOTA_UNITS["labels.create"])
+            label = labels.create(userId=self.user_id,
+                                  body={
+                                      "name": name,
+                                      "labelListVisibility": "labelShow",
+                                      "messageListVisibility": "show"
+                                  }).execute()
+            self._label_ids[name] = label["id"]
+        return self._label_ids[name]
+
+    def batch_modify(self, message_ids, add_label_ids=(), remove_label_ids=()):
+        """Add and remove label IDs on every message; returns the number of calls."""
+        calls = 0
+        for start in range(0, len(message_ids), MAX_MODIFY_IDS):
+            spend_quota(self.limiter, QUOTA_UNITS["messages.batchModify"])
+            self.api_resource.users().messages().batchModify(
+                userId=self.user_id,
+                body={
+                    "ids": message_ids[start:start + MAX_MODIFY_IDS],
+                    "addLabelIds": list(add_label_ids),
+                    "removeLabelIds": list(remove_label_ids)
+                }).execute()
+            calls += 1
+        return calls
@@ -0,0 +1,181 @@
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+# A JSON-lines file past this size is moved to "<path>.1" before appending
+MAX_JSONL_BYTES = 10 * 2**20
+
+
+def _percentile(values, percent):
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, int(round(percent / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def _escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"')
+
+
+class PipelineMetrics:
+    """Per-stage timings, token usage and event counters for one refresh.
+
+    Spans are recorded per email (``email_id``) and per stage, e.g.
+    ``gmail_metadata``, ``clean_body`` or ``llm_triage``. Counters track
+    events such as retries, cache hits and fused-triage fallbacks, and
+    LLM token usage and cost are tracked per stage.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Start a new run."""
+        with self._lock:
+            self.started_at = time.time()
+            self.spans = []
+            self.counters = defaultdict(int)
+            self.tokens = defaultdict(int)
+            self.cost = defaultdict(float)  # USD per stage
+
+    @contextmanager
+    def span(self, stage, email_id=None):
+        """Time the enclosed block as ``stage``."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - started, email_id)
+
+    def record(self, stage, seconds, email_id=None):
+        with self._lock:
+            self.spans.append({
+                "stage": stage,
+                "email_id": email_id,
+                "seconds": seconds
+            })
+
+    def incr(self, name, amount=1):
+        with self._lock:
+            self.counters[name] += amount
+
+    def add_usage(self, stage, message, cost=0.0):
+        """Add token usage from an LLM response message, if it reports any.
+
+        ``cost`` is the price of the call in USD.
+        """
+        usage = getattr(message, "usage_metadata", None) or {}
+        with self._lock:
+            for key in ("input_tokens", "output_tokens"):
+                self.tokens[key] += usage.get(key, 0)
+                self.tokens[f"{stage}.{key}"] += usage.get(key, 0)
+            self.cost[stage] += cost
+
+    def stage_summary(self):
+        """Return {stage: {count, total_ms, mean_ms, p95_ms}}."""
+        with self._lock:
+            by_stage = defaultdict(list)
+            for span in self.spans:
+                by_stage[span["stage"]].append(span["seconds"] * 1000)
+        return {
+            stage: {
+                "count": len(values),
+                "total_ms": round(sum(values), 1),
+                "mean_ms": round(sum(values) / len(values), 1),
+                "p95_ms": round(_percentile(values, 95), 1)
+            }
+            for stage, values in by_stage.items()
+        }
+
+    def per_email(self):
+        """Return {email_id: {stage: ms}} for spans tied to a single email."""
+        with self._lock:
+            spans = list(self.spans)
+        breakdown = defaultdict(lambda: defaultdict(float))
+        for span in spans:
+            if span["email_id"] is not None:
+                breakdown[span["email_id"]][span["stage"]] += round(
+                    span["seconds"] * 1000, 1)
+        return {email_id: dict(stages) for email_id, stages in breakdown.items()}
+
+    def summary(self):
+        """Return a JSON-serializable snapshot of the run."""
+        with self._lock:
+            counters = dict(self.counters)
+            tokens = dict(self.tokens)
+            cost = {stage: round(usd, 6) for stage, usd in self.cost.items()}
+        return {
+            "started_at": self.started_at,
+            "duration_s": round(time.time() - self.started_at, 3),
+            "stages": self.stage_summary(),
+            "counters": counters,
+            "tokens": tokens,
+            "cost_usd": cost,
+        }
+
+    def write_jsonl(self, path, spans=False, max_bytes=MAX_JSONL_BYTES):
+        """Append a summary record of the run to ``path`` as JSON lines.
+
+        With ``spans`` every span is written too. Once the file reaches
+        ``max_bytes`` it is moved to ``<path>.1``, replacing the previous
+        one, so at most two files' worth of history is kept.
+        """
+        run_id = f"{self.started_at:.3f}"
+        with self._lock:
+            spans = list(self.spans) if spans else []
+        if max_bytes and os.path.exists(path) and os.path.getsize(
+                path) >= max_bytes:
+            os.replace(path, f"{path}.1")
+        with open(path, "a") as f:
+            for span in spans:
+                f.write(json.dumps({"type": "span", "run": run_id, **span}) +
+                        "\n")
+            f.write(
+                json.dumps({
+                    "type": "summary",
+                    "run": run_id,
+                    **self.summary()
+                }) + "\n")
+
+    def to_prometheus(self, prefix="email_assistant"):
+        """Render the run in the Prometheus text exposition format."""
+        lines = [
+            f"# TYPE {prefix}_stage_seconds summary",
+        ]
+        for stage, stats in sorted(self.stage_summary().items()):
+            label = f'stage="{_escape_label(stage)}"'
+            lines.append(f"{prefix}_stage_seconds_sum{{{label}}} "
+                         f"{stats['total_ms'] / 1000:.6f}")
+            lines.append(
+                f"{prefix}_stage_seconds_count{{{label}}} {stats['count']}")
+        summary = self.summary()
+        lines.append(f"# TYPE {prefix}_tokens_total counter")
+        for key, value in sorted(summary["tokens"].items()):
+            stage, _, direction = key.rpartition(".")
+            direction = direction.replace("_tokens", "")
+            if not stage:
+                continue  # Totals are the sum over the per-stage series
+            labels = (f'stage="{_escape_label(stage)}",'
+                      f'direction="{_escape_label(direction)}"')
+            lines.append(f"{prefix}_tokens_total{{{labels}}} {value}")
+        lines.append(f"# TYPE {prefix}_cost_usd_total counter")
+        for stage, value in sorted(summary["cost_usd"].items()):
+            lines.append(f'{prefix}_cost_usd_total{{stage="{_escape_label(stage)}"}} '
+                         f"{value:.6f}")
+        lines.append(f"# TYPE {prefix}_events_total counter")
+        for name, value in sorted(summary["counters"].items()):
+            lines.append(f'{prefix}_events_total{{event="{_escape_label(name)}"}} '
+                         f"{value}")
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path):
+        """Write the Prometheus text format to ``path`` (textfile collector)."""
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(self.to_prometheus())
+        os.replace(tmp_path, path)
@@ -0,0 +1,106 @@
+from typing import NamedTuple
+
+from langchain_groq import ChatGroq
+
+SMALL_MODEL = "llama-3.1-8b-instant"
+LARGE_MODEL = "llama-3.3-70b-versatile"
+
+# Groq list prices in USD per million (input, output) tokens
+MODEL_PRICES = {
+    "llama-3.1-8b-instant": (0.05, 0.08),
+    "llama-3.3-70b-versatile": (0.59, 0.79),
+}
+
+
+class Route(NamedTuple):
+    """Model settings for one chain."""
+    model: str
+    temperature: float
+    max_tokens: int
+    # Larger model asked again when the answer can't be parsed or isn't a
+    # valid label; None disables escalation
+    escalate_to: str = None
+
+
+# Labels come from a small deterministic model, so identical emails get
+# identical (cacheable) results; only drafts need the larger model.
+DEFAULT_ROUTES = {
+    "category": Route(SMALL_MODEL, 0.0, 5, escalate_to=LARGE_MODEL),
+    "urgency": Route(SMALL_MODEL, 0.0, 8, escalate_to=LARGE_MODEL),
+    "summary": Route(SMALL_MODEL, 0.0, 60),
+    "triage": Route(SMALL_MODEL, 0.0, 200, escalate_to=LARGE_MODEL),
+    "draft": Route(LARGE_MODEL, 0.7, 500),
+}
+
+
+class ModelRouter:
+    """Pick the chat model for each chain (route) and price its usage.
+
+    ``routes`` overrides entries of DEFAULT_ROUTES by name and ``prices``
+    entries of MODEL_PRICES by model. One Groq client is built per distinct
+    model, temperature and max_tokens, so routes with the same settings
+    share it. ``llm`` replaces every model, e.g. with a stub for offline
+    benchmarks.
+    """
+
+    def __init__(self,
+                 routes=None,
+                 api_key=None,
+                 timeout=60.0,
+                 llm=None,
+                 prices=None):
+        self.routes = {**DEFAULT_ROUTES, **(routes or {})}
+        self.prices = {**MODEL_PRICES, **(prices or {})}
+        self.api_key = api_key
+        self.timeout = timeout
+        self._llm = llm
+        self._models = {}
+
+    def can_escalate(self, route):
+        return self.routes[route].escalate_to is not None
+
+    def model_name(self, route, escalated=False):
+        """Return the name of the model that serves ``route``."""
+        if self._llm is not None:
+            return self._llm.model_name
+        settings = self.routes[route]
+        return settings.escalate_to if escalated else settings.model
+
+    def llm(self, route, escalated=False):
+        """Return the chat model for ``route``, or its escalation model."""
+        if self._llm is not None:
+            return self._llm
+        settings = self.routes[route]
+        key = (self.model_name(route, escalated), settings.temperature,
+               settings.max_tokens)
+        if key not in self._models:
+            model, temperature, max_tokens = key
+            self._models[key] = ChatGroq(
+                model=model,
+                temperature=temperature,
+                max_tokens=max_tokens,
+                api_key=self.api_key,
+                timeout=self.timeout,
+                max_retries=0)  # Retries are handled by the caller
+        return self._models[key]
+
+    def fingerprint(self, routes):
+        """Describe the settings of ``routes``, for cache versioning."""
+        parts = []
+        for route in routes:
+            settings = self.routes[route]
+            parts.append(f"{route}={self.model_name(route)},"
+                         f"{settings.temperature},{settings.max_tokens},"
+                         f"{self.model_name(route, escalated=True)}")
+        return ";".join(parts)
+
+    def cost(self, route, message, escalated=False):
+        """Return the USD cost of an LLM response message on ``route``.
+
+        Models without a known price cost nothing.
+        """
+        usage = getattr(message, "usage_metadata", None) or {}
+        input_price, output_price = self.prices.get(
+            self.model_name(route, escalated), (0.0, 0.0))
+        return (usage.get("input_tokens", 0) * input_price +
+                usage.get("output_tokens", 0) * output_price) / 1e6
@@ -0,0 +1,142 @@
+import json
+import logging
+import os
+import re
+import threading
+from collections import Counter
+from email.utils import parseaddr
+
+from file_utils import write_atomic
+
+logger = logging.getLogger(__name__)
+
+# Score added for each Gmail label; user-applied labels weigh the most
+LABEL_WEIGHTS = {
+    "STARRED": 3.0,
+    "IMPORTANT": 2.0,
+    "CATEGORY_PERSONAL": 1.0,
+    "CATEGORY_UPDATES": -1.0,
+    "CATEGORY_FORUMS": -1.0,
+    "CATEGORY_SOCIAL": -1.5,
+    "CATEGORY_PROMOTIONS": -2.0,
+    "SPAM": -3.0
+}
+URGENT_LEVELS = ("Urgent", "High")
+_URGENT_SUBJECT = re.compile(
+    r"\b(urgent|asap|immediately|deadline|action required|overdue|"
+    r"final notice|outage|eod)\b", re.IGNORECASE)
+_BULK_HEADERS = ("list-unsubscribe", "list-id", "auto-submitted")
+
+
+def _address(sender):
+    return parseaddr(sender or "")[1].lower()
+
+
+class Prioritizer:
+    """Rank messages for triage using only metadata, before any LLM work.
+
+    Signals are Gmail labels (starred, important, inbox category), priority
+    and bulk-mail headers, replies in an ongoing thread, urgent words in
+    the subject and how often the sender's past mail was urgent. The sender
+    history is learnt from LLM results and persisted at ``path`` (None
+    keeps it in memory only). Processes sharing ``path`` each add their
+    own counts to it on save, so none overwrites the others'.
+    """
+
+    def __init__(self, path="sender_history.json"):
+        self.path = path
+        # address -> [emails triaged, urgent or high]
+        self.senders = self._read()
+        self._unsaved = {}  # counts recorded since the last save
+        self._lock = threading.Lock()
+
+    def _read(self):
+        if not self.path or not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}  # Start from scratch if the saved history is unreadable
+
+    def save(self):
+        """Add the counts recorded since the last save to the stored history.
+
+        Errors are logged rather than raised; the counts are kept and saved
+        next time.
+        """
+        if not self.path:
+            return
+        with self._lock:
+            if not self._unsaved:
+                return
+            senders = self._read()
+            for address, (total, urgent) in self._unsaved.items():
+                counts = senders.setdefault(address, [0, 0])
+                counts[0] += total
+                counts[1] += urgent
+            try:
+                write_atomic(self.path, json.dumps(senders))
+            except OSError as e:
+                logger.warning("Could not save the sender history: %s", e)
+                return
+            # Also picks up what other processes recorded meanwhile
+            self.senders = senders
+            self._unsaved = {}
+
+    def record(self, result, urgency):
+        """Learn how urgent mail from this message's sender tends to be."""
+        address = _address(result.get("sender"))
+        if not address:
+            return
+        urgent = int(urgency in URGENT_LEVELS)
+        with self._lock:
+            for senders in (self.senders, self._unsaved):
+                counts = senders.setdefault(address, [0, 0])
+                counts[0] += 1
+                counts[1] += urgent
+
+    def score(self, result, thread_size=1):
+        """Return a priority score for a message; higher is triaged sooner.
+
+        ``thread_size`` is how many of the messages being ranked share its
+        thread.
+        """
+        labels = result.get("labelIds") or []
+        headers = result.get("headers") or {}
+        score = sum(LABEL_WEIGHTS.get(label, 0.0) for label in labels)
+
+        if (headers.get("importance", "").strip().lower() == "high"
+                or headers.get("x-priority", "").strip()[:1] in ("1", "2")):
+            score += 2.0
+        if any(name in headers for name in _BULK_HEADERS):
+            score -= 1.5
+        # A reply in a conversation, or a thread with several new messages
+        if "in-reply-to" in headers or "references" in headers:
+            score += 1.5
+        score += min(thread_size - 1, 3) * 0.5
+        if _URGENT_SUBJECT.search(result.get("subject") or ""):
+            score += 2.0
+
+        with self._lock:
+            total, urgent = self.senders.get(_address(result.get("sender")),
+                                             (0, 0))
+        # Smoothed towards "not urgent" so one urgent email isn't decisive
+        score += 3.0 * urgent / (total + 2)
+        return score
+
+    def rank(self, results, positions=None):
+        """Return ``positions`` in ``results`` (default: all) by descending score.
+
+        Ties keep their original (Gmail) order.
+        """
+        if positions is None:
+            positions = range(len(results))
+        thread_sizes = Counter(results[pos].get("threadId") for pos in positions)
+        scores = {
+            pos: self.score(results[pos],
+                            thread_sizes[results[pos].get("threadId")]
+                            if results[pos].get("threadId") else 1)
+            for pos in positions
+        }
+        return sorted(positions, key=lambda pos: -scores[pos])
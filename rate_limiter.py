@@ -0,0 +1,118 @@
+import asyncio
+import multiprocessing
+import threading
+import time
+
+
+def is_rate_limited(error):
+    """Return True if the exception looks like an HTTP 429 from the backend."""
+    status = getattr(error, "status_code", None)
+    if status is None:
+        status = getattr(getattr(error, "resp", None), "status", None)
+    if status is not None:
+        return int(status) == 429
+    message = str(error).lower()
+    return "429" in message or "rate limit" in message
+
+
+def retry_after_seconds(error):
+    """Extract the Retry-After hint (in seconds) from an error, if present."""
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucket:
+    """Token-bucket rate limiter that backs off when the backend returns 429.
+
+    Tokens refill at ``rate`` per second up to ``capacity``. Every 429 halves
+    the rate (never below ``min_rate``) and pauses the bucket; every success
+    nudges the rate back towards its configured maximum.
+    """
+
+    def __init__(self, rate=5.0, capacity=None, min_rate=0.5):
+        self.max_rate = float(rate)
+        self.rate = float(rate)
+        self.min_rate = min(float(min_rate), self.max_rate)
+        self.capacity = capacity or max(1, int(rate))
+        self._tokens = float(self.capacity)
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def _reserve(self, cost=1):
+        """Take ``cost`` tokens if available, else return seconds to wait.
+
+        A cost above ``capacity`` is let through once the bucket is full and
+        leaves it in debt, so large requests still count in full.
+        """
+        with self._lock:
+            now = time.monotonic()
+            if now < self._blocked_until:
+                return self._blocked_until - now
+            self._tokens = min(self.capacity,
+                               self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            needed = min(cost, self.capacity)
+            if self._tokens >= needed:
+                self._tokens -= cost
+                return 0.0
+            return (needed - self._tokens) / self.rate
+
+    async def acquire(self, cost=1):
+        """Wait asynchronously until a request may be sent."""
+        while True:
+            wait = self._reserve(cost)
+            if wait <= 0:
+                return
+            await asyncio.sleep(wait)
+
+    def acquire_sync(self, cost=1):
+        """Block the calling thread until a request may be sent."""
+        while True:
+            wait = self._reserve(cost)
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+    def penalize(self, retry_after=None):
+        """Back off after a 429: halve the rate and pause the bucket."""
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self._tokens = 0.0
+            pause = retry_after if retry_after else 1.0 / self.rate
+            self._blocked_until = max(self._blocked_until,
+                                      time.monotonic() + pause)
+
+    def reward(self):
+        """Recover the rate additively after a successful request."""
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate * 0.1)
+
+
+def _shared_field(index):
+    return property(lambda self: self._shared[index],
+                    lambda self, value: self._shared.__setitem__(index, value))
+
+
+class SharedTokenBucket(TokenBucket):
+    """TokenBucket whose state lives in shared memory.
+
+    Pass it to worker processes when they are created (e.g. through a
+    process pool initializer) and they all draw from one budget, so a
+    global rate limit holds however many workers run. ``context`` must be
+    the multiprocessing context the workers are started with.
+    """
+    rate = _shared_field(0)
+    _tokens = _shared_field(1)
+    _updated = _shared_field(2)
+    _blocked_until = _shared_field(3)
+
+    def __init__(self, rate=5.0, capacity=None, min_rate=0.5, context=None):
+        context = context or multiprocessing.get_context()
+        self._shared = context.RawArray("d", 4)
+        super().__init__(rate, capacity, min_rate)
+        self._lock = context.Lock()
@@ -0,0 +1,201 @@
+import asyncio
+import random
+import socket
+import threading
+import time
+
+from rate_limiter import is_rate_limited, retry_after_seconds
+
+# Gmail reports per-user rate limits as 403s with one of these reasons.
+_GMAIL_RATE_LIMIT_REASONS = ("rateLimitExceeded", "userRateLimitExceeded")
+
+
+class CircuitOpen(Exception):
+    """Raised instead of calling a backend whose circuit breaker is open."""
+
+
+def _status_code(error):
+    status = getattr(error, "status_code", None)
+    if status is None:
+        status = getattr(getattr(error, "resp", None), "status", None)
+    try:
+        return int(status) if status is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+def is_transient(error):
+    """Return True for failures worth retrying: 429s, 5xx and timeouts."""
+    if isinstance(error, CircuitOpen):
+        return False
+    if isinstance(error, (TimeoutError, asyncio.TimeoutError, socket.timeout,
+                          ConnectionError)):
+        return True
+    status = _status_code(error)
+    if status == 403:
+        return any(reason in str(error) for reason in _GMAIL_RATE_LIMIT_REASONS)
+    if status is not None:
+        return status == 429 or status >= 500
+    return is_rate_limited(error)
+
+
+def backoff_delay(attempt, base_delay=0.5, max_delay=20.0, retry_after=None):
+    """Return a full-jitter exponential delay for retry number ``attempt``.
+
+    A server-provided ``retry_after`` is used as the lower bound.
+    """
+    delay = random.uniform(0, min(max_delay, base_delay * 2**attempt))
+    return max(delay, retry_after or 0.0)
+
+
+class CircuitBreaker:
+    """Stops calling a backend after repeated transient failures.
+
+    After ``failure_threshold`` consecutive failures the circuit opens and
+    calls fail fast with CircuitOpen for ``reset_timeout`` seconds. Then a
+    single trial call is let through: success closes the circuit, failure
+    opens it again.
+    """
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self._opened_at = None
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        with self._lock:
+            return self._opened_at is not None
+
+    def before_call(self):
+        """Raise CircuitOpen unless a call may be made now.
+
+        Returns True if the call is the trial call of an open circuit.
+        """
+        with self._lock:
+            if self._opened_at is None:
+                return False
+            remaining = self._opened_at + self.reset_timeout - time.monotonic()
+            if remaining > 0 or self._trial_running:
+                raise CircuitOpen(f"{self.name} is unavailable after repeated "
+                                  "failures; calls are paused")
+            self._trial_running = True
+            return True
+
+    def release_trial(self):
+        """Let another trial call through after one ended without an answer.
+
+        For a trial call that was cancelled or interrupted: it says nothing
+        about the backend, so it counts as neither success nor failure.
+        """
+        with self._lock:
+            self._trial_running = False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self._opened_at = None
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._trial_running or self.failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+            self._trial_running = False
+
+
+class RetryPolicy:
+    """Timeouts, jittered exponential retries and a circuit breaker for one backend.
+
+    Transient failures (429, 5xx, timeouts, dropped connections) are
+    retried up to ``max_retries`` times and count towards the circuit
+    breaker; other errors are raised straight away. Calls that must not be
+    repeated once the backend may have acted on them (e.g. creating a
+    draft) pass ``idempotent=False`` and are only retried on 429s.
+    """
+
+    def __init__(self,
+                 name,
+                 timeout=30.0,
+                 max_retries=3,
+                 base_delay=0.5,
+                 max_delay=20.0,
+                 breaker=None,
+                 on_retry=None):
+        self.name = name
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.breaker = breaker or CircuitBreaker(name)
+        self.on_retry = on_retry  # Called with each error that is retried
+
+    def should_retry(self, error, attempt, idempotent=True):
+        """Return True if a call that failed with ``error`` may be retried."""
+        if attempt >= self.max_retries:
+            return False
+        if not idempotent:
+            return is_rate_limited(error)
+        return is_transient(error)
+
+    def backoff(self, attempt, error=None):
+        """Return how long to wait before retry number ``attempt``."""
+        retry_after = retry_after_seconds(error) if error is not None else None
+        return backoff_delay(attempt, self.base_delay, self.max_delay,
+                             retry_after)
+
+    def _record(self, error):
+        # Any answer other than a transient failure means the backend is up
+        if error is not None and is_transient(error):
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+
+    async def attempt(self, func, *args):
+        """Await ``func(*args)`` once, guarded by the breaker and the timeout."""
+        trial = self.breaker.before_call()
+        try:
+            result = await asyncio.wait_for(func(*args), self.timeout)
+        except Exception as e:
+            self._record(e)
+            raise
+        except BaseException:
+            # Cancelled, e.g. by asyncio; don't leave the circuit stuck open
+            if trial:
+                self.breaker.release_trial()
+            raise
+        self._record(None)
+        return result
+
+    def call(self, func, *args, idempotent=True):
+        """Call ``func(*args)``, retrying transient failures with backoff.
+
+        Synchronous calls can't be interrupted, so their timeout has to be
+        set on the underlying client (see gmail_auth.GMAIL_TIMEOUT_SECONDS).
+        """
+        attempt = 0
+        while True:
+            trial = self.breaker.before_call()
+            try:
+                result = func(*args)
+            except Exception as e:
+                self._record(e)
+                if not self.should_retry(e, attempt, idempotent):
+                    raise
+                attempt += 1
+                if self.on_retry:
+                    self.on_retry(e)
+                time.sleep(self.backoff(attempt, e))
+                continue
+            except BaseException:
+                # Interrupted, e.g. by Ctrl+C; there is no answer to record
+                if trial:
+                    self.breaker.release_trial()
+                raise
+            self._record(None)
+            return result
@@ -0,0 +1,102 @@
+import json
+import sqlite3
+import threading
+import time
+
+
+def merge_emails(existing, updates, removed_ids, matching_ids=None):
+    """Merge incrementally synced emails into the current list, newest first.
+
+    With ``matching_ids`` (see SyncResult) only emails that still match the
+    sync query are kept, in that order.
+    """
+    dropped = {email['id'] for email in updates} | set(removed_ids)
+    merged = updates + [email for email in existing if email.get('id') not in dropped]
+    if matching_ids is None:
+        return merged
+    order = {message_id: position for position, message_id in enumerate(matching_ids)}
+    return sorted((email for email in merged if email['id'] in order),
+                  key=lambda email: order[email['id']])
+
+
+class ResultsStore:
+    """Local SQLite snapshot of the latest triaged emails.
+
+    The background daemon (or the app itself) writes each refresh here and
+    the dashboard reads it on load, so the page renders without waiting for
+    Gmail or the LLM. Email bodies are not stored; drafts load them lazily.
+    Alongside the emails the store keeps the Gmail historyId and query the
+    snapshot belongs to, so incremental syncs can continue from it, plus
+    the run statistics shown in the UI.
+    """
+
+    def __init__(self, path="triage_results.db"):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        # WAL lets the dashboard read while the daemon writes
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS emails (
+                id TEXT PRIMARY KEY,
+                position INTEGER NOT NULL,
+                data TEXT NOT NULL
+            )""")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS state (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL
+            )""")
+        self._conn.commit()
+
+    def save(self, emails, history_id=None, query=None, stats=None,
+             source="app"):
+        """Replace the snapshot with ``emails``; returns its update time."""
+        updated_at = time.time()
+        state = {
+            "history_id": history_id,
+            "query": query,
+            "stats": stats or {},
+            "source": source,
+            "updated_at": updated_at
+        }
+        rows = [(email['id'], position,
+                 json.dumps({**email, 'body': None}))
+                for position, email in enumerate(emails)]
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM emails")
+            self._conn.executemany("INSERT INTO emails VALUES (?, ?, ?)", rows)
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO state VALUES (?, ?)",
+                [(key, json.dumps(value)) for key, value in state.items()])
+        return updated_at
+
+    def _state(self, key):
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM state WHERE key = ?",
+                                     (key, )).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def updated_at(self):
+        """Return when the snapshot was last written, or None if never."""
+        return self._state("updated_at")
+
+    def query(self):
+        """Return the Gmail query of the stored snapshot, or None."""
+        return self._state("query")
+
+    def load(self):
+        """Return the snapshot as a dict, or None if nothing was saved yet.
+
+        The dict has the keys emails, history_id, query, stats, source and
+        updated_at.
+        """
+        with self._lock:
+            state = dict(self._conn.execute("SELECT key, value FROM state"))
+            rows = self._conn.execute(
+                "SELECT data FROM emails ORDER BY position").fetchall()
+        if "updated_at" not in state:
+            return None
+        snapshot = {key: json.loads(value) for key, value in state.items()}
+        snapshot["emails"] = [json.loads(row[0]) for row in rows]
+        return snapshot
@@ -0,0 +1,136 @@
+import hashlib
+import sqlite3
+import threading
+import time
+
+
+def content_hash(text):
+    """Return a stable hash of an email body."""
+    return hashlib.sha256(text.encode("utf-8", errors="replace")).hexdigest()
+
+
+class TriageCache:
+    """Disk-backed cache of triage results.
+
+    Entries are keyed by Gmail message ID, a hash of the cleaned body and the
+    prompt/model version, so a changed body or prompt never returns a stale
+    result. Entries expire after ``ttl_seconds`` and the least recently used
+    ones are evicted once the cache holds more than ``max_entries``.
+    """
+
+    def __init__(self,
+                 path="triage_cache.db",
+                 max_entries=5000,
+                 ttl_seconds=7 * 24 * 3600):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS triage (
+                message_id TEXT NOT NULL,
+                content_hash TEXT NOT NULL,
+                version TEXT NOT NULL,
+                category TEXT NOT NULL,
+                urgency TEXT NOT NULL,
+                summary TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                last_access REAL NOT NULL,
+                group_id TEXT,
+                PRIMARY KEY (message_id, content_hash, version)
+            )""")
+        columns = {row[1] for row in self._conn.execute(
+            "PRAGMA table_info(triage)")}
+        if "group_id" not in columns:  # Caches created before deduplication
+            self._conn.execute("ALTER TABLE triage ADD COLUMN group_id TEXT")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_triage_access "
+                           "ON triage (last_access)")
+        self._conn.commit()
+
+    def _lookup(self, where, params):
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT rowid, category, urgency, summary, created_at, group_id "
+                f"FROM triage WHERE {where} ORDER BY created_at DESC LIMIT 1",
+                params).fetchone()
+            if row is None or now - row[4] > self.ttl_seconds:
+                self.misses += 1
+                return None
+            self._conn.execute(
+                "UPDATE triage SET last_access = ? WHERE rowid = ?",
+                (now, row[0]))
+            self._conn.commit()
+            self.hits += 1
+        return {
+            "category": row[1],
+            "urgency": row[2],
+            "summary": row[3],
+            "group_id": row[5]
+        }
+
+    def get(self, message_id, body_hash, version):
+        """Return the cached triage dict, or None on a miss."""
+        return self._lookup(
+            "message_id = ? AND content_hash = ? AND version = ?",
+            (message_id, body_hash, version))
+
+    def get_by_message(self, message_id, version):
+        """Return the newest cached triage for a message, whatever its body hash.
+
+        Gmail message bodies are immutable, so this lets callers skip
+        downloading the body of a message that was already triaged.
+        """
+        return self._lookup("message_id = ? AND version = ?",
+                            (message_id, version))
+
+    def put(self,
+            message_id,
+            body_hash,
+            version,
+            category,
+            urgency,
+            summary,
+            group_id=None):
+        """Store a triage result; ``group_id`` links deduplicated messages."""
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO triage (message_id, content_hash, "
+                "version, category, urgency, summary, created_at, last_access, "
+                "group_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (message_id, body_hash, version, category, urgency, summary,
+                 now, now, group_id))
+            self._conn.commit()
+
+    def evict(self):
+        """Drop expired entries and trim the cache to ``max_entries``."""
+        with self._lock:
+            self._conn.execute("DELETE FROM triage WHERE created_at < ?",
+                               (time.time() - self.ttl_seconds, ))
+            self._conn.execute(
+                "DELETE FROM triage WHERE rowid IN (SELECT rowid FROM triage "
+                "ORDER BY last_access DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries, ))
+            self._conn.commit()
+
+    def stats(self):
+        """Return hit/miss counters and the current number of entries."""
+        with self._lock:
+            entries = self._conn.execute(
+                "SELECT COUNT(*) FROM triage").fetchone()[0]
+        return {"hits": self.hits, "misses": self.misses, "entries": entries}
+
+    def reset_stats(self):
+        """Reset the hit/miss counters, e.g. at the start of a refresh."""
+        self.hits = 0
+        self.misses = 0
+
+    def clear(self):
+        """Remove every cached entry."""
+        with self._lock:
+            self._conn.execute("DELETE FROM triage")
+            self._conn.commit()
@@ -0,0 +1,116 @@
+"""Triage the inbox on a schedule, without the Streamlit UI.
+
+Each run syncs Gmail incrementally from the last stored historyId, triages
+new mail and writes the result to the local results store that the
+dashboard reads, so the page loads instantly and stays current whether or
+not it is open. Authorize once through the app first to create token.json.
+
+    python triage_daemon.py --interval 300
+    python triage_daemon.py --once
+"""
+import argparse
+import logging
+import os
+import signal
+import threading
+
+from email_processor import EmailProcessor
+from gmail_auth import CredentialManager
+from results_store import ResultsStore, merge_emails
+
+logger = logging.getLogger("triage_daemon")
+
+
+def run_once(processor, store, query, max_results):
+    """Sync and triage once, saving the merged result; returns True on success."""
+    snapshot = store.load()
+    # A stored historyId is only valid for the query it was taken with
+    history_id = (snapshot['history_id']
+                  if snapshot and snapshot['query'] == query else None)
+    result = processor.sync_emails(
+        history_id=history_id,
+        query=query,
+        max_results=max_results,
+        known_ids=[email['id'] for email in snapshot['emails']]
+        if history_id else None)
+    if result is None:
+        return False
+
+    if result.full_resync:
+        emails = result.emails
+    else:
+        emails = merge_emails(snapshot['emails'], result.emails,
+                              result.removed_ids, result.matching_ids)
+    store.save(emails,
+               history_id=result.history_id,
+               query=query,
+               stats=processor.run_stats(),
+               source="daemon")
+    logger.info("%s: %d new or changed, %d removed, %d stored (%.1f s)",
+                "Full sync" if result.full_resync else "Incremental sync",
+                len(result.emails), len(result.removed_ids), len(emails),
+                processor.metrics.summary()['duration_s'])
+    return True
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--query",
+                        default="is:unread newer_than:2d category:primary",
+                        help="Gmail search query to triage")
+    parser.add_argument("--max-results", type=int, default=50)
+    parser.add_argument("--interval", type=float, default=300.0,
+                        help="seconds between runs")
+    parser.add_argument("--once", action="store_true",
+                        help="run a single triage pass and exit")
+    parser.add_argument("--store", default="triage_results.db",
+                        help="results store read by the dashboard")
+    parser.add_argument("--token", default="token.json")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--separate-chains", action="store_true",
+                        help="disable fused triage")
+    parser.add_argument("--prometheus", metavar="PATH",
+                        help="also write metrics in the Prometheus text format")
+    parser.add_argument("--log-level", default="INFO")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=args.log_level.upper(),
+                        format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    if not os.path.exists(args.token):
+        parser.exit(1, f"{args.token} not found. Authorize Gmail in the app "
+                    "first (streamlit run app.py).\n")
+
+    credentials = CredentialManager(token_file=args.token)
+    credentials.start()  # Refresh the token before it expires, between runs
+    processor = EmailProcessor(credentials.api_resource,
+                               fused_triage=not args.separate_chains,
+                               max_concurrency=args.concurrency,
+                               prometheus_path=args.prometheus)
+    store = ResultsStore(args.store)
+
+    stop = threading.Event()
+
+    def shutdown(*_):
+        stop.set()
+        credentials.stop()
+        processor.cancel()  # Don't wait for a run in progress to finish
+
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, shutdown)
+
+    while True:
+        try:
+            if not run_once(processor, store, args.query, args.max_results):
+                logger.error("Triage run failed: %s", "; ".join(processor.errors))
+        except Exception:
+            logger.exception("Triage run failed")
+        if credentials.refresh_error:
+            parser.exit(1, f"Gmail access was revoked ({credentials.refresh_error}). "
+                        "Authorize Gmail in the app again.\n")
+        if args.once or stop.wait(args.interval):
+            break
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())